@@ -0,0 +1,83 @@
+"""
+Бенчмарк доступа к БД из асинхронных обработчиков.
+
+Несколько "чатов" одновременно запрашивают товар. Каждый запрос к БД
+имитирует задержку QUERY_TIME. Блокирующий вызов прямо в event loop
+выстраивает чаты в очередь, вызов через пул потоков БД - нет.
+
+Запуск: python -m benchmarks.bench_async_db
+"""
+import asyncio
+import time
+
+from opencart_db import ConnectionPool, configure_db_executor
+from opencart_products import OpenCartProducts
+
+
+QUERY_TIME = 0.05
+CHATS = (1, 5, 20)
+POOL_SIZE = 10
+
+
+class SlowCursor():
+    """Курсор, отвечающий на любой запрос одной строкой с задержкой."""
+
+    def execute(self, query, params=()):
+        time.sleep(QUERY_TIME)
+
+    def __iter__(self):
+        return iter([(1, 'Пицца', 100, 10, 'pizza.jpg', 'Описание')])
+
+    def close(self):
+        pass
+
+
+class SlowConnection():
+
+    def cursor(self):
+        return SlowCursor()
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def make_products():
+    op_products = OpenCartProducts(user=None, password=None, host=None,
+                                   database='bench_async',
+                                   website='example.com', cache=False)
+    op_products.pool = ConnectionPool(None, None, None, 'bench_async',
+                                      size=POOL_SIZE,
+                                      connect=SlowConnection)
+    return op_products
+
+
+async def blocking_chat(op_products):
+    return op_products.get_my_product(1)
+
+
+async def async_chat(op_products):
+    return await op_products.get_my_product_async(1)
+
+
+async def run(chat, chats):
+    op_products = make_products()
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(op_products) for _ in range(chats)))
+    return time.perf_counter() - started
+
+
+def main():
+    configure_db_executor(max_workers=POOL_SIZE)
+    print(f'query time: {QUERY_TIME * 1000:.0f} ms, pool size: {POOL_SIZE}')
+    print(f'{"chats":>6} {"blocking, ms":>14} {"executor, ms":>14}')
+    for chats in CHATS:
+        blocking = asyncio.run(run(blocking_chat, chats))
+        executor = asyncio.run(run(async_chat, chats))
+        print(f'{chats:>6} {blocking * 1000:>14.1f} {executor * 1000:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Бенчмарк бэкендов корзины: OpenCart API против прямых запросов к БД.
+
+Каждая "корзина" - это отдельный чат со своим api_token, который
+кладет в корзину два товара, смотрит корзину, меняет количество,
+удаляет товар и снова смотрит корзину. Все корзины работают
+одновременно.
+
+Оба бэкенда работают с FakeOpenCart: HTTP-бэкенд ходит в его api/*,
+где каждый запрос тратит BOOTSTRAP_TIME (запуск PHP-приложения),
+а одновременно обслуживается не больше PHP_WORKERS запросов (пул
+php-fpm). БД-бэкенд работает с его SQLite, к каждому запросу
+добавляется сетевая задержка QUERY_TIME.
+
+Запуск: python -m benchmarks.bench_cart_backends
+"""
+import asyncio
+import statistics
+import time
+
+import opencart_api_async as api_async
+
+from benchmarks.fake_opencart import FakeOpenCart
+from opencart_cart_db import DatabaseCart
+from opencart_db import ConnectionPool, configure_db_executor
+from opencart_transport import configure_transport
+
+
+CARTS = (50, 200, 1000)
+BOOTSTRAP_TIME = 0.03
+PHP_WORKERS = 16
+QUERY_TIME = 0.001
+POOL_SIZE = 10
+PORT = 8771
+
+
+async def chat(backend, session, api_token, website, latencies):
+    """Сценарий одной корзины. Время каждой операции - в latencies."""
+
+    async def timed(func, *args, **kwargs):
+        started = time.perf_counter()
+        result = await func(session, api_token, *args, **kwargs)
+        latencies.append(time.perf_counter() - started)
+        return result
+
+    await timed(backend.cart_add, 1, website, 1)
+    await timed(backend.cart_add, 2, website, 2)
+    cart = await timed(backend.get_cart_products, website)
+    first, second = cart['products']
+    await timed(backend.cart_edit, first['cart_id'], website, 3)
+    await timed(backend.cart_remove, second['cart_id'], website)
+    cart = await timed(backend.get_cart_products, website)
+    assert [product['quantity'] for product in cart['products']] == ['3']
+
+
+async def run(fake, backend, carts, website):
+    latencies = []
+    session = api_async.create_session(limit=PHP_WORKERS * 2)
+    try:
+        # Токены получаем заранее: api/login в замер не входит.
+        fake.latency = 0
+        api_tokens = [await api_async.get_api_token(session, 'bot', 'key',
+                                                    website)
+                      for _ in range(carts)]
+        fake.latency = BOOTSTRAP_TIME
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            chat(backend, session, api_token, website, latencies)
+            for api_token in api_tokens))
+        elapsed = time.perf_counter() - started
+    finally:
+        await session.close()
+    latencies.sort()
+    return {
+        'elapsed': elapsed,
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(len(latencies) * 0.95)],
+    }
+
+
+async def bench():
+    fake = FakeOpenCart(workers=PHP_WORKERS, query_time=QUERY_TIME)
+    fake.seed()
+    db_cart = DatabaseCart(user=None, password=None, host=None,
+                           database='bench_cart', api_username='bot')
+    db_cart.pool = ConnectionPool(None, None, None, 'bench_cart',
+                                  size=POOL_SIZE, connect=fake.connect)
+    backends = (('http', api_async), ('db', db_cart))
+
+    website = await fake.start(port=PORT)
+    print(f'bootstrap: {BOOTSTRAP_TIME * 1000:.0f} ms, '
+          f'php workers: {PHP_WORKERS}, '
+          f'query: {QUERY_TIME * 1000:.0f} ms, db pool: {POOL_SIZE}')
+    print(f'{"carts":>6} {"backend":>8} {"total, s":>9} '
+          f'{"p50, ms":>9} {"p95, ms":>9}')
+    try:
+        for carts in CARTS:
+            for name, backend in backends:
+                result = await run(fake, backend, carts, website)
+                print(f'{carts:>6} {name:>8} {result["elapsed"]:>9.2f} '
+                      f'{result["p50"] * 1000:>9.1f} '
+                      f'{result["p95"] * 1000:>9.1f}')
+    finally:
+        await fake.stop()
+        fake.close()
+
+
+def main():
+    configure_db_executor(max_workers=POOL_SIZE)
+    # Меряем очередь к PHP-воркерам, а не срабатывание таймаутов.
+    configure_transport(default_timeout=300,
+                        route_timeouts={'api/cart/products': 300},
+                        retries=0,
+                        failure_threshold=float('inf'))
+    asyncio.run(bench())
+
+
+if __name__ == '__main__':
+    main()
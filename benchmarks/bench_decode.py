@@ -0,0 +1,91 @@
+"""
+Бенчмарк разбора ответов OpenCart API.
+
+Сравнивает прежний разбор (split по "</b>" и json.loads дважды - для
+лога и для результата) с decode_response на стандартном json и на
+orjson. Ответы - корзина и заказ на N товаров с уведомлением PHP
+в начале, как бывает при включенном выводе ошибок.
+
+Запуск: python -m benchmarks.bench_decode
+"""
+import json
+import timeit
+
+import opencart_api
+
+
+SIZES = (10, 100, 1000)
+# Прежний разбор не справляется с "<br />" после уведомления,
+# поэтому для сравнения берется уведомление без него.
+NOTICE = ('<b>Notice</b>:  Undefined index: customer_id in '
+          '<b>/www/catalog/controller/api/cart.php</b> on line '
+          '<b>171</b>')
+
+
+def make_cart(count):
+    """Ответ api/cart/products на count товаров."""
+    products = [{
+        'cart_id': str(cart_id),
+        'product_id': str(cart_id),
+        'name': f'Пицца {cart_id}',
+        'model': f'Пицца {cart_id}',
+        'option': [],
+        'quantity': '2',
+        'stock': True,
+        'shipping': '1',
+        'price': '395.00р.',
+        'total': '790.00р.',
+        'reward': 0,
+    } for cart_id in range(1, count + 1)]
+    totals = [{'title': 'Сумма', 'text': f'{790 * count}.00р.'},
+              {'title': 'Итого', 'text': f'{790 * count}.00р.'}]
+    return {'products': products, 'vouchers': [], 'totals': totals}
+
+
+def make_order(count):
+    """Ответ api/order/info на count товаров."""
+    return {'order': {
+        'order_id': '42',
+        'total': f'{790 * count}.0000',
+        'telephone': '+79990000000',
+        'products': make_cart(count)['products'],
+    }}
+
+
+def legacy(text):
+    """Прежний разбор: дважды split и json.loads."""
+    payload = text.split('</b>')[-1]
+    json.loads(payload)
+    return json.loads(text.split('</b>')[-1])
+
+
+def main():
+    orjson = opencart_api.orjson
+    print(f'{"payload":>12} {"size, KB":>9} {"legacy, us":>11} '
+          f'{"json, us":>9} {"orjson, us":>11}')
+    for name, make in (('cart', make_cart), ('order', make_order)):
+        for size in SIZES:
+            text = NOTICE + json.dumps(make(size), ensure_ascii=False)
+            body = text.encode('utf-8')
+            number = max(10, 10000 // size)
+
+            legacy_time = timeit.timeit(lambda: legacy(text), number=number)
+            opencart_api.orjson = None
+            json_time = timeit.timeit(
+                lambda: opencart_api.decode_response(body), number=number)
+            opencart_api.orjson = orjson
+            if orjson is not None:
+                orjson_time = timeit.timeit(
+                    lambda: opencart_api.decode_response(body),
+                    number=number) / number * 1e6
+                orjson_text = f'{orjson_time:>11.1f}'
+            else:
+                orjson_text = f'{"-":>11}'
+
+            print(f'{f"{name} x{size}":>12} {len(body) / 1024:>9.1f} '
+                  f'{legacy_time / number * 1e6:>11.1f} '
+                  f'{json_time / number * 1e6:>9.1f} {orjson_text}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Бенчмарк раздачи заказов доставщикам.
+
+Заказы приходят с частотой --rate в секунду в течение --duration
+секунд, клиенты случайно разбросаны в --spread км вокруг пиццерий
+FakeOpenCart. Сравнивается прежняя отправка каждого заказа доставщику
+сразу (сообщение и геопозиция, доставщики по очереди) с Dispatcher
+при разных окнах раздачи: сколько сообщений получают доставщики,
+сколько километров проезжают (каждый заказ отдельно туда и обратно
+против маршрута по нескольким адресам) и сколько заказ ждет раздачи.
+
+Отдельно меряется время планирования (матрица расстояний, пакеты
+и маршруты) для больших очередей.
+
+Запуск: python -m benchmarks.bench_dispatch
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import time
+
+from benchmarks.bench_e2e import percentiles
+from benchmarks.fake_opencart import STORES, FakeOpenCart
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.fake_telegram import FakeBot
+from dispatch import Dispatcher
+from opencart_couriers import CourierDirectory
+from opencart_stores import StoreIndex
+
+
+DB_USER = 'bench'
+DB_HOST = 'localhost'
+DB_NAME = 'bench_dispatch'
+
+
+def random_point(center, spread_km, rng):
+    lat, lon = center
+    angle = rng.uniform(0, 2 * math.pi)
+    radius = spread_km * math.sqrt(rng.random())
+    return (lat + radius / 111.1 * math.sin(angle),
+            lon + radius / (111.1 * math.cos(math.radians(lat)))
+            * math.cos(angle))
+
+
+def make_orders(count, spread, stores, rng):
+    centers = [tuple(map(float, geocode.split(',')))
+               for _, _, geocode in STORES]
+    orders = []
+    for order_id in range(1, count + 1):
+        lat, lon = random_point(rng.choice(centers), spread, rng)
+        store = stores.nearest(lat, lon)[0]
+        orders.append({'order_id': order_id, 'store': store['name'],
+                       'lat': lat, 'lon': lon, 'distance': store['distance'],
+                       'text': f'Пицца {order_id % 20 + 1} - 1 шт.'})
+    return orders
+
+
+async def immediate(args, orders, directory):
+    """Прежний delivery(): каждый заказ сразу своему доставщику."""
+    fake_bot = FakeBot(latency=args.telegram_latency)
+    km = 0.0
+    for order in orders:
+        courier = directory.pick(order['store'])
+        await fake_bot.send_message(chat_id=courier, text=order['text'])
+        await fake_bot.send_location(chat_id=courier, latitude=order['lat'],
+                                     longitude=order['lon'])
+        directory.assigned(courier, order['order_id'])
+        km += 2 * order['distance']
+        await asyncio.sleep(1 / args.rate)
+    return {'messages': fake_bot.total_calls(), 'km': km, 'stats': {}}
+
+
+async def batched(args, orders, dispatcher, window):
+    fake_bot = FakeBot(latency=args.telegram_latency)
+    done = asyncio.Event()
+
+    async def dispatch_loop():
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), window)
+            except asyncio.TimeoutError:
+                pass
+            await dispatcher.run(fake_bot)
+        # Остаток очереди после последнего заказа.
+        while await dispatcher.run(fake_bot):
+            pass
+
+    loop_task = asyncio.create_task(dispatch_loop())
+    for order in orders:
+        dispatcher.add(order['order_id'], 0, order['store'], order['lat'],
+                       order['lon'], order['text'])
+        await asyncio.sleep(1 / args.rate)
+    done.set()
+    await loop_task
+    stats = dispatcher.stats()
+    return {'messages': fake_bot.total_calls(), 'km': stats['route_km'],
+            'stats': stats}
+
+
+def plan_times(args, dispatcher, stores, rng):
+    """Время Dispatcher.plan для очередей разной длины, мс."""
+    times = {}
+    for count in args.plan_orders:
+        samples = []
+        for _ in range(args.plan_repeats):
+            orders = make_orders(count, args.spread, stores, rng)
+            for order in orders:
+                order['created_at'] = time.time()
+            started = time.perf_counter()
+            dispatcher.plan(orders)
+            samples.append(time.perf_counter() - started)
+        times[count] = percentiles(samples)
+    return times
+
+
+async def bench(args):
+    rng = random.Random(args.seed)
+    fake = FakeOpenCart()
+    fake.seed(products=20, couriers_per_store=args.couriers)
+    fake.install_database(DB_USER, DB_HOST, DB_NAME)
+    stores = StoreIndex(DB_USER, None, DB_HOST, DB_NAME, max_staleness=3600)
+    orders = make_orders(int(args.rate * args.duration), args.spread,
+                         stores, rng)
+    print(f'{len(orders)} orders in {args.duration} s, '
+          f'{len(STORES)} stores x {args.couriers} couriers, '
+          f'max {args.max_stops} stops within {args.radius} km')
+    print(f'{"window":>7} {"messages":>9} {"km":>8} {"km/order":>9} '
+          f'{"stops":>6} {"wait p50":>9} {"wait p95":>9} {"deferred":>9}')
+
+    def directory():
+        # У каждого прогона своя нагрузка доставщиков.
+        return CourierDirectory(DB_USER, None, DB_HOST, DB_NAME,
+                                FakeRedis(), strategy='least_loaded')
+
+    result = await immediate(args, orders, directory())
+    print(f'{"now":>7} {result["messages"]:>9} {result["km"]:>8.1f} '
+          f'{result["km"] / len(orders):>9.2f} {1:>6.2f} '
+          f'{"-":>9} {"-":>9} {"-":>9}')
+    for window in args.windows:
+        courier_directory = directory()
+        dispatcher = Dispatcher(courier_directory.db, courier_directory,
+                                stores, max_stops=args.max_stops,
+                                radius_km=args.radius)
+        result = await batched(args, orders, dispatcher, window)
+        stats = result['stats']
+        print(f'{window:>7} {result["messages"]:>9} {result["km"]:>8.1f} '
+              f'{result["km"] / len(orders):>9.2f} '
+              f'{stats["stops_per_route"]:>6.2f} '
+              f'{stats["assignment"]["p50_ms"]:>9} '
+              f'{stats["assignment"]["p95_ms"]:>9} '
+              f'{stats["deferred"]:>9}')
+
+    print(f'\n{"orders":>7} {"plan p50, ms":>13} {"plan p95, ms":>13}')
+    for count, stats in plan_times(args, dispatcher, stores, rng).items():
+        print(f'{count:>7} {stats["p50_ms"]:>13.2f} {stats["p95_ms"]:>13.2f}')
+    fake.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rate', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--spread', type=float, default=6.0)
+    parser.add_argument('--couriers', type=int, default=4)
+    parser.add_argument('--windows', type=float, nargs='+',
+                        default=[0.5, 1, 2])
+    parser.add_argument('--max-stops', type=int, default=5)
+    parser.add_argument('--radius', type=float, default=3.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--plan-orders', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--plan-repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    logging.getLogger('tg_bot').setLevel(logging.WARNING)
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
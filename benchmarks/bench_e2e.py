@@ -0,0 +1,447 @@
+"""
+Сквозной нагрузочный тест бота.
+
+Синтетические пользователи проходят весь путь покупателя: /start,
+листание меню, карточки товаров, добавление в корзину, корзина,
+телефон, адрес или геопозиция, доставка или самовывоз, оплата.
+Каждый апдейт - настоящий telegram.Update, который обрабатывает
+handle_users_reply, как в рабочем боте. Внешние системы заменены:
+Telegram - FakeBot, Redis - FakeRedis, OpenCart и его БД -
+FakeOpenCart, геокодер - StubGeocoder с таблицей адресов.
+
+Отчет: пропускная способность, p50/p95/p99 времени обработки апдейта
+по состояниям бота и времени каждого внешнего вызова (маршруты
+OpenCart API, запросы к БД, методы Telegram), число вызовов Telegram
+на апдейт и команд Redis. Результат пишется в JSON (--output), его
+можно сравнить с результатом другого коммита (--compare).
+
+Запуск: python -m benchmarks.bench_e2e --users 200 --output e2e.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import subprocess
+import time
+
+import shop_tg_bot as bot
+
+from benchmarks.fake_opencart import FakeOpenCart, query_name
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.fake_telegram import FakeBot, UpdateFactory
+from geocoder import CachedGeocoder, StubGeocoder
+from opencart_db import configure_db_executor
+from opencart_transport import configure_transport
+from tariffs import TariffEngine
+
+
+PHONE = '+79131234567'
+# Адреса, которые "знает" геокодер, и их координаты (широта, долгота).
+ADDRESSES = {
+    'Минусинск, ул. Ленина, 10': ('53.7105', '91.6880'),
+    'Минусинск, ул. Мира, 45': ('53.6960', '91.7030'),
+    'Минусинск, ул. Абаканская, 3': ('53.7220', '91.6640'),
+    'Минусинск, ул. Дальняя, 1': ('53.9000', '92.1000'),
+}
+DB_USER = 'bench'
+DB_HOST = 'localhost'
+DB_NAME = 'opencart'
+DELIVERY_ZONES_PATH = 'data/delivery_zones.json'
+
+
+def percentiles(samples):
+    """Сводка по выборке длительностей, мс."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def rank(q):
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': rank(50) * 1000,
+        'p95_ms': rank(95) * 1000,
+        'p99_ms': rank(99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+class Samples():
+    """Длительности, сгруппированные по имени."""
+
+    def __init__(self):
+        """Инициализировать атрибуты данных."""
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        return {name: percentiles(samples)
+                for name, samples in sorted(self.samples.items())}
+
+
+class ErrorCounter(logging.Handler):
+    """Считает ошибки, которые бот только пишет в лог."""
+
+    def __init__(self):
+        """Инициализировать атрибуты данных."""
+        super().__init__(logging.ERROR)
+        self.errors = {}
+
+    def emit(self, record):
+        message = record.getMessage().split('\n')[0][:120]
+        self.errors[message] = self.errors.get(message, 0) + 1
+
+
+class FakeJobQueue():
+
+    def __init__(self):
+        """Инициализировать атрибуты данных."""
+        self.jobs = 0
+
+    def run_once(self, callback, when, **kwargs):
+        self.jobs += 1
+
+
+class FakeContext():
+    """Контекст обработчика: бот и очередь задач."""
+
+    def __init__(self, fake_bot):
+        """Инициализировать атрибуты данных."""
+        self.bot = fake_bot
+        self.job_queue = FakeJobQueue()
+
+
+class ScenarioError(Exception):
+    """Бот не показал кнопку, которую пользователь хотел нажать."""
+
+
+class Harness():
+    """Прогоняет апдейты через handle_users_reply и собирает метрики."""
+
+    def __init__(self, args, fake_bot, redis):
+        """Инициализировать атрибуты данных."""
+        self.args = args
+        self.bot = fake_bot
+        self.redis = redis
+        self.updates = UpdateFactory(fake_bot)
+        self.context = FakeContext(fake_bot)
+        self.states = Samples()
+        self.telegram_per_update = {}
+        self.scenario_errors = 0
+        self.completed = 0
+        self.processed = 0
+
+    async def dispatch(self, chat_id, update, command=False):
+        if command:
+            state = 'START'
+        else:
+            state = self.redis.data.get(str(chat_id), 'NONE')
+        started = time.perf_counter()
+        # Считаем только вызовы этого апдейта, а не соседних пользователей.
+        calls = await self.bot.count_calls(
+            bot.handle_users_reply(update, self.context))
+        self.states.add(state, time.perf_counter() - started)
+        self.telegram_per_update.setdefault(state, []).append(calls)
+        self.processed += 1
+
+    async def text(self, chat_id, text):
+        await self.dispatch(chat_id, self.updates.text(chat_id, text),
+                            command=text == '/start')
+
+    async def location(self, chat_id, latitude, longitude):
+        await self.dispatch(chat_id,
+                            self.updates.location(chat_id, latitude,
+                                                  longitude))
+
+    async def tap(self, chat_id, match, rng=None):
+        """Нажать кнопку последней клавиатуры: match(текст, данные).
+
+        Если подходят несколько кнопок, а передан rng, нажимается
+        случайная из них, иначе первая.
+        """
+        buttons = [data for text, data in self.bot.keyboards.get(chat_id, [])
+                   if match(text, data)]
+        if not buttons:
+            raise ScenarioError(f'Чат {chat_id}: нет нужной кнопки среди '
+                                f'{self.bot.keyboards.get(chat_id)}')
+        data = rng.choice(buttons) if rng else buttons[0]
+        await self.dispatch(chat_id, self.updates.callback(chat_id, data))
+        return data
+
+    async def tap_text(self, chat_id, text):
+        return await self.tap(chat_id,
+                              lambda button, data: button == text)
+
+    async def user(self, chat_id, rng):
+        """Сценарий одного покупателя."""
+        args = self.args
+        try:
+            await self.text(chat_id, '/start')
+            for _ in range(rng.randint(0, 2)):
+                await self.tap_text(chat_id, 'След')
+            for _ in range(rng.randint(1, 3)):
+                # Кнопки товаров - это их product_id.
+                await self.tap(chat_id, lambda text, data: data.isdigit(),
+                               rng)
+                await self.tap_text(chat_id, 'Положить в корзину')
+                await self.tap_text(chat_id, 'Назад')
+            await self.tap_text(chat_id, 'Корзина')
+            if rng.random() >= args.checkout_ratio:
+                await self.tap_text(chat_id, 'В меню')
+                self.completed += 1
+                return
+
+            await self.tap_text(chat_id, 'Сделать заказ')
+            await self.text(chat_id, PHONE)
+            await self.tap_text(chat_id, 'Верно')
+            if rng.random() < 0.5:
+                latitude, longitude = rng.choice(list(ADDRESSES.values())[:3])
+                await self.location(chat_id, float(latitude),
+                                    float(longitude))
+            else:
+                address = rng.choice(list(ADDRESSES)[:3])
+                if rng.random() < 0.5:
+                    # Тот же адрес, набранный иначе.
+                    address = address.lower().replace(', ', ' ,  ')
+                await self.text(chat_id, address)
+            await self.tap_text(chat_id, rng.choice(('Доставка',
+                                                     'Самовывоз')))
+            await self.tap_text(chat_id, rng.choice(('Оплата онлайн',
+                                                     'Оплата на месте')))
+            self.completed += 1
+        except ScenarioError as err:
+            self.scenario_errors += 1
+            logging.getLogger('tg_bot.bench').warning(err)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench(args):
+    errors = ErrorCounter()
+    logging.getLogger('tg_bot').addHandler(errors)
+
+    opencart_calls = Samples()
+    db_queries = Samples()
+    fake = FakeOpenCart(latency=args.opencart_latency,
+                        jitter=args.opencart_jitter,
+                        workers=args.php_workers,
+                        error_rate=args.error_rate,
+                        notice_rate=args.notice_rate,
+                        query_time=args.query_time,
+                        query_observer=lambda query, seconds: db_queries.add(
+                            query_name(query), seconds),
+                        seed=args.seed)
+    fake.seed(products=args.products)
+    fake.install_database(DB_USER, DB_HOST, DB_NAME, size=args.db_pool)
+    configure_db_executor(max_workers=args.db_pool)
+    configure_transport(observer=lambda route, seconds, error:
+                        opencart_calls.add(route, seconds))
+    website = await fake.start(port=args.port)
+
+    redis = FakeRedis(latency=args.redis_latency)
+    fake_bot = FakeBot(latency=args.telegram_latency,
+                       download_latency=args.photo_download_latency)
+    # Бот берет настройки из переменных окружения при импорте,
+    # здесь они указывают на заглушки.
+    bot.OP_USER, bot.OP_PASSWORD = DB_USER, None
+    bot.OP_HOST, bot.OP_DATABASE = DB_HOST, DB_NAME
+    bot.API_USERNAME, bot.API_KEY = fake.api_username, fake.api_key
+    bot.WEBSITE = website
+    bot.CART_BACKEND = args.cart_backend
+    bot._database = redis
+    bot._renderer = None
+    bot._photo_cache = None
+    bot._tariffs = TariffEngine.from_file(DELIVERY_ZONES_PATH)
+    geocoder = bot._geocoder = CachedGeocoder(
+        redis, StubGeocoder(ADDRESSES, latency=args.geocoder_latency))
+
+    harness = Harness(args, fake_bot, redis)
+    limit = asyncio.Semaphore(args.concurrency)
+    rng = random.Random(args.seed)
+
+    async def user(chat_id, user_rng):
+        async with limit:
+            await harness.user(chat_id, user_rng)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            user(chat_id, random.Random(rng.random()))
+            for chat_id in range(1000001, 1000001 + args.users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.close_api_sessions(None)
+        await fake.stop()
+        fake.close()
+        logging.getLogger('tg_bot').removeHandler(errors)
+
+    telegram_calls = fake_bot.total_calls()
+    render = {}
+    if bot._renderer is not None:
+        render = bot._renderer.stats()
+    geocoder_stats = geocoder.stats()
+    geocoder_stats['requests'] = geocoder.geocoder.requests
+    tariffs = bot._tariffs.stats()
+    couriers = {}
+    if hasattr(bot, 'get_courier_directory'):
+        couriers = bot.get_courier_directory().stats()
+        # Сколько заказов ушло каждому доставщику.
+        couriers['deliveries'] = dict(sorted(fake_bot.locations.items()))
+    photos = {}
+    if getattr(bot, '_photo_cache', None) is not None:
+        photos = bot._photo_cache.stats()
+    return {
+        'commit': git_commit(),
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'users': args.users,
+        'completed_users': harness.completed,
+        'scenario_errors': harness.scenario_errors,
+        'updates': harness.processed,
+        'throughput_updates_per_s': harness.processed / elapsed,
+        'errors': errors.errors,
+        'states': harness.states.summary(),
+        'opencart': opencart_calls.summary(),
+        'opencart_requests': fake.stats(),
+        'db': db_queries.summary(),
+        'telegram': {
+            'calls': telegram_calls,
+            'calls_per_update': telegram_calls / max(harness.processed, 1),
+            'calls_per_update_by_state': {
+                state: statistics.fmean(calls)
+                for state, calls in sorted(
+                    harness.telegram_per_update.items())},
+            'photo_downloads': fake_bot.downloads,
+            'methods': {method: percentiles(samples)
+                        for method, samples in sorted(
+                            fake_bot.latencies.items())},
+        },
+        'redis_commands': dict(sorted(redis.commands.items())),
+        'render': render,
+        'photos': photos,
+        'geocoder': geocoder_stats,
+        'couriers': couriers,
+        'tariffs': tariffs,
+    }
+
+
+def print_report(result):
+    print(f'commit {result["commit"]}: {result["updates"]} updates '
+          f'from {result["users"]} users in {result["elapsed_s"]:.2f} s, '
+          f'{result["throughput_updates_per_s"]:.1f} updates/s, '
+          f'errors: {sum(result["errors"].values())}, '
+          f'scenario errors: {result["scenario_errors"]}')
+    for title, section in (('state', result['states']),
+                           ('opencart', result['opencart']),
+                           ('db', result['db']),
+                           ('telegram', result['telegram']['methods'])):
+        print(f'\n{title:<28} {"count":>7} {"p50, ms":>9} '
+              f'{"p95, ms":>9} {"p99, ms":>9}')
+        for name, stats in section.items():
+            print(f'{name[:28]:<28} {stats["count"]:>7} '
+                  f'{stats["p50_ms"]:>9.1f} {stats["p95_ms"]:>9.1f} '
+                  f'{stats["p99_ms"]:>9.1f}')
+    print(f'\ntelegram calls per update: '
+          f'{result["telegram"]["calls_per_update"]:.2f}')
+    for state, calls in result['telegram'][
+            'calls_per_update_by_state'].items():
+        print(f'  {state:<26} {calls:>7.2f}')
+    if result.get('render'):
+        print(f'render: {result["render"]}')
+    print(f'photo downloads: {result["telegram"].get("photo_downloads")}')
+    if result.get('photos'):
+        print(f'photo cache: {result["photos"]}')
+    if result.get('geocoder'):
+        print(f'geocoder: {result["geocoder"]}')
+    if result.get('tariffs'):
+        print(f'tariffs: {result["tariffs"]}')
+    if result.get('couriers'):
+        print(f'couriers: {result["couriers"]}')
+    print(f'redis commands: {result["redis_commands"]}')
+    for message, count in result['errors'].items():
+        print(f'error x{count}: {message}')
+
+
+def print_comparison(baseline, result):
+    """p95 по состояниям и пропускная способность против baseline."""
+    print(f'\ncompare {baseline["commit"]} -> {result["commit"]}')
+    rows = [('throughput, updates/s',
+             baseline['throughput_updates_per_s'],
+             result['throughput_updates_per_s'])]
+    for section in ('states', 'opencart'):
+        for name, stats in result[section].items():
+            old = baseline[section].get(name)
+            if old and old.get('count'):
+                rows.append((f'{section} {name} p95, ms',
+                             old['p95_ms'], stats['p95_ms']))
+    rows.append(('telegram calls per update',
+                 baseline['telegram']['calls_per_update'],
+                 result['telegram']['calls_per_update']))
+    old_states = baseline['telegram']['calls_per_update_by_state']
+    for state, calls in result['telegram'][
+            'calls_per_update_by_state'].items():
+        if state in old_states:
+            rows.append((f'telegram calls per update {state}',
+                         old_states[state], calls))
+    for name, old, new in rows:
+        change = (new - old) / old * 100 if old else float('nan')
+        print(f'{name[:40]:<40} {old:>10.2f} {new:>10.2f} {change:>+8.1f}%')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='сколько пользователей действуют одновременно')
+    parser.add_argument('--checkout-ratio', type=float, default=0.7)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--cart-backend', choices=('http', 'db'),
+                        default='http')
+    parser.add_argument('--opencart-latency', type=float, default=0.03)
+    parser.add_argument('--opencart-jitter', type=float, default=0.02)
+    parser.add_argument('--php-workers', type=int, default=16)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--notice-rate', type=float, default=0.1)
+    parser.add_argument('--query-time', type=float, default=0.001)
+    parser.add_argument('--db-pool', type=int, default=5)
+    parser.add_argument('--redis-latency', type=float, default=0.0002)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--photo-download-latency', type=float,
+                        default=0.15)
+    parser.add_argument('--geocoder-latency', type=float, default=0.2)
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='куда записать результат в JSON')
+    parser.add_argument('--compare', help='JSON прошлого прогона')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    for name in ('tg_bot', 'aiohttp.access'):
+        logging.getLogger(name).setLevel(args.log_level)
+
+    result = asyncio.run(bench(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main()
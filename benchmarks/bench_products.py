@@ -0,0 +1,76 @@
+"""
+Микро-бенчмарк поиска товара по id.
+
+Сравнивает поиск по индексу снимка каталога (get_my_product) с прежним
+полным перебором строк каталога на каталогах от 100 до 100 000 товаров.
+
+Запуск: python -m benchmarks.bench_products
+"""
+import random
+import time
+import timeit
+
+from opencart_db import SnapshotCache
+from opencart_products import CatalogSnapshot, OpenCartProducts
+
+
+SIZES = (100, 1_000, 10_000, 100_000)
+LOOKUPS = 1_000
+
+
+def make_rows(count):
+    """Строки каталога в том виде, в каком их отдает запрос к БД."""
+    return [(product_id, f'Пицца {product_id}', 100 + product_id, 10,
+             f'catalog/food/{product_id}.jpg', 'Описание')
+            for product_id in range(1, count + 1)]
+
+
+def make_products(rows):
+    """OpenCartProducts с заранее построенным снимком каталога."""
+    op_products = OpenCartProducts(user=None, password=None, host=None,
+                                   database=f'bench_{len(rows)}',
+                                   website='example.com', cache=False)
+    op_products.cache = SnapshotCache(None, None, None,
+                                      max_staleness=float('inf'))
+    products = {row[0]: op_products._make_product(*row) for row in rows}
+    op_products.cache.snapshot = CatalogSnapshot(products, list(products),
+                                                 {})
+    op_products.cache.checked_at = time.monotonic()
+    return op_products
+
+
+def scan(rows, id_my_product, image_path):
+    """Прежний способ: перебор всех строк каталога."""
+    product = {}
+    for (id, name, price, quantity, image, description) in rows:
+        if id == id_my_product:
+            product['id'] = id
+            product['name'] = name
+            product['price'] = int(price)
+            product['quantity'] = quantity
+            product['image'] = image_path + image
+            product['description'] = description
+    return product
+
+
+def main():
+    print(f'{"products":>10} {"index, us":>12} {"scan, us":>12}')
+    for size in SIZES:
+        rows = make_rows(size)
+        op_products = make_products(rows)
+        ids = [random.randint(1, size) for _ in range(LOOKUPS)]
+
+        index_time = timeit.timeit(
+            lambda: [op_products.get_my_product(id) for id in ids], number=1)
+        # Перебор слишком медленный, чтобы гонять его на всех ids.
+        scan_ids = ids[:max(1, LOOKUPS * 100 // size)]
+        scan_time = timeit.timeit(
+            lambda: [scan(rows, id, op_products.image_path)
+                     for id in scan_ids], number=1)
+
+        print(f'{size:>10} {index_time / len(ids) * 1e6:>12.2f} '
+              f'{scan_time / len(scan_ids) * 1e6:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
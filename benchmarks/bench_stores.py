@@ -0,0 +1,118 @@
+"""
+Бенчмарк поиска ближайшего пункта самовывоза.
+
+Сравнивает прежний способ - запрос всей oc_location на каждое
+сообщение с геопозицией и geopy.distance по каждому пункту в цикле -
+с StoreIndex: массивы numpy, векторные гаверсинусы и уточнение
+нескольких кандидатов geopy. Пункты случайно разбросаны вокруг
+Минусинска, oc_location лежит в FakeOpenCart.
+
+Отдельно меряется чистый поиск (без БД) и поиск вместе с получением
+пунктов (прежний запрос к БД против свежего индекса). Для каждого
+числа пунктов проверяется, что оба способа находят один и тот же пункт.
+
+Запуск: python -m benchmarks.bench_stores
+"""
+import argparse
+import random
+import time
+
+from geopy import distance
+
+from benchmarks.bench_e2e import percentiles
+from benchmarks.fake_opencart import FakeOpenCart
+from opencart_stores import StoreIndex
+
+
+DB_USER = 'bench'
+DB_HOST = 'localhost'
+CENTER = (53.7105, 91.6880)
+
+
+def load_stores(pool):
+    """Прежний get_all_stores_locations: запрос всей oc_location."""
+    with pool.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute('SELECT name, geocode from oc_location')
+        locations = [{'name': name, 'geocode': geocode}
+                     for name, geocode in cursor]
+        cursor.close()
+    return locations
+
+
+def geopy_nearest(user_geocode, stores_locations):
+    """Прежний get_distance_to_stores + min(..., key=get_distance)."""
+    distances = [{'name': store['name'],
+                  'distance': distance.distance(store['geocode'],
+                                                user_geocode).km}
+                 for store in stores_locations]
+    return min(distances, key=lambda store: store['distance'])
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def run(args, stores_count, rng):
+    stores = [(f'Пункт {number}', f'ул. {number}',
+               f'{CENTER[0] + rng.uniform(-0.5, 0.5):.6f},'
+               f'{CENTER[1] + rng.uniform(-0.8, 0.8):.6f}')
+              for number in range(stores_count)]
+    database = f'bench_stores_{stores_count}'
+    fake = FakeOpenCart(query_time=args.query_time)
+    fake.seed(products=1, stores=stores, couriers_per_store=0)
+    pool = fake.install_database(DB_USER, DB_HOST, database)
+    index = StoreIndex(DB_USER, None, DB_HOST, database,
+                       max_staleness=3600)
+    index.get_snapshot()
+
+    users = [(CENTER[0] + rng.uniform(-0.5, 0.5),
+              CENTER[1] + rng.uniform(-0.8, 0.8))
+             for _ in range(args.lookups)]
+    loaded = load_stores(pool)
+    times = {'geopy': [], 'index': [], 'geopy+db': [], 'index+db': []}
+    mismatches = 0
+    for user in users:
+        old, seconds = timed(geopy_nearest, user, loaded)
+        times['geopy'].append(seconds)
+        new, seconds = timed(index.nearest, *user)
+        times['index'].append(seconds)
+        if old['name'] != new[0]['name']:
+            mismatches += 1
+
+    # С получением пунктов: по-старому на каждое сообщение идет запрос.
+    for user in users[:args.db_lookups]:
+        _, seconds = timed(lambda: geopy_nearest(user, load_stores(pool)))
+        times['geopy+db'].append(seconds)
+        _, seconds = timed(index.nearest, *user)
+        times['index+db'].append(seconds)
+    fake.close()
+    return {name: percentiles(samples) for name, samples in times.items()}, \
+        mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--stores', type=int, nargs='+',
+                        default=[3, 100, 1000, 5000])
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--db-lookups', type=int, default=10)
+    parser.add_argument('--query-time', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print(f'{"stores":>6} {"method":>9} {"p50, ms":>9} {"p95, ms":>9} '
+          f'{"p99, ms":>9}')
+    for stores_count in args.stores:
+        results, mismatches = run(args, stores_count, rng)
+        for name, stats in results.items():
+            print(f'{stores_count:>6} {name:>9} {stats["p50_ms"]:>9.3f} '
+                  f'{stats["p95_ms"]:>9.3f} {stats["p99_ms"]:>9.3f}')
+        print(f'{stores_count:>6} {"mismatch":>9} {mismatches}')
+
+
+if __name__ == '__main__':
+    main()
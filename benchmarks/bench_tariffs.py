@@ -0,0 +1,144 @@
+"""
+Бенчмарк расчета доставки (TariffEngine.quote).
+
+У каждой пиццерии --zones вложенных зон-многоугольников по --vertices
+вершин: звезды с неровным краем вокруг пиццерии, от маленькой к
+большой, плюс полосы расстояния за пределами зон. Точки клиентов
+случайно разбросаны вокруг пиццерий.
+
+Сравниваются прямой перебор - проверка каждого многоугольника лучом без
+ограничивающих прямоугольников и сетки - и TariffEngine. Для каждой
+конфигурации проверяется, что оба способа выбирают одну и ту же зону.
+
+Запуск: python -m benchmarks.bench_tariffs
+"""
+import argparse
+import math
+import random
+import time
+
+from geopy import distance
+
+from tariffs import StoreTariff, TariffEngine, Zone
+
+
+CENTER = (53.7105, 91.6880)
+
+
+def star(center, radius_km, vertices, rng):
+    """Многоугольник-звезда с неровным краем вокруг center."""
+    lat, lon = center
+    polygon = []
+    for vertex in range(vertices):
+        angle = 2 * math.pi * vertex / vertices
+        radius = radius_km * rng.uniform(0.7, 1.0)
+        polygon.append((lat + radius / 111.1 * math.sin(angle),
+                        lon + radius / (111.1 * math.cos(math.radians(lat)))
+                        * math.cos(angle)))
+    return polygon
+
+
+def build(args, rng):
+    stores = {}
+    centers = {}
+    polygons = {}
+    for number in range(args.stores):
+        name = f'Пункт {number}'
+        center = (CENTER[0] + rng.uniform(-0.1, 0.1),
+                  CENTER[1] + rng.uniform(-0.15, 0.15))
+        polygons[name] = [
+            (f'Зона {zone}', star(center, args.radius * (zone + 1)
+                                  / args.zones, args.vertices, rng))
+            for zone in range(args.zones)]
+        zones = [Zone(zone, 100 * index, 30 + 10 * index, polygon)
+                 for index, (zone, polygon) in enumerate(polygons[name])]
+        bands = ({'name': 'Пригород', 'max_distance': 3 * args.radius,
+                  'price': 500, 'eta': 120},)
+        stores[name] = StoreTariff(name, zones, bands)
+        centers[name] = center
+    return TariffEngine(stores), centers, polygons
+
+
+def contains(polygon, lat, lon):
+    """Проверка точки лучом без предварительных вычислений."""
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in zip(polygon,
+                                          polygon[1:] + polygon[:1]):
+        if ((lat1 > lat) != (lat2 > lat)
+                and lon < lon1 + (lat - lat1) * (lon2 - lon1)
+                / (lat2 - lat1)):
+            inside = not inside
+    return inside
+
+
+def naive_zone(polygons, lat, lon):
+    for name, polygon in polygons:
+        if contains(polygon, lat, lon):
+            return name
+    return None
+
+
+def run(args, rng):
+    engine, centers, polygons = build(args, rng)
+    spread = 1.5 * args.radius / 111.1
+    points = []
+    for _ in range(args.quotes):
+        name = rng.choice(list(centers))
+        lat, lon = centers[name]
+        point = (lat + rng.uniform(-spread, spread),
+                 lon + rng.uniform(-spread, spread) * 1.7)
+        points.append((name, point,
+                       distance.distance(centers[name], point).km))
+
+    started = time.perf_counter()
+    naive = [naive_zone(polygons[name], *point)
+             for name, point, _ in points]
+    naive_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    quotes = [engine.quote(name, *point, km) for name, point, km in points]
+    engine_seconds = time.perf_counter() - started
+
+    # Вне зон TariffEngine считает по полосе, перебор дает None.
+    mismatches = sum(
+        old != (None if quote['zone'] == 'Пригород' else quote['zone'])
+        for old, quote in zip(naive, quotes)
+        if quote['deliverable'])
+    return {
+        'naive_qps': len(points) / naive_seconds,
+        'engine_qps': len(points) / engine_seconds,
+        'naive_us': naive_seconds / len(points) * 1e6,
+        'engine_us': engine_seconds / len(points) * 1e6,
+        'mismatches': mismatches,
+        'stats': engine.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--stores', type=int, default=10)
+    parser.add_argument('--zones', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--vertices', type=int, nargs='+',
+                        default=[8, 64, 256])
+    parser.add_argument('--radius', type=float, default=8.0)
+    parser.add_argument('--quotes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f'{args.stores} stores, {args.quotes} quotes')
+    print(f'{"zones":>5} {"vertices":>8} {"naive q/s":>10} '
+          f'{"engine q/s":>10} {"naive us":>9} {"engine us":>9} '
+          f'{"mismatch":>8}')
+    for zones in args.zones:
+        for vertices in args.vertices:
+            config = argparse.Namespace(**{**vars(args), 'zones': zones,
+                                           'vertices': vertices})
+            result = run(config, random.Random(args.seed))
+            print(f'{zones:>5} {vertices:>8} {result["naive_qps"]:>10.0f} '
+                  f'{result["engine_qps"]:>10.0f} '
+                  f'{result["naive_us"]:>9.1f} {result["engine_us"]:>9.1f} '
+                  f'{result["mismatches"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Бенчмарк обработчиков апдейтов: последовательного, параллельного
+и параллельного с очередью на чат (ChatUpdateProcessor).
+
+Каждый чат шлет серии из --burst быстрых нажатий. Обработчик
+устроен как handle_users_reply: читает состояние чата из Redis, ходит
+во внешние системы (FakeBot и ожидание --handler-time) и записывает
+новое состояние - здесь счетчик нажатий. Если апдейты одного чата
+обрабатываются одновременно, часть нажатий теряется: это видно по
+расхождению счетчика с числом отправленных апдейтов. Часть чатов
+(--slow-chats) "медленные": их обработка занимает --slow-time.
+
+Апдейты подаются так же, как их подает Application: задача на каждый
+апдейт в порядке поступления, через process_update обработчика.
+
+Запуск: python -m benchmarks.bench_updates
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from telegram.ext import SimpleUpdateProcessor
+
+from benchmarks.bench_e2e import percentiles
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.fake_telegram import FakeBot, UpdateFactory
+from tg_updates import ChatUpdateProcessor
+
+
+async def run(args, name, processor):
+    redis = FakeRedis(latency=args.redis_latency)
+    fake_bot = FakeBot(latency=args.telegram_latency)
+    updates = UpdateFactory(fake_bot)
+    rng = random.Random(args.seed)
+    slow_chats = set(range(1, args.slow_chats + 1))
+    latencies = []
+    fast_latencies = []
+
+    async def handle(update, received_at):
+        chat_id = update.effective_chat.id
+        clicks = int(redis.get(f'clicks:{chat_id}') or 0)
+        await fake_bot.answer_callback_query(update.callback_query.id)
+        await asyncio.sleep(args.slow_time if chat_id in slow_chats
+                            else args.handler_time)
+        redis.set(f'clicks:{chat_id}', clicks + 1)
+        latency = time.perf_counter() - received_at
+        latencies.append(latency)
+        if chat_id not in slow_chats:
+            fast_latencies.append(latency)
+
+    tasks = []
+
+    async def chat(chat_id):
+        for _ in range(args.bursts):
+            for _ in range(args.burst):
+                update = updates.callback(chat_id, 'tap')
+                tasks.append(asyncio.create_task(processor.process_update(
+                    update, handle(update, time.perf_counter()))))
+                await asyncio.sleep(args.tap_gap)
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+
+    started = time.perf_counter()
+    async with processor:
+        await asyncio.gather(*(chat(chat_id)
+                               for chat_id in range(1, args.chats + 1)))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    sent = args.bursts * args.burst
+    lost = sum(sent - int(redis.get(f'clicks:{chat_id}') or 0)
+               for chat_id in range(1, args.chats + 1))
+    result = {
+        'processor': name,
+        'updates': len(tasks),
+        'elapsed_s': elapsed,
+        'throughput_updates_per_s': len(tasks) / elapsed,
+        'latency': percentiles(latencies),
+        'fast_chats_latency': percentiles(fast_latencies),
+        'lost_updates': lost,
+    }
+    if isinstance(processor, ChatUpdateProcessor):
+        result['stats'] = processor.stats()
+    return result
+
+
+async def bench(args):
+    processors = (
+        ('sequential', SimpleUpdateProcessor(1)),
+        ('concurrent', SimpleUpdateProcessor(args.concurrency)),
+        ('per-chat', ChatUpdateProcessor(concurrency=args.concurrency)),
+    )
+    print(f'{args.chats} chats x {args.bursts} bursts of {args.burst} taps, '
+          f'handler {args.handler_time * 1000:.0f} ms, '
+          f'{args.slow_chats} slow chats {args.slow_time * 1000:.0f} ms, '
+          f'concurrency {args.concurrency}')
+    print(f'{"processor":>11} {"upd/s":>8} {"p50, ms":>9} {"p95, ms":>9} '
+          f'{"fast p95":>9} {"lost":>6}')
+    for name, processor in processors:
+        result = await run(args, name, processor)
+        print(f'{name:>11} {result["throughput_updates_per_s"]:>8.1f} '
+              f'{result["latency"]["p50_ms"]:>9.1f} '
+              f'{result["latency"]["p95_ms"]:>9.1f} '
+              f'{result["fast_chats_latency"]["p95_ms"]:>9.1f} '
+              f'{result["lost_updates"]:>6}')
+        if 'stats' in result:
+            stats = result['stats']
+            print(f'{"":>11} max queue depth {stats["max_queue_depth"]}, '
+                  f'max chat depth {stats["max_chat_depth"]}, '
+                  f'chat wait p95 {stats["chat_wait"]["p95_ms"]} ms, '
+                  f'limit wait p95 {stats["limit_wait"]["p95_ms"]} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--bursts', type=int, default=3)
+    parser.add_argument('--burst', type=int, default=2)
+    parser.add_argument('--tap-gap', type=float, default=0.02)
+    parser.add_argument('--think-time', type=float, default=0.5)
+    parser.add_argument('--handler-time', type=float, default=0.05)
+    parser.add_argument('--slow-chats', type=int, default=2)
+    parser.add_argument('--slow-time', type=float, default=1.0)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--redis-latency', type=float, default=0.0002)
+    parser.add_argument('--seed', type=int, default=1)
+    logging.getLogger('tg_bot').setLevel(logging.WARNING)
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
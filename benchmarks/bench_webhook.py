@@ -0,0 +1,182 @@
+"""
+Нагрузочный тест приема апдейтов через вебхук.
+
+Заглушка Telegram шлет апдейты POST-запросами на настоящий
+WebhookServer: каждый чат отправляет свои апдейты по одному, как это
+делает Telegram, а одновременно открыто не больше --connections
+запросов. Фронт раскладывает апдейты по шардам очереди в FakeRedis,
+воркеры UpdateWorker (по одному на шард) обрабатывают их. Обработка
+апдейта - вызов FakeBot и ожидание --handler-time с разбросом, чтобы
+апдейты одного чата завершались бы не по порядку, если бы воркер
+не упорядочивал их.
+
+Все воркеры работают в одном процессе, то есть это модель
+горизонтального масштабирования по вводу-выводу: в рабочем развертывании
+каждый воркер - отдельный процесс со своим ядром.
+
+Отчет для каждого числа шардов: пропускная способность, задержка
+ответа вебхука, задержка от отправки апдейта до конца его обработки,
+нарушения порядка внутри чатов и распределение по шардам.
+
+Запуск: python -m benchmarks.bench_webhook --shards 1 2 4
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from benchmarks.bench_e2e import percentiles
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.fake_telegram import FakeBot
+from tg_webhook import (SECRET_HEADER,
+                        UpdateQueue,
+                        UpdateWorker,
+                        WebhookServer)
+
+
+SECRET = 'bench-secret'
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Тест'},
+            'text': text,
+        },
+    }
+
+
+async def run(args, shards):
+    redis = FakeRedis(latency=args.redis_latency)
+    queue = UpdateQueue(redis, shards=shards)
+    server = WebhookServer(queue, secret_token=SECRET)
+    fake_bot = FakeBot(latency=args.telegram_latency)
+    rng = random.Random(args.seed)
+    sent_at = {}
+    processed = {}
+    latencies = []
+    handled_by_shard = [0] * shards
+
+    def handler(shard):
+        async def process(data):
+            chat_id = data['message']['chat']['id']
+            await fake_bot.send_message(chat_id=chat_id, text='ok')
+            await asyncio.sleep(args.handler_time * rng.uniform(0.2, 1.8))
+            processed.setdefault(chat_id, []).append(data['update_id'])
+            latencies.append(time.perf_counter()
+                             - sent_at[data['update_id']])
+            handled_by_shard[shard] += 1
+        return process
+
+    workers = [UpdateWorker(queue, shard, handler(shard),
+                            concurrency=args.worker_concurrency,
+                            poll_timeout=0.1)
+               for shard in range(shards)]
+    worker_tasks = [asyncio.create_task(worker.run()) for worker in workers]
+    await server.start('127.0.0.1', args.port)
+
+    url = f'http://127.0.0.1:{args.port}{server.path}'
+    connections = asyncio.Semaphore(args.connections)
+    update_ids = iter(range(1, args.chats * args.updates_per_chat + 1))
+    sent = {}
+    webhook_latencies = []
+    max_queue = 0
+
+    async def chat(session, chat_id):
+        nonlocal max_queue
+        for number in range(args.updates_per_chat):
+            update_id = next(update_ids)
+            update = make_update(update_id, chat_id, f'text {number}')
+            async with connections:
+                started = time.perf_counter()
+                sent_at[update_id] = started
+                async with session.post(url, json=update,
+                                        headers={SECRET_HEADER: SECRET}) as r:
+                    assert r.status == 200, r.status
+                webhook_latencies.append(time.perf_counter() - started)
+            sent.setdefault(chat_id, []).append(update_id)
+            max_queue = max(max_queue, max(queue.lengths()))
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+
+    total = args.chats * args.updates_per_chat
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(chat(session, chat_id)
+                               for chat_id in range(1, args.chats + 1)))
+    while len(latencies) < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for worker in workers:
+        worker.stop()
+    await asyncio.gather(*worker_tasks)
+    await server.stop()
+
+    violations = sum(processed.get(chat_id) != chat_updates
+                     for chat_id, chat_updates in sent.items())
+    return {
+        'shards': shards,
+        'updates': total,
+        'elapsed_s': elapsed,
+        'throughput_updates_per_s': total / elapsed,
+        'webhook': percentiles(webhook_latencies),
+        'end_to_end': percentiles(latencies),
+        'order_violations': violations,
+        'by_shard': handled_by_shard,
+        'max_queue_length': max_queue,
+        'workers': [worker.stats() for worker in workers],
+    }
+
+
+def print_result(result):
+    webhook = result['webhook']
+    end_to_end = result['end_to_end']
+    print(f'{result["shards"]:>6} '
+          f'{result["throughput_updates_per_s"]:>9.1f} '
+          f'{webhook["p50_ms"]:>9.1f} {webhook["p95_ms"]:>9.1f} '
+          f'{end_to_end["p50_ms"]:>9.1f} {end_to_end["p95_ms"]:>9.1f} '
+          f'{result["order_violations"]:>7} '
+          f'{result["max_queue_length"]:>7}  {result["by_shard"]}')
+
+
+async def bench(args):
+    print(f'{args.chats} chats x {args.updates_per_chat} updates, '
+          f'handler {args.handler_time * 1000:.0f} ms, '
+          f'worker concurrency {args.worker_concurrency}, '
+          f'webhook connections {args.connections}')
+    print(f'{"shards":>6} {"upd/s":>9} {"hook p50":>9} {"hook p95":>9} '
+          f'{"e2e p50":>9} {"e2e p95":>9} {"order":>7} {"queue":>7}  '
+          f'by shard')
+    for shards in args.shards:
+        print_result(await run(args, shards))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--updates-per-chat', type=int, default=10)
+    parser.add_argument('--connections', type=int, default=40,
+                        help='max_connections вебхука в Telegram')
+    parser.add_argument('--think-time', type=float, default=0.05)
+    parser.add_argument('--handler-time', type=float, default=0.2)
+    parser.add_argument('--worker-concurrency', type=int, default=16)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--redis-latency', type=float, default=0.0002)
+    parser.add_argument('--port', type=int, default=8795)
+    parser.add_argument('--seed', type=int, default=1)
+    # Журнал доступа aiohttp на каждый апдейт исказит замер.
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('tg_bot').setLevel(logging.WARNING)
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,662 @@
+"""
+Локальная замена OpenCart для нагрузочных тестов без сети.
+
+FakeOpenCart - это aiohttp-сервер с маршрутами index.php?route=api/...,
+которые вызывают opencart_api и opencart_api_async, и БД SQLite
+в памяти с таблицами oc_*, которые читает бот. Корзины и заказы
+хранятся в тех же таблицах, что и у OpenCart (oc_cart, oc_order,
+oc_order_product), поэтому HTTP-маршруты, DatabaseCart
+и get_order_content видят одни и те же данные.
+
+Поведение настраивается:
+    latency, jitter - задержка ответа: latency + random(0, jitter) сек.;
+    workers         - сколько запросов обслуживается одновременно
+                      (пул php-fpm), None - без ограничения;
+    error_rate      - доля ответов 500;
+    hang_rate       - доля запросов, которые "висят" hang секунд;
+    notice_rate     - доля ответов с PHP-уведомлением перед JSON
+                      ("<b>Notice</b>: ... <br />");
+    session_ttl     - сколько секунд живет простаивающая api-сессия;
+    query_time      - задержка каждого запроса к БД через connect();
+    query_observer  - query_observer(запрос, секунды) вызывается после
+                      каждого запроса к БД через connect().
+
+Боту БД подключается через install_database(): пул соединений для его
+реквизитов создается с connect=fake.connect, и OpenCartProducts,
+DatabaseCart, get_order_content и остальные запросы идут в SQLite.
+
+Запуск отдельного сервера: python -m benchmarks.fake_opencart --port 8080
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+
+from opencart_db import get_pool
+
+
+SCHEMA = '''
+CREATE TABLE oc_api (api_id INTEGER PRIMARY KEY, username TEXT,
+    `key` TEXT, status INTEGER);
+CREATE TABLE oc_api_session (api_session_id INTEGER PRIMARY KEY,
+    api_id INTEGER, session_id TEXT, ip TEXT, date_added TEXT,
+    date_modified TEXT);
+CREATE TABLE oc_product (product_id INTEGER PRIMARY KEY, model TEXT,
+    quantity INTEGER, image TEXT, shipping INTEGER, points INTEGER,
+    price REAL, status INTEGER, date_modified TEXT);
+CREATE TABLE oc_product_description (product_id INTEGER,
+    language_id INTEGER, name TEXT, description TEXT);
+CREATE TABLE oc_product_to_category (product_id INTEGER,
+    category_id INTEGER);
+CREATE TABLE oc_product_special (product_special_id INTEGER PRIMARY KEY,
+    product_id INTEGER, customer_group_id INTEGER, priority INTEGER,
+    price REAL, date_start TEXT, date_end TEXT);
+CREATE TABLE oc_cart (cart_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    api_id INTEGER, customer_id INTEGER, session_id TEXT,
+    product_id INTEGER, recurring_id INTEGER, `option` TEXT,
+    quantity INTEGER, date_added TEXT);
+CREATE INDEX cart_id ON oc_cart (api_id, customer_id, session_id,
+    product_id, recurring_id);
+CREATE TABLE oc_order (order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    firstname TEXT, lastname TEXT, email TEXT, telephone TEXT,
+    shipping_method TEXT, payment_method TEXT, total REAL,
+    order_status_id INTEGER, date_added TEXT);
+CREATE TABLE oc_order_product (order_product_id INTEGER PRIMARY KEY
+    AUTOINCREMENT, order_id INTEGER, product_id INTEGER, name TEXT,
+    model TEXT, quantity INTEGER, price REAL, total REAL);
+CREATE TABLE oc_order_history (order_history_id INTEGER PRIMARY KEY
+    AUTOINCREMENT, order_id INTEGER, order_status_id INTEGER,
+    comment TEXT, date_added TEXT);
+CREATE TABLE oc_location (location_id INTEGER PRIMARY KEY, name TEXT,
+    address TEXT, geocode TEXT);
+CREATE TABLE oc_customer_group_description (customer_group_id INTEGER,
+    language_id INTEGER, name TEXT);
+CREATE TABLE oc_customer (customer_id INTEGER PRIMARY KEY,
+    customer_group_id INTEGER, firstname TEXT, lastname TEXT,
+    telephone TEXT, custom_field TEXT, status INTEGER);
+'''
+
+# Тексты ответов OpenCart 3 (en-gb).
+ERROR_PERMISSION = 'Warning: You do not have permission to access the API!'
+SUCCESS_CART = 'Success: You have modified your shopping cart!'
+SUCCESS_ORDER = 'Success: You have modified orders!'
+NOTICE = ('<b>Notice</b>: Undefined index: {field} in '
+          '<b>/var/www/catalog/controller/api/{route}.php</b> '
+          'on line <b>{line}</b><br />\n')
+
+CATEGORY_PIZZA = 59
+# Пиццерии: название, адрес, координаты "широта,долгота".
+STORES = (
+    ('Пиццерия на Ленина', 'ул. Ленина, 1', '53.7100,91.6870'),
+    ('Пиццерия на Мира', 'ул. Мира, 50', '53.6950,91.7040'),
+    ('Пиццерия на Абаканской', 'ул. Абаканская, 12', '53.7230,91.6620'),
+)
+
+
+# Первая таблица запроса: по ней запросы группируются в статистике.
+TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+`?(\w+)', re.IGNORECASE)
+
+
+def query_name(query):
+    """Короткое имя запроса для статистики: "SELECT oc_product"."""
+    table = TABLE_RE.search(query)
+    verb = query.split(None, 1)[0].upper()
+    return f'{verb} {table.group(1)}' if table else verb
+
+
+def now():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SqliteCursor():
+    """Курсор SQLite с параметрами в стиле mysql.connector (%s)."""
+
+    def __init__(self, cursor, lock, query_time=0.0, observer=None):
+        self.cursor = cursor
+        self.lock = lock
+        self.query_time = query_time
+        self.observer = observer
+        self.rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        started = time.perf_counter()
+        if self.query_time:
+            time.sleep(self.query_time)
+        # Таблицы с общим кэшем блокируются целиком: запросы по одному,
+        # результат забираем сразу.
+        with self.lock:
+            self.cursor.execute(query.replace('%s', '?'), tuple(params))
+            self.rows = self.cursor.fetchall()
+            self.rowcount = self.cursor.rowcount
+            self.lastrowid = self.cursor.lastrowid
+        if self.observer is not None:
+            self.observer(query, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteConnection():
+    """Соединение с общей БД SQLite в памяти (замена mysql.connector)."""
+
+    def __init__(self, uri, lock, query_time=0.0, observer=None):
+        self.lock = lock
+        self.query_time = query_time
+        self.observer = observer
+        self.cnx = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   isolation_level=None)
+        self.cnx.create_function('NOW', 0, now)
+        # Функции MySQL, которых нет в SQLite.
+        self.cnx.create_function(
+            'CRC32', 1, lambda value: zlib.crc32(str(value).encode()))
+        self.cnx.create_function(
+            'CONCAT_WS', -1,
+            lambda sep, *values: sep.join(str(value) for value in values
+                                          if value is not None))
+
+    def cursor(self):
+        return SqliteCursor(self.cnx.cursor(), self.lock, self.query_time,
+                            self.observer)
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self.cnx.close()
+
+
+class FakeOpenCart():
+    """
+    Замена OpenCart: маршруты api/* и БД с таблицами oc_*.
+    """
+
+    _names = itertools.count(1)
+
+    def __init__(self, latency=0.0, jitter=0.0, workers=None, error_rate=0.0,
+                 hang_rate=0.0, hang=30.0, notice_rate=0.0,
+                 session_ttl=3600, query_time=0.0, query_observer=None,
+                 api_username='bot', api_key='key', seed=None):
+        """Инициализировать атрибуты данных."""
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.notice_rate = notice_rate
+        self.session_ttl = session_ttl
+        self.query_time = query_time
+        self.query_observer = query_observer
+        self.api_username = api_username
+        self.api_key = api_key
+        self.random = random.Random(seed)
+        self._workers_limit = workers
+        self._workers = None
+        self.uri = (f'file:fake_opencart_{next(self._names)}'
+                    '?mode=memory&cache=shared')
+        self.lock = threading.Lock()
+        # Пока открыто это соединение, БД в памяти существует.
+        self.db = SqliteConnection(self.uri, self.lock)
+        self.db.cnx.executescript(SCHEMA)
+        self.db.cnx.execute(
+            'INSERT INTO oc_api (api_id, username, `key`, status) '
+            'VALUES (1, ?, ?, 1)', (api_username, api_key))
+        # Данные api-сессий: {api_token: {...}}.
+        self.sessions = {}
+        self.runner = None
+        self.routes = {
+            'api/login': self.login,
+            'api/cart/add': self.cart_add,
+            'api/cart/edit': self.cart_edit,
+            'api/cart/remove': self.cart_remove,
+            'api/cart/products': self.cart_products,
+            'api/customer': self.customer,
+            'api/shipping/address': self.shipping_address,
+            'api/shipping/methods': self.shipping_methods,
+            'api/shipping/method': self.shipping_method,
+            'api/payment/address': self.payment_address,
+            'api/payment/methods': self.payment_methods,
+            'api/payment/method': self.payment_method,
+            'api/order/add': self.order_add,
+            'api/order/edit': self.order_edit,
+            'api/order/delete': self.order_delete,
+            'api/order/info': self.order_info,
+            'api/order/history': self.order_history,
+        }
+        self.requests = {}
+        self.injected = {'errors': 0, 'hangs': 0, 'notices': 0}
+
+    # БД
+
+    def connect(self):
+        """Новое соединение с БД магазина (для ConnectionPool)."""
+        return SqliteConnection(self.uri, self.lock, self.query_time,
+                                self.query_observer)
+
+    def install_database(self, user, host, database, **kwargs):
+        """Направить общий пул соединений бота с этой БД в SQLite.
+
+        Вызывать до первого get_pool для тех же реквизитов.
+        """
+        return get_pool(user, None, host, database, connect=self.connect,
+                        **kwargs)
+
+    def execute(self, query, params=()):
+        """Выполнить запрос к БД магазина. Строки уже забраны в курсор."""
+        cursor = self.db.cursor()
+        cursor.execute(query, params)
+        cursor.close()
+        return cursor
+
+    def query(self, query, params=()):
+        """Выполнить запрос к БД магазина и вернуть строки."""
+        return self.execute(query, params).fetchall()
+
+    def seed(self, products=20, stores=STORES, couriers_per_store=2):
+        """Заполнить каталог, пиццерии и доставщиков."""
+        for product_id in range(1, products + 1):
+            self.query(
+                'INSERT INTO oc_product (product_id, model, quantity, image, '
+                'shipping, points, price, status, date_modified) '
+                'VALUES (%s, %s, 100, %s, 1, 0, %s, 1, %s)',
+                (product_id, f'PIZZA-{product_id}',
+                 f'catalog/pizza/{product_id}.jpg',
+                 300 + 10 * product_id, now()))
+            self.query(
+                'INSERT INTO oc_product_description VALUES (%s, 1, %s, %s)',
+                (product_id, f'Пицца {product_id}',
+                 f'Описание пиццы {product_id}'))
+            self.query('INSERT INTO oc_product_to_category VALUES (%s, %s)',
+                       (product_id, CATEGORY_PIZZA))
+
+        courier_ids = itertools.count(100000001)
+        for group_id, (name, address, geocode) in enumerate(stores, 1):
+            self.query('INSERT INTO oc_location VALUES (%s, %s, %s, %s)',
+                       (group_id, name, address, geocode))
+            self.query('INSERT INTO oc_customer_group_description '
+                       'VALUES (%s, 1, %s)', (group_id, name))
+            for _ in range(couriers_per_store):
+                telegram_id = next(courier_ids)
+                self.query(
+                    'INSERT INTO oc_customer (customer_group_id, firstname, '
+                    'lastname, telephone, custom_field, status) '
+                    'VALUES (%s, %s, %s, %s, %s, 1)',
+                    (group_id, 'Курьер', str(telegram_id), '+79000000000',
+                     # json_encode в PHP пишет без пробелов.
+                     json.dumps({'1': str(telegram_id)},
+                                separators=(',', ':'))))
+
+    # HTTP
+
+    def app(self):
+        """aiohttp-приложение с index.php."""
+        app = web.Application()
+        app.router.add_route('*', '/index.php', self.handle)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """Запустить сервер. Возвращает адрес для WEBSITE."""
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f'{host}:{port}'
+
+    async def stop(self):
+        """Остановить сервер."""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def close(self):
+        """Закрыть БД в памяти (после этого она исчезнет)."""
+        self.db.close()
+
+    async def handle(self, request):
+        route = request.query.get('route', '')
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if self._workers is None and self._workers_limit:
+            self._workers = asyncio.Semaphore(self._workers_limit)
+        if self._workers is not None:
+            await self._workers.acquire()
+        try:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if self.hang_rate and self.random.random() < self.hang_rate:
+                self.injected['hangs'] += 1
+                delay = self.hang
+            if delay:
+                await asyncio.sleep(delay)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.injected['errors'] += 1
+                return web.Response(status=500,
+                                    text='<b>Fatal error</b>')
+
+            handler = self.routes.get(route)
+            if handler is None:
+                return web.Response(status=404)
+            data = dict(await request.post())
+            params = dict(request.query)
+            if route == 'api/login':
+                result = handler(params, data)
+            else:
+                session = self._session(params.get('api_token'))
+                if session is None:
+                    result = {'error': {'warning': ERROR_PERMISSION}}
+                else:
+                    result = handler(session, params, data)
+            return self._response(route, result)
+        finally:
+            if self._workers is not None:
+                self._workers.release()
+
+    def _response(self, route, result):
+        body = json.dumps(result, ensure_ascii=False)
+        if self.notice_rate and self.random.random() < self.notice_rate:
+            self.injected['notices'] += 1
+            body = NOTICE.format(field='firstname',
+                                 route=route.split('/')[1],
+                                 line=self.random.randint(10, 200)) + body
+        # OpenCart отдает JSON с Content-Type text/html, если перед ним
+        # успело напечататься уведомление.
+        return web.Response(text=body, content_type='text/html')
+
+    def _session(self, api_token):
+        session = self.sessions.get(api_token)
+        if session is None:
+            return None
+        if time.monotonic() - session['last_used'] > self.session_ttl:
+            del self.sessions[api_token]
+            return None
+        session['last_used'] = time.monotonic()
+        return session
+
+    def stats(self):
+        """Число запросов по маршрутам и внесенные сбои."""
+        return {'requests': dict(self.requests), **self.injected}
+
+    # Маршруты
+
+    def login(self, params, data):
+        if (data.get('username') != self.api_username
+                or data.get('key') != self.api_key):
+            return {'error': {'key': 'Warning: Incorrect API Key!'}}
+        api_token = uuid.uuid4().hex[:26]
+        self.sessions[api_token] = {'api_token': api_token,
+                                    'last_used': time.monotonic()}
+        self.query('INSERT INTO oc_api_session (api_id, session_id, ip, '
+                   'date_added, date_modified) '
+                   "VALUES (1, %s, '127.0.0.1', %s, %s)",
+                   (api_token, now(), now()))
+        return {'success': 'Success: API session successfully started!',
+                'api_token': api_token}
+
+    @staticmethod
+    def _forget_methods(session):
+        # Как в OpenCart: изменение корзины сбрасывает методы.
+        for key in ('shipping_method', 'shipping_methods',
+                    'payment_method', 'payment_methods'):
+            session.pop(key, None)
+
+    def _cart_rows(self, api_token):
+        return self.query(
+            'SELECT c.cart_id, c.product_id, c.quantity, pd.name, p.model, '
+            'p.price FROM oc_cart as c '
+            'JOIN oc_product as p on p.product_id = c.product_id '
+            'left JOIN oc_product_description as pd '
+            'on pd.product_id = p.product_id '
+            'WHERE c.api_id = 1 AND c.customer_id = 0 AND c.session_id = %s '
+            'ORDER BY c.cart_id', (api_token,))
+
+    def cart_add(self, session, params, data):
+        api_token = session['api_token']
+        product_id = int(data.get('product_id', 0))
+        quantity = int(data.get('quantity', 1))
+        if not self.query('SELECT 1 FROM oc_product '
+                          'WHERE product_id = %s AND status = 1',
+                          (product_id,)):
+            return {'error': {'store': 'Warning: Product not found!'}}
+        updated = self.execute(
+            'UPDATE oc_cart SET quantity = quantity + %s '
+            'WHERE api_id = 1 AND customer_id = 0 AND session_id = %s '
+            "AND product_id = %s AND recurring_id = 0 AND `option` = '[]'",
+            (quantity, api_token, product_id)).rowcount
+        if not updated:
+            self.query(
+                'INSERT INTO oc_cart (api_id, customer_id, session_id, '
+                'product_id, recurring_id, `option`, quantity, date_added) '
+                "VALUES (1, 0, %s, %s, 0, '[]', %s, %s)",
+                (api_token, product_id, quantity, now()))
+        self._forget_methods(session)
+        return {'success': SUCCESS_CART}
+
+    def cart_edit(self, session, params, data):
+        self.query('UPDATE oc_cart SET quantity = %s WHERE cart_id = %s '
+                   'AND session_id = %s',
+                   (int(data['quantity']), int(data['key']),
+                    session['api_token']))
+        self._forget_methods(session)
+        return {'success': SUCCESS_CART}
+
+    def cart_remove(self, session, params, data):
+        self.query('DELETE FROM oc_cart WHERE cart_id = %s '
+                   'AND session_id = %s',
+                   (int(data['key']), session['api_token']))
+        self._forget_methods(session)
+        return {'success': SUCCESS_CART}
+
+    def cart_products(self, session, params, data):
+        products = []
+        sub_total = 0
+        for (cart_id, product_id, quantity, name, model,
+                price) in self._cart_rows(session['api_token']):
+            total = price * quantity
+            sub_total += total
+            products.append({
+                'cart_id': str(cart_id),
+                'product_id': str(product_id),
+                'name': name,
+                'model': model,
+                'option': [],
+                'quantity': str(quantity),
+                'stock': True,
+                'shipping': '1',
+                'price': f'{price:.2f}р.',
+                'total': f'{total:.2f}р.',
+                'reward': 0,
+            })
+        return {
+            'products': products,
+            'vouchers': [],
+            'totals': [
+                {'title': 'Сумма', 'text': f'{sub_total:.2f}р.'},
+                {'title': 'Итого', 'text': f'{sub_total:.2f}р.'},
+            ],
+        }
+
+    def customer(self, session, params, data):
+        session['customer'] = data
+        return {'success': 'Success: You have modified customers!'}
+
+    def shipping_address(self, session, params, data):
+        session['shipping_address'] = data
+        session.pop('shipping_method', None)
+        session.pop('shipping_methods', None)
+        return {'success': 'Success: Shipping address has been set!'}
+
+    def shipping_methods(self, session, params, data):
+        if 'shipping_address' not in session:
+            return {'error': 'Warning: Shipping address required!'}
+        methods = {'pickup': {'title': 'Самовывоз', 'quote': {'pickup': {
+            'code': 'pickup.pickup', 'title': 'Самовывоз', 'cost': 0}}}}
+        session['shipping_methods'] = methods
+        return {'shipping_methods': methods}
+
+    def shipping_method(self, session, params, data):
+        code = data.get('shipping_method', '')
+        if 'shipping_methods' not in session:
+            return {'error': 'Warning: Shipping method required!'}
+        if code.split('.')[0] not in session['shipping_methods']:
+            return {'error': 'Warning: Shipping method required!'}
+        session['shipping_method'] = code
+        return {'success': 'Success: Shipping method has been set!'}
+
+    def payment_address(self, session, params, data):
+        session['payment_address'] = data
+        session.pop('payment_method', None)
+        session.pop('payment_methods', None)
+        return {'success': 'Success: Payment address has been set!'}
+
+    def payment_methods(self, session, params, data):
+        if 'payment_address' not in session:
+            return {'error': 'Warning: Payment address required!'}
+        methods = {'cod': {'code': 'cod', 'title': 'Оплата при доставке'}}
+        session['payment_methods'] = methods
+        return {'payment_methods': methods}
+
+    def payment_method(self, session, params, data):
+        code = data.get('payment_method', '')
+        if code not in session.get('payment_methods', {}):
+            return {'error': 'Warning: Payment method required!'}
+        session['payment_method'] = code
+        return {'success': 'Success: Payment method has been set!'}
+
+    def order_add(self, session, params, data):
+        api_token = session['api_token']
+        rows = self._cart_rows(api_token)
+        for key, error in (('customer', 'Warning: Customer details required!'),
+                           ('payment_address',
+                            'Warning: Payment address required!'),
+                           ('payment_method',
+                            'Warning: Payment method required!'),
+                           ('shipping_method',
+                            'Warning: Shipping method required!')):
+            if key not in session:
+                return {'error': error}
+        if not rows:
+            return {'error': 'Warning: Cart is empty!'}
+
+        customer = session['customer']
+        total = sum(price * quantity
+                    for _, _, quantity, _, _, price in rows)
+        order_id = self.execute(
+            'INSERT INTO oc_order (firstname, lastname, email, telephone, '
+            'shipping_method, payment_method, total, order_status_id, '
+            'date_added) VALUES (%s, %s, %s, %s, %s, %s, %s, 1, %s)',
+            (customer.get('firstname'), customer.get('lastname'),
+             customer.get('email'), customer.get('telephone'),
+             session['shipping_method'], session['payment_method'],
+             total, now())).lastrowid
+        for _, product_id, quantity, name, model, price in rows:
+            self.query(
+                'INSERT INTO oc_order_product (order_id, product_id, name, '
+                'model, quantity, price, total) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s)',
+                (order_id, product_id, name, model, quantity, price,
+                 price * quantity))
+        self.query('DELETE FROM oc_cart WHERE session_id = %s', (api_token,))
+        self._forget_methods(session)
+        return {'success': SUCCESS_ORDER, 'order_id': order_id}
+
+    def _order(self, order_id):
+        rows = self.query('SELECT order_id, firstname, lastname, email, '
+                          'telephone, total, order_status_id '
+                          'FROM oc_order WHERE order_id = %s',
+                          (int(order_id),))
+        if not rows:
+            return None
+        keys = ('order_id', 'firstname', 'lastname', 'email', 'telephone',
+                'total', 'order_status_id')
+        order = dict(zip(keys, rows[0]))
+        order['total'] = f'{order["total"]:.4f}'
+        order['products'] = [
+            {'product_id': product_id, 'name': name, 'quantity': quantity}
+            for product_id, name, quantity in self.query(
+                'SELECT product_id, name, quantity FROM oc_order_product '
+                'WHERE order_id = %s', (int(order_id),))]
+        return order
+
+    def order_edit(self, session, params, data):
+        if self._order(params.get('order_id', 0)) is None:
+            return {'error': 'Warning: Order could not be found!'}
+        return {'success': SUCCESS_ORDER}
+
+    def order_delete(self, session, params, data):
+        order_id = int(params.get('order_id', 0))
+        if self._order(order_id) is None:
+            return {'error': 'Warning: Order could not be found!'}
+        self.query('DELETE FROM oc_order_product WHERE order_id = %s',
+                   (order_id,))
+        self.query('DELETE FROM oc_order WHERE order_id = %s', (order_id,))
+        return {'success': SUCCESS_ORDER}
+
+    def order_info(self, session, params, data):
+        order = self._order(params.get('order_id', 0))
+        if order is None:
+            return {'error': 'Warning: Order could not be found!'}
+        return {'order': order}
+
+    def order_history(self, session, params, data):
+        order_id = int(params.get('order_id', 0))
+        if self._order(order_id) is None:
+            return {'error': 'Warning: Order could not be found!'}
+        status = int(data.get('order_status_id', 1))
+        self.query('INSERT INTO oc_order_history (order_id, '
+                   'order_status_id, comment, date_added) '
+                   'VALUES (%s, %s, %s, %s)',
+                   (order_id, status, data.get('comment', ''), now()))
+        return {'success': SUCCESS_ORDER}
+
+
+async def serve(args):
+    fake = FakeOpenCart(latency=args.latency, jitter=args.jitter,
+                        workers=args.workers, error_rate=args.error_rate,
+                        notice_rate=args.notice_rate, seed=args.seed)
+    fake.seed(products=args.products)
+    website = await fake.start(args.host, args.port)
+    print(f'Fake OpenCart: http://{website}/index.php, '
+          f'api user {fake.api_username!r}, key {fake.api_key!r}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+        fake.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.03)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--notice-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+Redis в памяти процесса для нагрузочных тестов.
+
+Поддерживает команды, которыми пользуется бот, и ведет себя как
+redis.Redis(decode_responses=True): значения хранятся и возвращаются
+строками. Каждая команда может стоить latency секунд (сетевая задержка
+до настоящего Redis), число вызовов каждой команды - в commands.
+"""
+import time
+
+
+class FakeRedis():
+    """Замена redis.Redis с decode_responses=True."""
+
+    def __init__(self, latency=0.0):
+        """Инициализировать атрибуты данных."""
+        self.latency = latency
+        self.data = {}
+        self.expires = {}
+        self.commands = {}
+
+    def _command(self, name):
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, name):
+        deadline = self.expires.get(name)
+        if deadline is not None and time.monotonic() >= deadline:
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return self.data.get(name)
+
+    def _hash(self, name):
+        value = self._get(name)
+        if value is None:
+            value = self.data[name] = {}
+        return value
+
+    @staticmethod
+    def _str(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return str(value)
+
+    # Строки
+
+    def get(self, name):
+        self._command('get')
+        return self._get(self._str(name))
+
+    def set(self, name, value, ex=None, nx=False):
+        self._command('set')
+        name = self._str(name)
+        if nx and self._get(name) is not None:
+            return None
+        self.data[name] = self._str(value)
+        self.expires.pop(name, None)
+        if ex is not None:
+            self.expires[name] = time.monotonic() + ex
+        return True
+
+    def setex(self, name, time, value):
+        return self.set(name, value, ex=time)
+
+    def mget(self, keys, *args):
+        self._command('mget')
+        if isinstance(keys, (str, bytes, int)):
+            keys = [keys, *args]
+        return [self._get(self._str(key)) for key in keys]
+
+    def incr(self, name, amount=1):
+        self._command('incr')
+        name = self._str(name)
+        value = int(self._get(name) or 0) + amount
+        self.data[name] = str(value)
+        return value
+
+    # Хэши
+
+    def hget(self, name, key):
+        self._command('hget')
+        return (self._get(self._str(name)) or {}).get(self._str(key))
+
+    def hgetall(self, name):
+        self._command('hgetall')
+        return dict(self._get(self._str(name)) or {})
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        self._command('hset')
+        value_hash = self._hash(self._str(name))
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        added = 0
+        for item_key, item_value in items.items():
+            item_key = self._str(item_key)
+            added += item_key not in value_hash
+            value_hash[item_key] = self._str(item_value)
+        return added
+
+    def hincrby(self, name, key, amount=1):
+        self._command('hincrby')
+        value_hash = self._hash(self._str(name))
+        key = self._str(key)
+        value = int(value_hash.get(key, 0)) + amount
+        value_hash[key] = str(value)
+        return value
+
+    def hdel(self, name, *keys):
+        self._command('hdel')
+        value_hash = self._get(self._str(name)) or {}
+        return sum(value_hash.pop(self._str(key), None) is not None
+                   for key in keys)
+
+    # Списки
+
+    def rpush(self, name, *values):
+        self._command('rpush')
+        name = self._str(name)
+        value_list = self._get(name)
+        if value_list is None:
+            value_list = self.data[name] = []
+        value_list.extend(self._str(value) for value in values)
+        return len(value_list)
+
+    def lpop(self, name):
+        self._command('lpop')
+        value_list = self._get(self._str(name))
+        return value_list.pop(0) if value_list else None
+
+    def lrange(self, name, start, end):
+        self._command('lrange')
+        value_list = self._get(self._str(name)) or []
+        end = len(value_list) if end == -1 else end + 1
+        return value_list[start:end]
+
+    def blpop(self, keys, timeout=0):
+        """Как BLPOP: ждет элемент в опросе, вызывать из потока."""
+        self._command('blpop')
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            for key in map(self._str, keys):
+                value_list = self._get(key)
+                if value_list:
+                    return key, value_list.pop(0)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(0.0005)
+
+    def llen(self, name):
+        self._command('llen')
+        return len(self._get(self._str(name)) or [])
+
+    # Упорядоченные множества
+
+    def zadd(self, name, mapping):
+        self._command('zadd')
+        zset = self._hash(self._str(name))
+        added = 0
+        for member, score in mapping.items():
+            member = self._str(member)
+            added += member not in zset
+            zset[member] = float(score)
+        return added
+
+    def zcard(self, name):
+        self._command('zcard')
+        return len(self._get(self._str(name)) or {})
+
+    def zpopmin(self, name, count=1):
+        self._command('zpopmin')
+        zset = self._get(self._str(name)) or {}
+        popped = sorted(zset.items(), key=lambda item: item[1])[:count]
+        for member, _ in popped:
+            del zset[member]
+        return popped
+
+    def zremrangebyscore(self, name, min, max):
+        self._command('zremrangebyscore')
+        zset = self._get(self._str(name)) or {}
+        low, high = float(min), float(max)
+        removed = [member for member, score in zset.items()
+                   if low <= score <= high]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    # Ключи
+
+    def delete(self, *names):
+        self._command('delete')
+        deleted = 0
+        for name in map(self._str, names):
+            deleted += self._get(name) is not None
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return deleted
+
+    def exists(self, *names):
+        self._command('exists')
+        return sum(self._get(self._str(name)) is not None for name in names)
+
+    def expire(self, name, time_):
+        self._command('expire')
+        name = self._str(name)
+        if self._get(name) is None:
+            return False
+        self.expires[name] = time.monotonic() + time_
+        return True
+
+    def ping(self):
+        self._command('ping')
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline():
+    """Конвейер команд: выполняет их по execute() за один "запрос"."""
+
+    def __init__(self, redis):
+        """Инициализировать атрибуты данных."""
+        self.redis = redis
+        self.queue = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queue = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.queue.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        queue, self.queue = self.queue, []
+        # Весь конвейер - одна сетевая задержка.
+        self.redis._command('pipeline')
+        latency, self.redis.latency = self.redis.latency, 0.0
+        try:
+            return [command(*args, **kwargs)
+                    for command, args, kwargs in queue]
+        finally:
+            self.redis.latency = latency
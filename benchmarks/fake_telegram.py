@@ -0,0 +1,175 @@
+"""
+Заглушка Telegram Bot API и фабрика апдейтов для нагрузочных тестов.
+
+FakeBot принимает любой метод Bot API, ждет latency секунд, считает
+вызовы и их время по методам и запоминает последнюю inline-клавиатуру
+каждого чата, чтобы "пользователь" мог нажимать кнопки, которые бот
+ему действительно показал. Фото, отправленное по URL, Telegram
+скачивает с сайта - это еще download_latency секунд; в ответ
+возвращается file_id, отправка по которому скачивания не требует. Апдейты создаются настоящими объектами
+telegram.Update, поэтому обработчики бота работают с ними без
+изменений.
+"""
+import asyncio
+import contextvars
+import datetime
+import itertools
+import time
+
+from telegram import (Chat, InlineKeyboardMarkup, Message, PhotoSize,
+                      Update)
+
+
+UTC = datetime.timezone.utc
+# Счетчик вызовов апдейта, который обрабатывается в текущей задаче.
+_update_calls = contextvars.ContextVar('fake_bot_update_calls')
+
+
+class FakeBot():
+    """Заглушка telegram.Bot."""
+
+    # Update.de_json читает часовой пояс из настроек бота.
+    defaults = None
+
+    def __init__(self, latency=0.0, download_latency=0.0):
+        """Инициализировать атрибуты данных."""
+        self.latency = latency
+        self.download_latency = download_latency
+        self.downloads = 0
+        self.calls = {}
+        self.latencies = {}
+        self.keyboards = {}
+        self.last_message_ids = {}
+        self.message_kinds = {}
+        # Сколько геопозиций получил каждый чат (доставщики).
+        self.locations = {}
+        self._message_ids = itertools.count(1)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            return await self._call(method, kwargs)
+        call.__name__ = method
+        return call
+
+    async def _call(self, method, kwargs):
+        started = time.perf_counter()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        update_calls = _update_calls.get(None)
+        if update_calls is not None:
+            update_calls[0] += 1
+        photo = kwargs.get('photo')
+        if 'media' in kwargs:
+            photo = kwargs['media'].media
+        if isinstance(photo, str) and photo.startswith('http'):
+            self.downloads += 1
+            delay = self.latency + self.download_latency
+        else:
+            delay = self.latency
+        if delay:
+            await asyncio.sleep(delay)
+
+        chat_id = kwargs.get('chat_id')
+        if method == 'send_location':
+            self.locations[chat_id] = self.locations.get(chat_id, 0) + 1
+        result = True
+        if method.startswith(('send_', 'edit_message_')):
+            markup = kwargs.get('reply_markup')
+            if isinstance(markup, InlineKeyboardMarkup):
+                # Telegram возвращает callback_data всегда строкой.
+                self.keyboards[chat_id] = [
+                    (button.text, str(button.callback_data))
+                    for row in markup.inline_keyboard for button in row]
+            if method in ('send_photo', 'edit_message_media'):
+                self.message_kinds[chat_id] = 'photo'
+            elif method in ('send_message', 'edit_message_text'):
+                self.message_kinds[chat_id] = 'text'
+            if method.startswith('send_'):
+                message_id = next(self._message_ids)
+                self.last_message_ids[chat_id] = message_id
+            else:
+                message_id = kwargs.get('message_id')
+            photo_sizes = None
+            if photo is not None:
+                file_id = (f'file-{abs(hash(photo))}'
+                           if photo.startswith('http') else photo)
+                photo_sizes = (PhotoSize(file_id, file_id, 512, 512),)
+            result = Message(message_id=message_id,
+                             date=datetime.datetime.now(UTC),
+                             chat=Chat(chat_id, Chat.PRIVATE),
+                             photo=photo_sizes)
+        self.latencies.setdefault(method, []).append(
+            time.perf_counter() - started)
+        return result
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    async def count_calls(self, coro):
+        """Выполнить coro и вернуть число вызовов Bot API из нее."""
+        update_calls = [0]
+        token = _update_calls.set(update_calls)
+        try:
+            await coro
+        finally:
+            _update_calls.reset(token)
+        return update_calls[0]
+
+
+class UpdateFactory():
+    """Создает апдейты от имени пользователей."""
+
+    def __init__(self, bot):
+        """Инициализировать атрибуты данных."""
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._ids = itertools.count(1)
+
+    def _user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': 'Тест',
+                'last_name': str(chat_id)}
+
+    def _message(self, chat_id, **fields):
+        return {'message_id': next(self._ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': self._user(chat_id),
+                **fields}
+
+    def _update(self, **fields):
+        return Update.de_json({'update_id': next(self._update_ids),
+                               **fields}, self.bot)
+
+    def text(self, chat_id, text):
+        """Текстовое сообщение (или команда, если text начинается с /)."""
+        fields = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                   'length': len(text.split()[0])}]
+        return self._update(message=self._message(chat_id, **fields))
+
+    def location(self, chat_id, latitude, longitude):
+        """Сообщение с геопозицией."""
+        return self._update(message=self._message(
+            chat_id, location={'latitude': latitude,
+                               'longitude': longitude}))
+
+    def callback(self, chat_id, data):
+        """Нажатие inline-кнопки в последнем сообщении бота."""
+        if self.bot.message_kinds.get(chat_id) == 'photo':
+            message = self._message(chat_id, caption='...', photo=[{
+                'file_id': 'photo', 'file_unique_id': 'photo',
+                'width': 512, 'height': 512}])
+        else:
+            message = self._message(chat_id, text='...')
+        message['message_id'] = self.bot.last_message_ids.get(chat_id, 1)
+        message['from'] = {'id': 1, 'is_bot': True, 'first_name': 'Бот'}
+        return self._update(callback_query={
+            'id': str(next(self._ids)),
+            'from': self._user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': message,
+        })
@@ -0,0 +1,308 @@
+"""
+Пакетная раздача заказов доставщикам.
+
+Заказы на доставку не отправляются доставщику сразу, а копятся
+в Redis. Раз в окно раздачи Dispatcher забирает все накопившиеся
+заказы, делит их по пиццериям и собирает из близких друг к другу
+заказов маршруты. Маршрут достается наименее загруженному доставщику
+пиццерии, и тот получает одно сообщение со всеми адресами и ссылкой
+на маршрут в Яндекс Картах.
+
+Расстояния между пиццерией и всеми ее заказами считаются одной
+матрицей numpy. Маршрут строится от пиццерии, каждый раз к ближайшему
+из оставшихся адресов. Заказы, которые не поместились ни одному
+доставщику, ждут следующего окна.
+
+Заказ, который не удалось раздать max_attempts раз подряд (у пиццерии
+нет доставщиков или координат, сообщение доставщику не уходит),
+перестает ждать: он перекладывается в dispatch:dead, а оператору
+отправляется сообщение.
+
+Ключи:
+    dispatch:orders - список ждущих заказов (JSON).
+    dispatch:dead - заказы, которые так и не удалось раздать (JSON).
+"""
+import json
+import logging
+import time
+
+import numpy as np
+
+from telegram.error import TelegramError
+
+from opencart_db import run_in_db_executor
+from opencart_stores import EARTH_RADIUS_KM
+from opencart_transport import LatencyHistogram
+
+
+logger = logging.getLogger('tg_bot.dispatch')
+
+# Границы корзин гистограммы ожидания раздачи, мс.
+DISPATCH_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000,
+                    120000, 300000, 600000)
+ROUTE_URL = 'https://yandex.ru/maps/?rtext={points}&rtt=auto'
+
+
+def distance_matrix(points):
+    """Попарные расстояния между точками [(широта, долгота), ...], км."""
+    radians = np.radians(np.asarray(points, dtype=np.float64)
+                         .reshape(-1, 2))
+    lat = radians[:, :1]
+    lon = radians[:, 1:]
+    haversine = (np.sin((lat - lat.T) / 2) ** 2
+                 + np.cos(lat) * np.cos(lat.T)
+                 * np.sin((lon - lon.T) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+def order_route(matrix, stops):
+    """
+    Порядок объезда stops (номера строк matrix) из пиццерии - строки 0.
+
+    Возвращает порядок и длину пути с возвращением в пиццерию, км.
+    """
+    route = []
+    left = list(stops)
+    current = 0
+    length = 0.0
+    while left:
+        distances = matrix[current, left]
+        nearest = int(np.argmin(distances))
+        length += float(distances[nearest])
+        current = left.pop(nearest)
+        route.append(current)
+    return route, length + float(matrix[current, 0])
+
+
+def format_route(route):
+    """Текст сообщения доставщику с адресами маршрута."""
+    lines = [f'Заказов в маршруте: {len(route["orders"])}, '
+             f'примерно {route["length"]:.1f} км.']
+    for number, order in enumerate(route['orders'], 1):
+        lines.append(f'\n{number}. Заказ № {order["order_id"]}\n'
+                     f'{order["text"]}')
+    points = [route['start']] + [(order['lat'], order['lon'])
+                                 for order in route['orders']]
+    lines.append('\nМаршрут: ' + ROUTE_URL.format(
+        points='~'.join(f'{lat},{lon}' for lat, lon in points)))
+    return '\n'.join(lines)
+
+
+class Dispatcher():
+    """
+    Раздача заказов пакетами.
+
+    directory - CourierDirectory, stores - StoreIndex. max_stops -
+    сколько заказов может получить доставщик за одну раздачу,
+    radius_km - насколько далеко от первого заказа маршрута могут быть
+    остальные. max_attempts - после скольких неудачных раздач заказ
+    считается нераздаваемым, alert_chat_id - чат оператора, куда
+    сообщать о таких заказах.
+    """
+
+    key = 'dispatch:orders'
+    dead_key = 'dispatch:dead'
+
+    def __init__(self, db, directory, stores, max_stops=5, radius_km=3.0,
+                 max_attempts=10, alert_chat_id=None):
+        """Инициализировать атрибуты данных."""
+        self.db = db
+        self.directory = directory
+        self.stores = stores
+        self.max_stops = max_stops
+        self.radius_km = radius_km
+        self.max_attempts = max_attempts
+        self.alert_chat_id = alert_chat_id
+        self._metrics = {
+            'orders': 0,
+            'routes': 0,
+            'deferred': 0,
+            'send_errors': 0,
+            'dead': 0,
+            'route_km': 0.0,
+            'direct_km': 0.0,
+            'max_route_km': 0.0,
+            'max_stops': 0,
+        }
+        self.assignment = LatencyHistogram(DISPATCH_BUCKETS)
+
+    def add(self, order_id, chat_id, store, latitude, longitude, text):
+        """Поставить заказ в очередь на раздачу."""
+        self.db.rpush(self.key, json.dumps({
+            'order_id': order_id,
+            'chat_id': chat_id,
+            'store': store,
+            'lat': float(latitude),
+            'lon': float(longitude),
+            'text': text,
+            'created_at': time.time(),
+            'attempts': 0,
+        }, ensure_ascii=False))
+
+    def take(self):
+        """Забрать все ждущие заказы."""
+        # В транзакции, чтобы заказ не достался двум процессам бота.
+        with self.db.pipeline() as pipe:
+            pipe.lrange(self.key, 0, -1)
+            pipe.delete(self.key)
+            orders = pipe.execute()[0]
+        return [json.loads(order) for order in orders]
+
+    def _requeue(self, orders):
+        """Вернуть заказы в очередь. Возвращает исчерпавшие попытки."""
+        queued = []
+        dead = []
+        for order in orders:
+            order['attempts'] = order.get('attempts', 0) + 1
+            if order['attempts'] >= self.max_attempts:
+                dead.append(order)
+            else:
+                queued.append(order)
+        if queued:
+            self.db.rpush(self.key, *(json.dumps(order, ensure_ascii=False)
+                                      for order in queued))
+        if dead:
+            self.db.rpush(self.dead_key, *(json.dumps(order,
+                                                      ensure_ascii=False)
+                                           for order in dead))
+        return dead
+
+    async def _alert(self, bot, dead):
+        self._metrics['dead'] += len(dead)
+        order_ids = ', '.join(str(order['order_id']) for order in dead)
+        logger.error(f'Не удалось раздать заказы: {order_ids}')
+        if not self.alert_chat_id:
+            return
+        try:
+            await bot.send_message(
+                chat_id=self.alert_chat_id,
+                text=f'Заказы не розданы доставщикам после '
+                     f'{self.max_attempts} попыток, нужна ручная '
+                     f'доставка: {order_ids}')
+        except TelegramError as err:
+            logger.error(f'Сообщение оператору о заказах {order_ids}: '
+                         f'{err}')
+
+    def _batches(self, matrix, stops):
+        # Самый старый заказ и ближайшие к нему в пределах radius_km.
+        batches = []
+        left = np.asarray(stops)
+        while len(left):
+            seed = left[0]
+            nearest = left[np.argsort(matrix[seed, left], kind='stable')]
+            batch = nearest[:self.max_stops]
+            batch = batch[matrix[seed, batch] <= self.radius_km]
+            batches.append([int(stop) for stop in batch])
+            left = left[~np.isin(left, batch)]
+        return batches
+
+    def plan_store(self, store, orders):
+        """
+        Маршруты доставщиков одной пиццерии.
+
+        Возвращает маршруты [{'courier', 'store', 'start', 'orders',
+        'length', 'direct'}, ...] и заказы, оставшиеся без доставщика.
+        """
+        orders = sorted(orders, key=lambda order: order['created_at'])
+        couriers = self.directory.couriers(store)
+        start = self.stores.point(store)
+        if not couriers or start is None:
+            logger.warning(f'Некому раздать заказы пиццерии {store}')
+            return [], orders
+
+        points = [start] + [(order['lat'], order['lon']) for order in orders]
+        matrix = distance_matrix(points)
+        loads = self.directory.loads(couriers)
+        stops = {courier: [] for courier in couriers}
+        deferred = []
+        for batch in self._batches(matrix, range(1, len(points))):
+            # Пакет - наименее загруженному из тех, кому он поместится.
+            free = [courier for courier in couriers
+                    if len(stops[courier]) + len(batch) <= self.max_stops]
+            if not free:
+                deferred.extend(orders[stop - 1] for stop in batch)
+                continue
+            courier = min(free, key=lambda courier: (loads[courier]
+                                                     + len(stops[courier])))
+            stops[courier].extend(batch)
+
+        routes = []
+        for courier, courier_stops in stops.items():
+            if not courier_stops:
+                continue
+            route, length = order_route(matrix, courier_stops)
+            routes.append({
+                'courier': courier,
+                'store': store,
+                'start': start,
+                'orders': [orders[stop - 1] for stop in route],
+                'length': length,
+                # Если бы каждый заказ везли отдельно, туда и обратно.
+                'direct': 2 * float(matrix[0, route].sum()),
+            })
+        return routes, deferred
+
+    def plan(self, orders):
+        """Маршруты по всем пиццериям и отложенные заказы."""
+        by_store = {}
+        for order in orders:
+            by_store.setdefault(order['store'], []).append(order)
+        routes = []
+        deferred = []
+        for store, store_orders in by_store.items():
+            store_routes, store_deferred = self.plan_store(store,
+                                                           store_orders)
+            routes.extend(store_routes)
+            deferred.extend(store_deferred)
+        return routes, deferred
+
+    async def run(self, bot):
+        """Раздать ждущие заказы. Возвращает число розданных."""
+        orders = self.take()
+        if not orders:
+            return 0
+        routes, deferred = await run_in_db_executor(self.plan, orders)
+        dead = self._requeue(deferred)
+        self._metrics['deferred'] += len(deferred)
+
+        dispatched = 0
+        for route in routes:
+            try:
+                await bot.send_message(chat_id=route['courier'],
+                                       text=format_route(route))
+            except TelegramError as err:
+                logger.error(f'Маршрут доставщику {route["courier"]}: {err}')
+                self._metrics['send_errors'] += 1
+                dead.extend(self._requeue(route['orders']))
+                continue
+            self._observe(route)
+            dispatched += len(route['orders'])
+        if dead:
+            await self._alert(bot, dead)
+        logger.info(f'Раздано заказов: {dispatched}, маршрутов: '
+                    f'{len(routes)}, отложено: {len(deferred)}')
+        return dispatched
+
+    def _observe(self, route):
+        now = time.time()
+        metrics = self._metrics
+        for order in route['orders']:
+            self.directory.assigned(route['courier'], order['order_id'])
+            self.assignment.observe(now - order['created_at'])
+        metrics['orders'] += len(route['orders'])
+        metrics['routes'] += 1
+        metrics['route_km'] += route['length']
+        metrics['direct_km'] += route['direct']
+        metrics['max_route_km'] = max(metrics['max_route_km'],
+                                      route['length'])
+        metrics['max_stops'] = max(metrics['max_stops'],
+                                   len(route['orders']))
+
+    def stats(self):
+        stats = dict(self._metrics)
+        stats['stops_per_route'] = (stats['orders'] / stats['routes']
+                                    if stats['routes'] else 0.0)
+        stats['pending'] = self.db.llen(self.key)
+        stats['dead_pending'] = self.db.llen(self.dead_key)
+        stats['assignment'] = self.assignment.stats()
+        return stats
@@ -0,0 +1,247 @@
+"""
+Асинхронный геокодер адресов с кэшем в Redis.
+
+YandexGeocoder ходит в геокодер Яндекса через aiohttp и не блокирует
+event loop. StubGeocoder отвечает по таблице адресов без сети - для
+тестов и локального запуска. CachedGeocoder запоминает ответы любого
+из них в Redis по нормализованному адресу: повторный ввод того же
+адреса (в другом регистре, с лишними пробелами и запятыми) не требует
+запроса к геокодеру. Ненайденные адреса тоже кэшируются, но на меньший
+срок. Число записей ограничено max_size: лишние удаляются начиная
+с самых старых.
+
+Ключи:
+    geo:<sha1 адреса>  - "широта,долгота" или "" для ненайденного;
+    geo:index          - sorted set ключей по времени записи.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+import aiohttp
+
+
+logger = logging.getLogger('tg_bot.geocoder')
+
+YANDEX_GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
+_dump_lock = threading.Lock()
+
+
+class GeocoderError(Exception):
+    """Геокодер недоступен или отклонил запрос."""
+
+
+def normalize_address(address):
+    """Адрес в виде ключа кэша: регистр, ё, пробелы и знаки не важны."""
+    address = address.casefold().replace('ё', 'е')
+    return ' '.join(re.findall(r'\w+', address))
+
+
+def dump_places(path, found_places):
+    """Записать ответ геокодера в файл для отладки."""
+    with _dump_lock:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(found_places, f, indent=4, ensure_ascii=False)
+
+
+class YandexGeocoder():
+    """
+    Клиент геокодера Яндекса.
+
+    dump_path - если задан, последний ответ геокодера пишется в этот
+    файл (раньше это делалось всегда, в data/geo.json).
+    """
+
+    def __init__(self, apikey, timeout=5, dump_path=None):
+        """Инициализировать атрибуты данных."""
+        self.apikey = apikey
+        self.timeout = timeout
+        self.dump_path = dump_path
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def fetch_coordinates(self, address):
+        """(широта, долгота) строками или None, если адрес не найден."""
+        params = {
+            'geocode': address,
+            'apikey': self.apikey,
+            'format': 'json',
+        }
+        try:
+            async with self._get_session().get(YANDEX_GEOCODER_URL,
+                                               params=params) as response:
+                response.raise_for_status()
+                payload = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                ValueError) as err:
+            raise GeocoderError(f'Геокодер Яндекса: {err!r}') from err
+
+        try:
+            found_places = (payload['response']['GeoObjectCollection']
+                            ['featureMember'])
+            if found_places:
+                lon, lat = (found_places[0]['GeoObject']['Point']['pos']
+                            .split(' '))
+        except (KeyError, IndexError, TypeError, ValueError) as err:
+            # Ответ с ошибкой или неожиданного вида - как сбой сети:
+            # адрес не считается ненайденным.
+            raise GeocoderError(
+                f'Геокодер Яндекса: неожиданный ответ {err!r}') from err
+        if self.dump_path:
+            await asyncio.to_thread(dump_places, self.dump_path,
+                                    found_places)
+        if not found_places:
+            return None
+        return lat, lon
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class StubGeocoder():
+    """Геокодер без сети: адреса и координаты берутся из словаря."""
+
+    def __init__(self, addresses, latency=0.0):
+        """Инициализировать атрибуты данных."""
+        self.addresses = {normalize_address(address): tuple(coords)
+                          for address, coords in addresses.items()}
+        self.latency = latency
+        self.requests = 0
+
+    @classmethod
+    def from_file(cls, path, latency=0.0):
+        """Загрузить {адрес: [широта, долгота]} из JSON-файла."""
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f), latency=latency)
+
+    async def fetch_coordinates(self, address):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not address or not address.strip():
+            raise GeocoderError('Пустой адрес')
+        return self.addresses.get(normalize_address(address))
+
+    async def close(self):
+        pass
+
+
+class CachedGeocoder():
+    """
+    Кэш ответов геокодера в Redis.
+
+    ttl - сколько секунд хранить найденные координаты, negative_ttl -
+    сколько помнить, что адрес не найден, max_size - предел числа
+    записей. Одновременные запросы одного адреса идут в геокодер
+    одним запросом.
+    """
+
+    index_key = 'geo:index'
+
+    def __init__(self, db, geocoder, ttl=30 * 24 * 3600,
+                 negative_ttl=24 * 3600, max_size=100000):
+        """Инициализировать атрибуты данных."""
+        self.db = db
+        self.geocoder = geocoder
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._inflight = {}
+        self._metrics = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'errors': 0,
+            'evicted': 0,
+        }
+
+    @staticmethod
+    def _key(normalized):
+        digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        return f'geo:{digest}'
+
+    async def fetch_coordinates(self, address):
+        """(широта, долгота) строками или None, если адрес не найден."""
+        normalized = normalize_address(address or '')
+        if not normalized:
+            raise GeocoderError('Пустой адрес')
+        key = self._key(normalized)
+
+        cached = self.db.get(key)
+        if cached is not None:
+            if not cached:
+                self._metrics['negative_hits'] += 1
+                return None
+            self._metrics['hits'] += 1
+            return tuple(cached.split(','))
+
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            coords = await self._fetch(key, address)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            future.set_exception(err)
+            # Исключение уже передано ждущим, само future не нужно.
+            future.exception()
+            raise
+        else:
+            future.set_result(coords)
+            return coords
+        finally:
+            del self._inflight[key]
+
+    async def _fetch(self, key, address):
+        self._metrics['misses'] += 1
+        try:
+            coords = await self.geocoder.fetch_coordinates(address)
+        except GeocoderError:
+            # Ошибку геокодера не кэшируем: в следующий раз повторим.
+            self._metrics['errors'] += 1
+            raise
+        if coords is None:
+            self.db.set(key, '', ex=self.negative_ttl)
+        else:
+            self.db.set(key, ','.join(coords), ex=self.ttl)
+        self._remember(key)
+        return coords
+
+    def _remember(self, key):
+        with self.db.pipeline() as pipe:
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.zcard(self.index_key)
+            size = pipe.execute()[-1]
+        if size <= self.max_size:
+            return
+        # Удаляем самые старые записи сверх предела.
+        oldest = self.db.zpopmin(self.index_key, size - self.max_size)
+        keys = [old_key for old_key, _ in oldest]
+        if keys:
+            self.db.delete(*keys)
+            self._metrics['evicted'] += len(keys)
+
+    def stats(self):
+        stats = dict(self._metrics)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = ((stats['hits'] + stats['negative_hits'])
+                              / lookups if lookups else 0.0)
+        return stats
+
+    async def close(self):
+        await self.geocoder.close()
@@ -1,21 +1,87 @@
+"""
+Синхронный клиент OpenCart API и запросы к БД заказов.
+
+HTTP-обертки этого модуля остались от синхронной версии бота: бот
+ходит в API через opencart_api_async и TokenManager, который обновляет
+недействительный api_token и повторяет запрос. Здесь такого повтора
+нет - вызывающий сам получает токен через get_actual_api_token.
+Из бота используются разбор ответов (decode_response) и чтение
+заказов из БД (get_order_content, get_orders_content).
+"""
 import logging
+import time
 
-import mysql.connector
 import json
 
+from opencart_db import get_pool, run_in_db_executor
+from opencart_transport import get_transport
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 logger = logging.getLogger('tg_bot.oc_api')
 
+# Символы, с которых может начинаться JSON-ответ OpenCart.
+_JSON_START = (ord('{'), ord('['))
+
+
+def find_payload_start(body):
+    """Позиция начала JSON в теле ответа OpenCart (bytes).
+
+    При включенном выводе ошибок PHP перед JSON идут уведомления вида
+    "<b>Notice</b>: ... on line <b>12</b><br />". JSON начинается
+    с первой скобки после последнего "</b>".
+    """
+    start = 0
+    while start < len(body) and body[start] in b' \t\r\n':
+        start += 1
+    if start < len(body) and body[start] in _JSON_START:
+        return start
+
+    notice_end = body.rfind(b'</b>')
+    start = notice_end + len(b'</b>') if notice_end >= 0 else 0
+    positions = [pos for pos in (body.find(b'{', start),
+                                 body.find(b'[', start)) if pos >= 0]
+    return min(positions) if positions else start
+
+
+def decode_response(body):
+    """Разобрать ответ OpenCart за один проход.
+
+    body - тело ответа (bytes или str). Если установлен orjson,
+    разбор идет через него, без копирования тела.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    start = find_payload_start(body)
+    if orjson is not None:
+        return orjson.loads(memoryview(body)[start:])
+    return json.loads(body[start:])
+
+
+def _post(session, website, route, params=None, data=None):
+    """POST на index.php?route=... и разобранный ответ."""
+    def send(timeout):
+        res = session.post(
+            f'http://{website}/index.php?route={route}',
+            params=params,
+            data=data,
+            timeout=timeout
+        )
+        res.raise_for_status()
+        return res.content
+
+    return decode_response(get_transport().request_sync(route, send))
+
 
 def get_api_token(session, username, key, website):
     """Сгенерировать новый api_token."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/login',
-        data={'username': username, 'key': key}
-    )
-    res.raise_for_status()
-    result_dict = json.loads(res.text)
-    if res.text == '[]':
+    result_dict = _post(session, website, 'api/login',
+                        data={'username': username, 'key': key})
+    if result_dict == []:
         text = (f'Error OpenCart API: api_token is empty.\n'
                 f'User API OpenCart - {username}.\n'
                 f'Key API OpenCart - {key}.')
@@ -29,102 +95,88 @@ def get_api_token(session, username, key, website):
 
 
 def get_actual_api_token(
-        session, username, key, user_db, psw, host, db, website):
-    """Получить существующий или сгенерить новый api_token."""
-    cnx = mysql.connector.connect(user=user_db,
-                                  password=psw,
-                                  host=host,
-                                  database=db)
-    cursor_api = cnx.cursor()
-    query_api = ('SELECT session_id FROM oc_api_session')
-    flag = True
-    while flag:
-        try:
-            # Читаем api_token из БД.
+        session, username, key, user_db, psw, host, db, website,
+        attempts=5, backoff=0.5):
+    """Получить существующий или сгенерить новый api_token.
+
+    Если в БД нет токена, запрашивается новый, и чтение повторяется
+    не более attempts раз с нарастающей паузой.
+    """
+    query_api = ('SELECT session_id FROM oc_api_session LIMIT 1')
+    pool = get_pool(user_db, psw, host, db)
+    api_token = None
+    for attempt in range(attempts):
+        if attempt:
+            # Паузы и api/login - без соединения: пока ждем, оно нужно
+            # другим запросам из пула.
+            time.sleep(backoff * 2 ** (attempt - 1))
+        # Читаем api_token из БД.
+        with pool.connection() as cnx:
+            cursor_api = cnx.cursor()
             cursor_api.execute(query_api)
-            api_token_list = []
-            for session_id in cursor_api:
-                api_token_list.append(session_id)
-            api_token = str(list(api_token_list[0])[0])
-            flag = False
-        except IndexError:
-            # Получаем api_token для сессии, если его нет в БД.
-            if not get_api_token(session, username, key, website):
-                flag = False
-
-    cursor_api.close()
+            rows = cursor_api.fetchall()
+            cursor_api.close()
+        if rows:
+            api_token = str(rows[0][0])
+            break
+        # Получаем api_token для сессии, если его нет в БД.
+        if not get_api_token(session, username, key, website):
+            break
     logger.debug(f'get_actual_api_token: api-token - "{api_token}"\n')
     return api_token
 
 
+async def get_actual_api_token_async(
+        session, username, key, user_db, psw, host, db, website):
+    """Асинхронный вариант get_actual_api_token."""
+    return await run_in_db_executor(get_actual_api_token, session, username,
+                                    key, user_db, psw, host, db, website)
+
+
 def set_session_for_api_user(session, api_token, username, key, website):
     """Установление сеанса для пользователя API."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/shipping/address',
-        params={'api_token': api_token},
-        data={
-            'username': username,
-            'key': key
-        }
-    )
-    res.raise_for_status()
-    user_session = res.text.split('</b>')[-1]
-    logger.debug(f'Cеанса для {username} : {json.loads(user_session)}')
-    return json.loads(user_session)
+    user_session = _post(session, website, 'api/shipping/address',
+                         params={'api_token': api_token},
+                         data={'username': username, 'key': key})
+    logger.debug(f'Cеанса для {username} : {user_session}')
+    return user_session
 
 
 def cart_add(session, api_token, product_id, website, quantity='1'):
     """ Добавляем товар в корзину."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/cart/add',
-        params={'api_token': api_token},
-        data={
-            'product_id': product_id,
-            'quantity': quantity,
-        }
-    )
-    res.raise_for_status()
-    cart_add = res.text.split('</b>')[-1]
-    logger.debug(f'cart_add: Добавлено в корзину - {json.loads(cart_add)}')
+    cart_add = _post(session, website, 'api/cart/add',
+                     params={'api_token': api_token},
+                     data={
+                         'product_id': product_id,
+                         'quantity': quantity,
+                     })
+    logger.debug(f'cart_add: Добавлено в корзину - {cart_add}')
 
 
 def cart_edit(session, api_token, cart_id, website, quantity):
     """Изменяем кол-во товара в корзине. (key = cart_id)"""
-    res = session.post(
-        f'http://{website}/index.php?route=api/cart/edit',
-        params={'api_token': api_token},
-        data={'key': cart_id,
-              'quantity': quantity}
-    )
-    res.raise_for_status()
-    cart_edit = res.text.split('</b>')[-1]
-    logger.debug(f'cart_edit: {json.loads(cart_edit)}')
+    cart_edit = _post(session, website, 'api/cart/edit',
+                      params={'api_token': api_token},
+                      data={'key': cart_id,
+                            'quantity': quantity})
+    logger.debug(f'cart_edit: {cart_edit}')
 
 
 def cart_remove(session, api_token, cart_id, website):
     """Удаляем товар из корзины. (key = cart_id)"""
-    res = session.post(
-        f'http://{website}/index.php?route=api/cart/remove',
-        params={'api_token': api_token},
-        data={'key': cart_id}
-    )
-    res.raise_for_status()
-    cart_remove = res.text.split('</b>')[-1]
-    logger.debug(f'cart_remove: {json.loads(cart_remove)}')
+    cart_remove = _post(session, website, 'api/cart/remove',
+                        params={'api_token': api_token},
+                        data={'key': cart_id})
+    logger.debug(f'cart_remove: {cart_remove}')
 
 
 def get_cart_products(session, api_token, website):
     """Содержимое корзины."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/cart/products',
-        params={'api_token': api_token},
-        data={}
-    )
-    res.raise_for_status()
-
-    cart_content = res.text.split('</b>')[-1]
-    logger.debug(f'cart_content: {json.loads(cart_content)}')
-    return json.loads(cart_content)
+    cart_content = _post(session, website, 'api/cart/products',
+                         params={'api_token': api_token},
+                         data={})
+    logger.debug(f'cart_content: {cart_content}')
+    return cart_content
 
 
 def set_customer(session,
@@ -135,244 +187,198 @@ def set_customer(session,
                  lastname='Ivanov!',
                  email='example@gmail.com'):
     """Установить клиента для текущей сессии."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/customer',
-        params={'api_token': api_token},
-        data={
-            'firstname': firstname,
-            'lastname': lastname,
-            'email': email,
-            'telephone': telephone,
-        }
-    )
-    res.raise_for_status()
-    customer = res.text.split('</b>')[-1]
-    logger.debug(f'customer: {json.loads(customer)}')
+    customer = _post(session, website, 'api/customer',
+                     params={'api_token': api_token},
+                     data={
+                         'firstname': firstname,
+                         'lastname': lastname,
+                         'email': email,
+                         'telephone': telephone,
+                     })
+    logger.debug(f'customer: {customer}')
 
 
 def set_shipping_address(session, api_token, website):
     """Установить адрес доставки."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/shipping/address',
-        params={'api_token': api_token},
-        data={
-            'firstname': 'Клиент',
-            'lastname': 'по умолчанию',
-            'address_1': 'Адрес по умолчанию',
-            'city': 'Минусинск',
-            'country_id': 'RUS',
-            'zone_id': 'KGD'
-        }
-    )
-    res.raise_for_status()
-    shipping_address = res.text.split('</b>')[-1]
-    logger.debug(f'shipping_address: {json.loads(shipping_address)}')
+    shipping_address = _post(session, website, 'api/shipping/address',
+                             params={'api_token': api_token},
+                             data={
+                                 'firstname': 'Клиент',
+                                 'lastname': 'по умолчанию',
+                                 'address_1': 'Адрес по умолчанию',
+                                 'city': 'Минусинск',
+                                 'country_id': 'RUS',
+                                 'zone_id': 'KGD'
+                             })
+    logger.debug(f'shipping_address: {shipping_address}')
 
 
 def get_shipping_methods(session, api_token, website):
     """Получить доступные методы доставки."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/shipping/methods',
-        params={'api_token': api_token},
-    )
-    res.raise_for_status()
-    shipping_methods = res.text.split('</b>')[-1]
-    logger.debug(f'shipping_methods: {json.loads(shipping_methods)}')
-    return json.loads(shipping_methods)
+    shipping_methods = _post(session, website, 'api/shipping/methods',
+                             params={'api_token': api_token})
+    logger.debug(f'shipping_methods: {shipping_methods}')
+    return shipping_methods
 
 
 def set_shipping_method(session, api_token, website):
     """Установить способ доставки для сеанса (самовывоз)."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/shipping/method',
-        params={'api_token': api_token},
-        data={
-            'shipping_method': 'pickup.pickup'
-        }
-    )
-    res.raise_for_status()
-    shipping_method = res.text.split('</b>')[-1]
-    logger.debug(f'shipping_method: {json.loads(shipping_method)}')
+    shipping_method = _post(session, website, 'api/shipping/method',
+                            params={'api_token': api_token},
+                            data={
+                                'shipping_method': 'pickup.pickup'
+                            })
+    logger.debug(f'shipping_method: {shipping_method}')
 
 
 def set_payment_address(session, api_token, website):
     """Установить платежный адрес."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/payment/address',
-        params={'api_token': api_token},
-        data={
-            'firstname': 'Клиент',
-            'lastname': 'по умолчанию',
-            'address_1': 'Адрес по умолчанию',
-            'city': 'Минусинск',
-            'country_id': 'RUS',
-            'zone_id': 'KGD'
-        }
-    )
-    res.raise_for_status()
-    payment_address = res.text.split('</b>')[-1]
-    logger.debug(f'payment_address: {json.loads(payment_address)}')
+    payment_address = _post(session, website, 'api/payment/address',
+                            params={'api_token': api_token},
+                            data={
+                                'firstname': 'Клиент',
+                                'lastname': 'по умолчанию',
+                                'address_1': 'Адрес по умолчанию',
+                                'city': 'Минусинск',
+                                'country_id': 'RUS',
+                                'zone_id': 'KGD'
+                            })
+    logger.debug(f'payment_address: {payment_address}')
 
 
 def get_payment_methods(session, api_token, website):
     """Получить доступные методы оплаты."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/payment/methods',
-        params={'api_token': api_token},
-    )
-    res.raise_for_status()
-    payment_methods = res.text.split('</b>')[-1]
-    logger.debug(f'payment_methods: {json.loads(payment_methods)}')
+    payment_methods = _post(session, website, 'api/payment/methods',
+                            params={'api_token': api_token})
+    logger.debug(f'payment_methods: {payment_methods}')
 
 
 def set_payment_method(session, api_token, website):
     """Установить способ оплаты."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/payment/method',
-        params={'api_token': api_token},
-        data={
-            'payment_method': 'cod'
-        }
-    )
-    res.raise_for_status()
-    payment_method = res.text.split('</b>')[-1]
-    logger.debug(f'payment_method: {json.loads(payment_method)}')
+    payment_method = _post(session, website, 'api/payment/method',
+                           params={'api_token': api_token},
+                           data={
+                               'payment_method': 'cod'
+                           })
+    logger.debug(f'payment_method: {payment_method}')
 
 
 def order_add(session, api_token, website):
     """Новый заказ по содержимому корзины."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/order/add',
-        params={'api_token': api_token},
-    )
-    res.raise_for_status()
-    order_content = json.loads(res.text.split('</b>')[-1])
+    order_content = _post(session, website, 'api/order/add',
+                          params={'api_token': api_token})
     logger.debug(f'order_content: {order_content}')
     return order_content['order_id']
 
 
 def order_edit(session, api_token, order_id, website):
     """Редактировать заказа."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/order/edit',
-        params={'api_token': api_token,
-                'order_id': order_id,
-                'product_id': 28,
-                'quantity': 9},
-        data={}
-    )
-    res.raise_for_status()
-    order_edit = res.text.split('</b>')[-1]
-    logger.debug(f'order_edit: {json.loads(order_edit)}')
+    order_edit = _post(session, website, 'api/order/edit',
+                       params={'api_token': api_token,
+                               'order_id': order_id,
+                               'product_id': 28,
+                               'quantity': 9},
+                       data={})
+    logger.debug(f'order_edit: {order_edit}')
 
 
 def order_delete(session, api_token, order_id, website):
     """Удалить заказа."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/order/delete',
-        params={'api_token': api_token,
-                'order_id': order_id},
-        data={}
-    )
-    res.raise_for_status()
-    order_delete = res.text.split('</b>')[-1]
-    logger.debug(f'order_delete: {json.loads(order_delete)}')
+    order_delete = _post(session, website, 'api/order/delete',
+                         params={'api_token': api_token,
+                                 'order_id': order_id},
+                         data={})
+    logger.debug(f'order_delete: {order_delete}')
 
 
 def get_order_info(session, api_token, order_id, website):
     """Информация о заказе."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/order/info',
-        params={'api_token': api_token,
-                'order_id': order_id},
-        data={}
-    )
-    res.raise_for_status()
-    order_info = res.text.split('</b>')[-1]
-    logger.debug(f'order_info: {json.loads(order_info)}')
+    order_info = _post(session, website, 'api/order/info',
+                       params={'api_token': api_token,
+                               'order_id': order_id},
+                       data={})
+    logger.debug(f'order_info: {order_info}')
     return order_info
 
 
 def get_order_history(session, api_token, order_id, website):
     """История заказа."""
-    res = session.post(
-        f'http://{website}/index.php?route=api/order/history',
-        params={'api_token': api_token,
-                'order_id': order_id},
-        data={}
-    )
-    res.raise_for_status()
-    order_history = res.text.split('</b>')[-1]
-    logger.debug(f'order_history: {json.loads(order_history)}')
+    order_history = _post(session, website, 'api/order/history',
+                          params={'api_token': api_token,
+                                  'order_id': order_id},
+                          data={})
+    logger.debug(f'order_history: {order_history}')
+
+
+def format_order_content(order_id, telephone, total, products):
+    """Текст сообщения доставщику."""
+    lines = ['Сообщение доставщику',
+             '--------------------------',
+             f'Номер заказа: {order_id}']
+    lines.extend(f'{name} - {quantity} шт.' for name, quantity in products)
+    lines.append(f'Итоговая сумма заказа: {total}')
+    lines.append(f'Номер телефона клиента: {telephone}')
+    return '\n'.join(lines)
+
+
+def get_orders_content(order_ids, user_db, psw, host, db, batch_size=500):
+    """Получить содержимое нескольких заказов: {order_id: текст}.
+
+    Заказы и их товары читаются одним запросом на каждые batch_size
+    заказов. Несуществующих заказов в результате нет.
+    """
+    order_ids = list(dict.fromkeys(int(order_id) for order_id in order_ids))
+    orders = {}
+    with get_pool(user_db, psw, host, db).connection() as cnx:
+        cursor = cnx.cursor()
+        for start in range(0, len(order_ids), batch_size):
+            batch = order_ids[start:start + batch_size]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(
+                'SELECT o.order_id, o.telephone, o.total, '
+                'op.name, op.quantity '
+                'FROM oc_order as o '
+                'left JOIN oc_order_product as op '
+                'on op.order_id = o.order_id '
+                f'WHERE o.order_id IN ({placeholders}) '
+                'ORDER BY o.order_id, op.order_product_id',
+                batch)
+            for order_id, telephone, total, name, quantity in cursor:
+                if order_id not in orders:
+                    orders[order_id] = (telephone, total, [])
+                # У заказа без товаров name и quantity - NULL.
+                if name is not None:
+                    orders[order_id][2].append((name, quantity))
+        cursor.close()
+
+    contents = {}
+    for order_id in order_ids:
+        if order_id in orders:
+            contents[order_id] = format_order_content(order_id,
+                                                      *orders[order_id])
+    logger.debug(f'Заказов для доставщиков: {len(contents)} '
+                 f'из {len(order_ids)}')
+    return contents
 
 
 def get_order_content(order_id, user_db, psw, host, db):
     """Получить содержимое заказа."""
-    cnx = mysql.connector.connect(user=user_db,
-                                  password=psw,
-                                  host=host,
-                                  database=db)
-    cursor = cnx.cursor()
-    query_order = ('SELECT telephone, total '
-                   f'FROM oc_order WHERE order_id = {order_id}')
-    query_order_product = ('SELECT name, quantity '
-                           'FROM oc_order_product '
-                           f'WHERE order_id = {order_id}')
-
-    cursor.execute(query_order)
-    order_dict = {}
-    for (telephone, total) in cursor:
-        order_dict['telephone'] = telephone
-        order_dict['total'] = total
-
-    cursor.close()
-
-    cursor = cnx.cursor()
-    cursor.execute(query_order_product)
-    order_products_list = []
-    for (name, quantity) in cursor:
-        product_dict = {}
-        product_dict['name'] = name
-        product_dict['quantity'] = quantity
-        order_products_list.append(product_dict)
-
-    cursor.close()
-
-    text = (f'Сообщение доставщику\n'
-            f'--------------------------\n'
-            f'Номер заказа: {order_id}\n')
-    for dish in order_products_list:
-        text += f'{dish["name"]} - {dish["quantity"]} шт.\n'
-
-    text += (f'Итоговая сумма заказа: {order_dict["total"]}\n'
-             f'Номер телефона клиента: {order_dict["telephone"]}')
-    logger.info(f'Текст сообщения доставщику: \n{text}')
+    text = get_orders_content([order_id], user_db, psw, host, db).get(
+        int(order_id))
+    if text is None:
+        logger.warning(f'Заказ {order_id} не найден')
+    else:
+        logger.info(f'Текст сообщения доставщику: \n{text}')
     return text
 
 
-def create_order(s, api_token, lastname, telephone, website):
-    """Создать заказ."""
-    # Установить адрес доставки.
-    set_shipping_address(s, api_token, website)
-
-    # Получить доступные методы доставки.
-    get_shipping_methods(s, api_token, website)
-
-    # Установить способ доставки для сеанса (самовывоз).
-    set_shipping_method(s, api_token, website)
-
-    # Установить платежный адрес.
-    set_payment_address(s, api_token, website)
-
-    # Получить доступные методы оплаты.
-    get_payment_methods(s, api_token, website)
-
-    # Установить способ оплаты.
-    set_payment_method(s, api_token, website)
+async def get_order_content_async(order_id, user_db, psw, host, db):
+    """Асинхронный вариант get_order_content."""
+    return await run_in_db_executor(get_order_content, order_id,
+                                    user_db, psw, host, db)
 
-    # Установить клиента для текущей сессии.
-    set_customer(s, api_token, website, telephone, lastname=lastname)
 
-    # Новый заказ по содержимому корзины.
-    order_id = order_add(s, api_token, website)
-    return order_id
+async def get_orders_content_async(order_ids, user_db, psw, host, db):
+    """Асинхронный вариант get_orders_content."""
+    return await run_in_db_executor(get_orders_content, order_ids,
+                                    user_db, psw, host, db)
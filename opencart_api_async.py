@@ -0,0 +1,442 @@
+"""
+Асинхронный клиент OpenCart API на aiohttp.
+
+Функции повторяют opencart_api и возвращают те же значения, поэтому
+обработчики бота можно переводить на них по одному. Вместо
+requests.Session первым аргументом передается aiohttp.ClientSession,
+созданная через create_session(): она держит keep-alive соединения
+с магазином и переиспользует их между запросами.
+"""
+import logging
+import time
+
+from collections import OrderedDict
+
+import aiohttp
+
+from opencart_api import decode_response
+from opencart_transport import get_transport
+
+
+logger = logging.getLogger('tg_bot.oc_api_async')
+
+# Таймаут по умолчанию для одного запроса к OpenCart, сек.
+DEFAULT_TIMEOUT = 10
+# Фрагменты текста ошибки OpenCart о недействительном api_token
+# (error_permission из языковых файлов en-gb и ru-ru), в нижнем регистре.
+INVALID_TOKEN_MARKERS = (
+    'permission to access the api',
+    'нет прав для доступа к api',
+)
+
+
+class OpenCartApiError(Exception):
+    """OpenCart API вернул ошибку."""
+
+
+class InvalidApiToken(OpenCartApiError):
+    """api_token истек или не принят OpenCart."""
+
+
+class CartError(OpenCartApiError):
+    """Товар не добавлен в корзину (нет такого или он отключен)."""
+
+
+def create_connector(limit=20, keepalive_timeout=30):
+    """Создать пул keep-alive соединений к OpenCart.
+
+    limit - максимум одновременных соединений с магазином,
+    keepalive_timeout - сколько секунд держать простаивающее соединение.
+    """
+    return aiohttp.TCPConnector(limit=limit,
+                                keepalive_timeout=keepalive_timeout)
+
+
+def create_session(limit=20, keepalive_timeout=30, timeout=DEFAULT_TIMEOUT,
+                   connector=None, cookie_jar=None):
+    """Создать сессию с пулом keep-alive соединений к OpenCart.
+
+    timeout - общий таймаут запроса по умолчанию. Если передан
+    connector, сессия использует его и не закрывает при закрытии:
+    так несколько сессий с разными cookies делят одни соединения.
+    """
+    connector_owner = connector is None
+    if connector is None:
+        connector = create_connector(limit, keepalive_timeout)
+    return aiohttp.ClientSession(
+        connector=connector,
+        connector_owner=connector_owner,
+        cookie_jar=cookie_jar,
+        timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+def _is_invalid_token(result):
+    """Ответ OpenCart - ошибка доступа из-за api_token."""
+    error = result.get('error') if isinstance(result, dict) else None
+    if isinstance(error, dict):
+        error = error.get('warning')
+    return (isinstance(error, str)
+            and any(marker in error.lower()
+                    for marker in INVALID_TOKEN_MARKERS))
+
+
+async def _post(session, website, route, params=None, data=None,
+                timeout=None):
+    """POST на index.php?route=... и разобранный ответ.
+
+    Запрос идет через общий транспорт: таймаут маршрута (если не задан
+    timeout), повторы идемпотентных запросов и предохранитель.
+    """
+    request_params = {'route': route}
+    if params:
+        request_params.update(params)
+
+    async def send(route_timeout):
+        request_timeout = aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else route_timeout)
+        async with session.post(f'http://{website}/index.php',
+                                params=request_params,
+                                data=data,
+                                timeout=request_timeout) as res:
+            res.raise_for_status()
+            return await res.read()
+
+    body = await get_transport().request(route, send)
+    result = decode_response(body)
+    if params and 'api_token' in params and _is_invalid_token(result):
+        raise InvalidApiToken(f'{route}: api_token не принят OpenCart')
+    return result
+
+
+async def get_api_token(session, username, key, website, timeout=None):
+    """Сгенерировать новый api_token."""
+    result_dict = await _post(session, website, 'api/login',
+                              data={'username': username, 'key': key},
+                              timeout=timeout)
+    if result_dict == []:
+        text = (f'Error OpenCart API: api_token is empty.\n'
+                f'User API OpenCart - {username}.\n'
+                f'Key API OpenCart - {key}.')
+        logger.error(text)
+        return False
+    elif 'error' in result_dict:
+        logger.error(f'Error OpenCart API: {result_dict["error"]}')
+        return False
+    else:
+        return result_dict['api_token']
+
+
+async def set_session_for_api_user(session, api_token, username, key,
+                                   website, timeout=None):
+    """Установление сеанса для пользователя API."""
+    user_session = await _post(session, website, 'api/shipping/address',
+                               params={'api_token': api_token},
+                               data={'username': username, 'key': key},
+                               timeout=timeout)
+    logger.debug(f'Cеанса для {username} : {user_session}')
+    return user_session
+
+
+async def cart_add(session, api_token, product_id, website, quantity='1',
+                   timeout=None):
+    """ Добавляем товар в корзину."""
+    cart_add = await _post(session, website, 'api/cart/add',
+                           params={'api_token': api_token},
+                           data={'product_id': product_id,
+                                 'quantity': quantity},
+                           timeout=timeout)
+    forget_checkout_state(api_token, CART_DEPENDENT_STEPS)
+    logger.debug(f'cart_add: Добавлено в корзину - {cart_add}')
+    if isinstance(cart_add, dict) and cart_add.get('error'):
+        raise CartError(f'cart_add {product_id}: {cart_add["error"]}')
+
+
+async def cart_edit(session, api_token, cart_id, website, quantity,
+                    timeout=None):
+    """Изменяем кол-во товара в корзине. (key = cart_id)"""
+    cart_edit = await _post(session, website, 'api/cart/edit',
+                            params={'api_token': api_token},
+                            data={'key': cart_id, 'quantity': quantity},
+                            timeout=timeout)
+    forget_checkout_state(api_token, CART_DEPENDENT_STEPS)
+    logger.debug(f'cart_edit: {cart_edit}')
+
+
+async def cart_remove(session, api_token, cart_id, website, timeout=None):
+    """Удаляем товар из корзины. (key = cart_id)"""
+    cart_remove = await _post(session, website, 'api/cart/remove',
+                              params={'api_token': api_token},
+                              data={'key': cart_id},
+                              timeout=timeout)
+    forget_checkout_state(api_token, CART_DEPENDENT_STEPS)
+    logger.debug(f'cart_remove: {cart_remove}')
+
+
+async def get_cart_products(session, api_token, website, timeout=None):
+    """Содержимое корзины."""
+    cart_content = await _post(session, website, 'api/cart/products',
+                               params={'api_token': api_token},
+                               data={},
+                               timeout=timeout)
+    logger.debug(f'cart_content: {cart_content}')
+    return cart_content
+
+
+async def set_customer(session,
+                       api_token,
+                       website,
+                       telephone='+71111111111',
+                       firstname='chat_id',
+                       lastname='Ivanov!',
+                       email='example@gmail.com',
+                       timeout=None):
+    """Установить клиента для текущей сессии."""
+    customer = await _post(session, website, 'api/customer',
+                           params={'api_token': api_token},
+                           data={
+                               'firstname': firstname,
+                               'lastname': lastname,
+                               'email': email,
+                               'telephone': telephone,
+                           },
+                           timeout=timeout)
+    logger.debug(f'customer: {customer}')
+
+
+async def set_shipping_address(session, api_token, website, timeout=None):
+    """Установить адрес доставки."""
+    shipping_address = await _post(session, website, 'api/shipping/address',
+                                   params={'api_token': api_token},
+                                   data={
+                                       'firstname': 'Клиент',
+                                       'lastname': 'по умолчанию',
+                                       'address_1': 'Адрес по умолчанию',
+                                       'city': 'Минусинск',
+                                       'country_id': 'RUS',
+                                       'zone_id': 'KGD'
+                                   },
+                                   timeout=timeout)
+    logger.debug(f'shipping_address: {shipping_address}')
+
+
+async def get_shipping_methods(session, api_token, website, timeout=None):
+    """Получить доступные методы доставки."""
+    shipping_methods = await _post(session, website, 'api/shipping/methods',
+                                   params={'api_token': api_token},
+                                   timeout=timeout)
+    logger.debug(f'shipping_methods: {shipping_methods}')
+    return shipping_methods
+
+
+async def set_shipping_method(session, api_token, website, timeout=None):
+    """Установить способ доставки для сеанса (самовывоз)."""
+    shipping_method = await _post(session, website, 'api/shipping/method',
+                                  params={'api_token': api_token},
+                                  data={'shipping_method': 'pickup.pickup'},
+                                  timeout=timeout)
+    logger.debug(f'shipping_method: {shipping_method}')
+
+
+async def set_payment_address(session, api_token, website, timeout=None):
+    """Установить платежный адрес."""
+    payment_address = await _post(session, website, 'api/payment/address',
+                                  params={'api_token': api_token},
+                                  data={
+                                      'firstname': 'Клиент',
+                                      'lastname': 'по умолчанию',
+                                      'address_1': 'Адрес по умолчанию',
+                                      'city': 'Минусинск',
+                                      'country_id': 'RUS',
+                                      'zone_id': 'KGD'
+                                  },
+                                  timeout=timeout)
+    logger.debug(f'payment_address: {payment_address}')
+
+
+async def get_payment_methods(session, api_token, website, timeout=None):
+    """Получить доступные методы оплаты."""
+    payment_methods = await _post(session, website, 'api/payment/methods',
+                                  params={'api_token': api_token},
+                                  timeout=timeout)
+    logger.debug(f'payment_methods: {payment_methods}')
+
+
+async def set_payment_method(session, api_token, website, timeout=None):
+    """Установить способ оплаты."""
+    payment_method = await _post(session, website, 'api/payment/method',
+                                 params={'api_token': api_token},
+                                 data={'payment_method': 'cod'},
+                                 timeout=timeout)
+    logger.debug(f'payment_method: {payment_method}')
+
+
+async def order_add(session, api_token, website, timeout=None):
+    """Новый заказ по содержимому корзины."""
+    order_content = await _post(session, website, 'api/order/add',
+                                params={'api_token': api_token},
+                                timeout=timeout)
+    logger.debug(f'order_content: {order_content}')
+    return order_content['order_id']
+
+
+async def order_edit(session, api_token, order_id, website, timeout=None):
+    """Редактировать заказа."""
+    order_edit = await _post(session, website, 'api/order/edit',
+                             params={'api_token': api_token,
+                                     'order_id': order_id,
+                                     'product_id': 28,
+                                     'quantity': 9},
+                             data={},
+                             timeout=timeout)
+    logger.debug(f'order_edit: {order_edit}')
+
+
+async def order_delete(session, api_token, order_id, website, timeout=None):
+    """Удалить заказа."""
+    order_delete = await _post(session, website, 'api/order/delete',
+                               params={'api_token': api_token,
+                                       'order_id': order_id},
+                               data={},
+                               timeout=timeout)
+    logger.debug(f'order_delete: {order_delete}')
+
+
+async def get_order_info(session, api_token, order_id, website, timeout=None):
+    """Информация о заказе."""
+    order_info = await _post(session, website, 'api/order/info',
+                             params={'api_token': api_token,
+                                     'order_id': order_id},
+                             data={},
+                             timeout=timeout)
+    logger.debug(f'order_info: {order_info}')
+    return order_info
+
+
+async def get_order_history(session, api_token, order_id, website,
+                            timeout=None):
+    """История заказа."""
+    order_history = await _post(session, website, 'api/order/history',
+                                params={'api_token': api_token,
+                                        'order_id': order_id},
+                                data={},
+                                timeout=timeout)
+    logger.debug(f'order_history: {order_history}')
+
+
+# Шаги оформления заказа, сгруппированные в цепочки. Внутри цепочки
+# каждый шаг зависит от предыдущего: OpenCart сбрасывает методы доставки
+# (оплаты) при смене адреса, а установить метод можно только из списка,
+# который в сессии сохранил запрос .../methods.
+CHECKOUT_CHAINS = (
+    ('shipping_address', 'shipping_methods', 'shipping_method'),
+    ('payment_address', 'payment_methods', 'payment_method'),
+    ('customer',),
+)
+# Шаги, результат которых OpenCart сбрасывает при изменении корзины.
+CART_DEPENDENT_STEPS = ('shipping_methods', 'shipping_method',
+                        'payment_methods', 'payment_method')
+# Сколько сессий OpenCart помнить для пропуска шагов оформления.
+MAX_CHECKOUT_SESSIONS = 10000
+
+# Выполненные шаги оформления по api_token: {шаг: входные данные шага}.
+_checkout_sessions = OrderedDict()
+
+
+def _get_checkout_state(api_token):
+    state = _checkout_sessions.pop(api_token, {})
+    _checkout_sessions[api_token] = state
+    while len(_checkout_sessions) > MAX_CHECKOUT_SESSIONS:
+        _checkout_sessions.popitem(last=False)
+    return state
+
+
+def forget_checkout_state(api_token, steps=None):
+    """Забыть выполненные шаги оформления для сессии OpenCart.
+
+    Без steps сессия забывается целиком.
+    """
+    state = _checkout_sessions.get(api_token)
+    if state is None:
+        return
+    if steps is None:
+        del _checkout_sessions[api_token]
+        return
+    for step in steps:
+        state.pop(step, None)
+
+
+async def create_order(s, api_token, lastname, telephone, website,
+                       report=None):
+    """Создать заказ.
+
+    Шаги, результат которых уже лежит в сессии OpenCart после прошлого
+    заказа (адреса, клиент), повторно не выполняются. Запросы идут
+    последовательно: OpenCart хранит сессию целиком и при параллельных
+    запросах к одной сессии последний перезапишет изменения остальных.
+
+    Если передан словарь report, в него записывается время каждого шага.
+    """
+    steps = {
+        # Установить адрес доставки.
+        'shipping_address': (set_shipping_address, {}),
+        # Получить доступные методы доставки.
+        'shipping_methods': (get_shipping_methods, {}),
+        # Установить способ доставки для сеанса (самовывоз).
+        'shipping_method': (set_shipping_method, {}),
+        # Установить платежный адрес.
+        'payment_address': (set_payment_address, {}),
+        # Получить доступные методы оплаты.
+        'payment_methods': (get_payment_methods, {}),
+        # Установить способ оплаты.
+        'payment_method': (set_payment_method, {}),
+        # Установить клиента для текущей сессии.
+        'customer': (set_customer, {'telephone': telephone,
+                                    'lastname': lastname}),
+    }
+    if report is None:
+        report = {}
+    report['steps'] = {}
+    report['skipped'] = []
+    started = time.perf_counter()
+
+    for attempt in range(2):
+        state = _get_checkout_state(api_token)
+        for chain in CHECKOUT_CHAINS:
+            chain_changed = False
+            for step in chain:
+                func, kwargs = steps[step]
+                if not chain_changed and state.get(step) == kwargs:
+                    report['skipped'].append(step)
+                    continue
+                chain_changed = True
+                step_started = time.perf_counter()
+                await func(s, api_token, website, **kwargs)
+                report['steps'][step] = time.perf_counter() - step_started
+                state[step] = kwargs
+
+        # Новый заказ по содержимому корзины.
+        step_started = time.perf_counter()
+        try:
+            order_id = await order_add(s, api_token, website)
+        except KeyError:
+            # Сессия OpenCart потеряла что-то из пропущенных шагов
+            # (истекла или корзину меняли в обход бота).
+            forget_checkout_state(api_token)
+            if attempt or not report['skipped']:
+                raise
+            logger.warning('create_order: повтор оформления без пропусков')
+            report['skipped'] = []
+            continue
+        finally:
+            report['steps']['order_add'] = (time.perf_counter()
+                                            - step_started)
+        break
+
+    # После заказа корзина очищается, а с ней и методы.
+    forget_checkout_state(api_token, CART_DEPENDENT_STEPS)
+    report['total'] = time.perf_counter() - started
+    logger.info(f'create_order: заказ {order_id}, '
+                f'время шагов {report["steps"]}, '
+                f'пропущены {report["skipped"]}, '
+                f'всего {report["total"]:.3f} сек.')
+    return order_id
@@ -0,0 +1,155 @@
+"""
+Зеркало корзин OpenCart в Redis.
+
+Корзина OpenCart привязана к api-сессии, и узнать, сколько товара
+в ней лежит, можно только запросом api/cart/products. Зеркало хранит
+количество товаров корзины чата по product_id и обновляется вместе
+с cart_add/cart_edit/cart_remove, поэтому карточке товара не нужен
+запрос к OpenCart.
+
+Ключи чата:
+    cart:<chat_id>       - {product_id: количество};
+    cart:<chat_id>:ids   - {cart_id: product_id}, нужен для cart_edit
+                           и cart_remove, которые работают с cart_id;
+    cart:<chat_id>:meta  - api_token и время последней сверки.
+
+Зеркало сверяется с OpenCart при показе корзины, а также если оно
+старше max_age секунд или было сверено для другого api_token (новый
+токен - новая api-сессия и новая, пустая корзина OpenCart).
+"""
+import logging
+import time
+
+
+logger = logging.getLogger('tg_bot.oc_cart')
+
+
+class CartMirror():
+    """
+    Зеркало корзин OpenCart в Redis.
+
+    ttl - сколько секунд хранить зеркало простаивающего чата (не дольше,
+    чем живет api-сессия OpenCart), max_age - через сколько секунд после
+    сверки зеркало снова сверяется с OpenCart.
+    """
+
+    def __init__(self, db, ttl=3600, max_age=300):
+        """Инициализировать атрибуты данных."""
+        self.db = db
+        self.ttl = ttl
+        self.max_age = max_age
+        self._metrics = {
+            'hits': 0,
+            'stale': 0,
+            'reconciled': 0,
+            'drifted': 0,
+        }
+
+    @staticmethod
+    def _keys(chat_id):
+        key = f'cart:{chat_id}'
+        return key, f'{key}:ids', f'{key}:meta'
+
+    def _expire(self, pipe, chat_id):
+        for key in self._keys(chat_id):
+            pipe.expire(key, self.ttl)
+
+    def is_synced(self, chat_id, api_token):
+        """Можно ли верить зеркалу без запроса к OpenCart."""
+        _, _, meta_key = self._keys(chat_id)
+        meta = self.db.hgetall(meta_key)
+        synced = (meta.get('api_token') == str(api_token)
+                  and time.time() - float(meta.get('synced_at', 0))
+                  < self.max_age)
+        if not synced:
+            self._metrics['stale'] += 1
+        return synced
+
+    def _read(self, chat_id):
+        cart_key, _, _ = self._keys(chat_id)
+        return {int(product_id): int(quantity) for product_id, quantity
+                in self.db.hgetall(cart_key).items()}
+
+    def get(self, chat_id):
+        """Содержимое корзины: {product_id: количество}."""
+        self._metrics['hits'] += 1
+        return self._read(chat_id)
+
+    def quantity(self, chat_id, product_id):
+        """Сколько товара product_id лежит в корзине чата."""
+        cart_key, _, _ = self._keys(chat_id)
+        self._metrics['hits'] += 1
+        return int(self.db.hget(cart_key, product_id) or 0)
+
+    def add(self, chat_id, product_id, quantity):
+        """Учесть api/cart/add."""
+        cart_key, _, _ = self._keys(chat_id)
+        with self.db.pipeline() as pipe:
+            pipe.hincrby(cart_key, product_id, int(quantity))
+            self._expire(pipe, chat_id)
+            pipe.execute()
+
+    def edit(self, chat_id, cart_id, quantity):
+        """Учесть api/cart/edit."""
+        cart_key, ids_key, _ = self._keys(chat_id)
+        product_id = self.db.hget(ids_key, cart_id)
+        if product_id is None:
+            # cart_id еще не видели: поправит ближайшая сверка.
+            return
+        if int(quantity) <= 0:
+            return self.remove(chat_id, cart_id)
+        with self.db.pipeline() as pipe:
+            pipe.hset(cart_key, product_id, int(quantity))
+            self._expire(pipe, chat_id)
+            pipe.execute()
+
+    def remove(self, chat_id, cart_id):
+        """Учесть api/cart/remove."""
+        cart_key, ids_key, _ = self._keys(chat_id)
+        product_id = self.db.hget(ids_key, cart_id)
+        if product_id is None:
+            return
+        with self.db.pipeline() as pipe:
+            pipe.hdel(cart_key, product_id)
+            pipe.hdel(ids_key, cart_id)
+            pipe.execute()
+
+    def reconcile(self, chat_id, api_token, cart_content):
+        """Заменить зеркало ответом api/cart/products.
+
+        Возвращает True, если зеркало расходилось с OpenCart.
+        """
+        cart_key, ids_key, meta_key = self._keys(chat_id)
+        quantities = {}
+        cart_ids = {}
+        for product in cart_content.get('products') or []:
+            product_id = int(product['product_id'])
+            # Один товар с разными опциями - несколько строк корзины.
+            quantities[product_id] = (quantities.get(product_id, 0)
+                                      + int(product['quantity']))
+            cart_ids[product['cart_id']] = product_id
+
+        drifted = self._read(chat_id) != quantities
+        self._metrics['reconciled'] += 1
+        if drifted:
+            self._metrics['drifted'] += 1
+            logger.debug(f'Корзина чата {chat_id} расходилась с OpenCart')
+
+        with self.db.pipeline() as pipe:
+            pipe.delete(cart_key, ids_key)
+            if quantities:
+                pipe.hset(cart_key, mapping=quantities)
+                pipe.hset(ids_key, mapping=cart_ids)
+            pipe.hset(meta_key, mapping={'api_token': str(api_token),
+                                         'synced_at': time.time()})
+            self._expire(pipe, chat_id)
+            pipe.execute()
+        return drifted
+
+    def forget(self, chat_id):
+        """Удалить зеркало корзины чата (например, после заказа)."""
+        self.db.delete(*self._keys(chat_id))
+
+    def stats(self):
+        """Метрики зеркала."""
+        return dict(self._metrics)
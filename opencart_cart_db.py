@@ -0,0 +1,229 @@
+"""
+Корзина OpenCart напрямую в БД.
+
+Каждый запрос api/cart/* - это полный запуск PHP-приложения OpenCart.
+DatabaseCart читает и пишет ту же таблицу oc_cart, что и API, теми же
+значениями api_id, customer_id и session_id (session_id api-сессии -
+это api_token), поэтому корзину, собранную через БД, видят
+api/order/add и остальные маршруты API.
+
+Функции DatabaseCart повторяют сигнатуры и ответы cart_add, cart_edit,
+cart_remove и get_cart_products из opencart_api_async, так что бот
+может брать корзину из любого из двух бэкендов. Цены считаются
+по oc_product и oc_product_special, без налогов, скидок за количество,
+опций и купонов: для магазина без них ответы совпадают с API.
+
+Запросы к БД не продлевают api-сессию OpenCart, поэтому функции
+корзины помечены как local_call: TokenManager не считает их
+использованием токена. Если токен все же сменился, move_cart
+переносит строки oc_cart со старого session_id на новый.
+"""
+import logging
+
+import opencart_api_async as api_async
+
+from opencart_db import get_pool, run_in_db_executor
+
+
+logger = logging.getLogger('tg_bot.oc_cart_db')
+
+
+def local_call(func):
+    """Пометить функцию корзины, не обращающуюся к API OpenCart."""
+    func.extends_api_session = False
+    return func
+
+
+class DatabaseCart():
+    """
+    Бэкенд корзины OpenCart на прямых запросах к БД.
+
+    api_username - имя пользователя API, от которого бот логинится
+    (по нему находится api_id), customer_group_id - группа покупателей
+    для специальных цен, price_format - формат цены в ответе.
+    """
+
+    products_query = (
+        'SELECT c.cart_id, c.product_id, c.quantity, '
+        'pd.name, p.model, p.quantity, p.shipping, p.points, '
+        'COALESCE((SELECT ps.price FROM oc_product_special as ps '
+        'WHERE ps.product_id = p.product_id '
+        'AND ps.customer_group_id = %s '
+        "AND (ps.date_start = '0000-00-00' OR ps.date_start < NOW()) "
+        "AND (ps.date_end = '0000-00-00' OR ps.date_end > NOW()) "
+        'ORDER BY ps.priority ASC, ps.price ASC LIMIT 1), p.price) '
+        'FROM oc_cart as c '
+        'JOIN oc_product as p on p.product_id = c.product_id '
+        'left JOIN oc_product_description as pd '
+        'on pd.product_id = p.product_id '
+        'WHERE c.api_id = %s AND c.customer_id = 0 AND c.session_id = %s '
+        'AND p.status = 1 '
+        'ORDER BY c.cart_id')
+
+    def __init__(self, user, password, host, database, api_username,
+                 customer_group_id=1, price_format='{:.2f}р.'):
+        """Инициализировать атрибуты данных."""
+        self.pool = get_pool(user, password, host, database)
+        self.api_username = api_username
+        self.customer_group_id = customer_group_id
+        self.price_format = price_format
+        self._api_id = None
+
+    def format_price(self, value):
+        """Цена в формате ответа api/cart/products."""
+        return self.price_format.format(value)
+
+    def _get_api_id(self, cursor):
+        if self._api_id is None:
+            cursor.execute('SELECT api_id FROM oc_api WHERE username = %s',
+                           (self.api_username,))
+            row = cursor.fetchone()
+            if row is None:
+                raise api_async.OpenCartApiError(
+                    f'Нет пользователя API {self.api_username}')
+            self._api_id = row[0]
+        return self._api_id
+
+    def _add(self, api_token, product_id, quantity):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            api_id = self._get_api_id(cursor)
+            cursor.execute('SELECT product_id FROM oc_product '
+                           'WHERE product_id = %s AND status = 1',
+                           (product_id,))
+            if cursor.fetchone() is None:
+                cursor.close()
+                return 0
+            # Как Cart::add() в OpenCart: та же строка без опций -
+            # увеличить количество, иначе добавить новую.
+            cursor.execute(
+                'UPDATE oc_cart SET quantity = quantity + %s '
+                'WHERE api_id = %s AND customer_id = 0 AND session_id = %s '
+                "AND product_id = %s AND recurring_id = 0 AND `option` = '[]'",
+                (quantity, api_id, api_token, product_id))
+            if not cursor.rowcount:
+                cursor.execute(
+                    'INSERT INTO oc_cart (api_id, customer_id, session_id, '
+                    'product_id, recurring_id, `option`, quantity, '
+                    'date_added) '
+                    "VALUES (%s, 0, %s, %s, 0, '[]', %s, NOW())",
+                    (api_id, api_token, product_id, quantity))
+            added = cursor.rowcount
+            cursor.close()
+        return added
+
+    def _edit(self, api_token, cart_id, quantity):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            api_id = self._get_api_id(cursor)
+            cursor.execute(
+                'UPDATE oc_cart SET quantity = %s WHERE cart_id = %s '
+                'AND api_id = %s AND customer_id = 0 AND session_id = %s',
+                (quantity, cart_id, api_id, api_token))
+            cursor.close()
+
+    def _remove(self, api_token, cart_id):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            api_id = self._get_api_id(cursor)
+            cursor.execute(
+                'DELETE FROM oc_cart WHERE cart_id = %s '
+                'AND api_id = %s AND customer_id = 0 AND session_id = %s',
+                (cart_id, api_id, api_token))
+            cursor.close()
+
+    def _move(self, old_token, new_token):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            api_id = self._get_api_id(cursor)
+            cursor.execute(
+                'UPDATE oc_cart SET session_id = %s '
+                'WHERE api_id = %s AND customer_id = 0 AND session_id = %s',
+                (new_token, api_id, old_token))
+            moved = cursor.rowcount
+            cursor.close()
+        return moved
+
+    def _products(self, api_token):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            api_id = self._get_api_id(cursor)
+            cursor.execute(self.products_query,
+                           (self.customer_group_id, api_id, api_token))
+            rows = cursor.fetchall()
+            cursor.close()
+
+        products = []
+        sub_total = 0
+        for (cart_id, product_id, quantity, name, model, stock,
+                shipping, points, price) in rows:
+            total = float(price) * quantity
+            sub_total += total
+            products.append({
+                'cart_id': str(cart_id),
+                'product_id': str(product_id),
+                'name': name,
+                'model': model,
+                'option': [],
+                'quantity': str(quantity),
+                'stock': stock >= quantity,
+                'shipping': str(shipping),
+                'price': self.format_price(float(price)),
+                'total': self.format_price(total),
+                'reward': points * quantity,
+            })
+        return {
+            'products': products,
+            'vouchers': [],
+            'totals': [
+                {'title': 'Сумма', 'text': self.format_price(sub_total)},
+                {'title': 'Итого', 'text': self.format_price(sub_total)},
+            ],
+        }
+
+    @local_call
+    async def cart_add(self, session, api_token, product_id, website,
+                       quantity='1', timeout=None):
+        """ Добавляем товар в корзину."""
+        added = await run_in_db_executor(self._add, api_token,
+                                         int(product_id), int(quantity))
+        logger.debug(f'cart_add: {product_id} x {quantity}, '
+                     f'строк изменено - {added}')
+        if not added:
+            raise api_async.CartError(
+                f'cart_add {product_id}: товар не найден или отключен')
+        api_async.forget_checkout_state(api_token,
+                                        api_async.CART_DEPENDENT_STEPS)
+
+    @local_call
+    async def cart_edit(self, session, api_token, cart_id, website, quantity,
+                        timeout=None):
+        """Изменяем кол-во товара в корзине. (key = cart_id)"""
+        await run_in_db_executor(self._edit, api_token, int(cart_id),
+                                 int(quantity))
+        api_async.forget_checkout_state(api_token,
+                                        api_async.CART_DEPENDENT_STEPS)
+        logger.debug(f'cart_edit: {cart_id} x {quantity}')
+
+    @local_call
+    async def cart_remove(self, session, api_token, cart_id, website,
+                          timeout=None):
+        """Удаляем товар из корзины. (key = cart_id)"""
+        await run_in_db_executor(self._remove, api_token, int(cart_id))
+        api_async.forget_checkout_state(api_token,
+                                        api_async.CART_DEPENDENT_STEPS)
+        logger.debug(f'cart_remove: {cart_id}')
+
+    @local_call
+    async def get_cart_products(self, session, api_token, website,
+                                timeout=None):
+        """Содержимое корзины."""
+        cart_content = await run_in_db_executor(self._products, api_token)
+        logger.debug(f'cart_content: {cart_content}')
+        return cart_content
+
+    async def move_cart(self, old_token, new_token):
+        """Перенести корзину api-сессии old_token в сессию new_token."""
+        moved = await run_in_db_executor(self._move, old_token, new_token)
+        logger.debug(f'move_cart: перенесено строк - {moved}')
+        return moved
@@ -0,0 +1,238 @@
+"""
+Справочник доставщиков пиццерий.
+
+Доставщик - покупатель OpenCart из группы, названной как пиццерия
+(oc_customer_group_description.name = oc_location.name). Его Telegram
+ID лежит в custom_field - JSON, который пишет OpenCart. Справочник
+загружается одним запросом и перечитывается раз в max_staleness секунд
+или по refresh(). Если у пиццерии несколько доставщиков, заказы
+распределяются между ними по очереди (round_robin) или достаются
+наименее загруженному (least_loaded).
+
+Состояние распределения хранится в Redis, чтобы его видели все
+процессы бота:
+    couriers:turn:<группа>   - счетчик очереди пиццерии;
+    couriers:orders:<id>     - sorted set заказов доставщика по времени
+                               назначения, нагрузка - заказы за
+                               последние load_window секунд.
+"""
+import json
+import logging
+import time
+
+from opencart_db import get_pool, get_snapshot_cache, run_in_db_executor
+
+
+logger = logging.getLogger('tg_bot.oc_couriers')
+
+STRATEGIES = ('round_robin', 'least_loaded')
+# Не чаще раза в столько секунд перечитывать справочник из-за
+# пиццерии, для которой нет доставщиков.
+MISS_REFRESH_INTERVAL = 10
+
+
+def parse_courier_id(custom_field, field_id=None):
+    """
+    Telegram ID доставщика из oc_customer.custom_field.
+
+    field_id - номер настраиваемого поля OpenCart с Telegram ID. Если он
+    не задан, берется первое непустое поле.
+    """
+    try:
+        fields = json.loads(custom_field or '{}')
+    except json.JSONDecodeError as err:
+        raise ValueError(f'custom_field не JSON: {custom_field!r}') from err
+    if not isinstance(fields, dict):
+        raise ValueError(f'custom_field не объект: {custom_field!r}')
+
+    if field_id is not None:
+        values = [fields.get(str(field_id))]
+    else:
+        values = list(fields.values())
+    for value in values:
+        if isinstance(value, (str, int)) and str(value).strip():
+            return str(value).strip()
+    raise ValueError(f'Нет Telegram ID в custom_field: {custom_field!r}')
+
+
+class CourierSnapshot():
+    """Неизменяемый снимок: пиццерия -> группа и доставщики."""
+
+    __slots__ = ('stores', 'couriers', 'skipped')
+
+    def __init__(self, stores, skipped=0):
+        """Инициализировать атрибуты данных."""
+        # name -> {'group_id': ..., 'couriers': (telegram_id, ...)}
+        self.stores = stores
+        self.couriers = sum(len(store['couriers'])
+                            for store in stores.values())
+        # Сколько доставщиков пропущено из-за custom_field без ID.
+        self.skipped = skipped
+
+    def __len__(self):
+        return len(self.stores)
+
+
+class CourierDirectory():
+    """
+    Выбор доставщика для заказа из пиццерии.
+
+    db - соединение с Redis, strategy - round_robin или least_loaded,
+    field_id - номер поля custom_field с Telegram ID (см.
+    parse_courier_id), load_window - за сколько секунд считать заказы
+    при выборе наименее загруженного.
+    """
+
+    query = (
+        'SELECT cgd.customer_group_id, cgd.name, c.custom_field '
+        'FROM oc_customer AS c '
+        'JOIN oc_customer_group_description AS cgd '
+        'ON cgd.customer_group_id = c.customer_group_id '
+        'JOIN oc_location AS l ON l.name = cgd.name '
+        'WHERE c.status = 1 '
+        'ORDER BY c.customer_id')
+
+    def __init__(self, user, password, host, database, db,
+                 strategy='round_robin', field_id=None,
+                 max_staleness=300, load_window=3600):
+        """Инициализировать атрибуты данных."""
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Неизвестная стратегия: {strategy}')
+        self.pool = get_pool(user, password, host, database)
+        self.db = db
+        self.strategy = strategy
+        self.field_id = field_id
+        self.load_window = load_window
+        # Справочник общий для всех экземпляров CourierDirectory одной
+        # БД. Отпечатка нет: устаревший справочник просто перечитывается.
+        self.cache = get_snapshot_cache(('couriers', host, database),
+                                        self.pool, None, self._load_snapshot,
+                                        max_staleness)
+
+    def _load_snapshot(self, cursor):
+        cursor.execute(self.query)
+        stores = {}
+        skipped = 0
+        for group_id, name, custom_field in cursor:
+            store = stores.setdefault(name, {'group_id': group_id,
+                                             'couriers': []})
+            try:
+                courier_id = parse_courier_id(custom_field, self.field_id)
+            except ValueError as err:
+                # Без Telegram ID заказ доставщику не отправить.
+                logger.warning(f'Доставщик пиццерии {name}: {err}')
+                skipped += 1
+                continue
+            # Группа может быть описана на нескольких языках.
+            if courier_id not in store['couriers']:
+                store['couriers'].append(courier_id)
+        for store in stores.values():
+            store['couriers'] = tuple(store['couriers'])
+        snapshot = CourierSnapshot(stores, skipped)
+        logger.info(f'Загружено доставщиков: {snapshot.couriers} '
+                    f'в пиццериях: {len(snapshot)}')
+        return snapshot
+
+    def _is_fresh(self):
+        return self.cache.is_fresh()
+
+    def get_snapshot(self, force=False):
+        """Актуальный снимок справочника."""
+        return self.cache.get(force)
+
+    def refresh(self):
+        """Перечитать справочник, не дожидаясь max_staleness."""
+        return self.get_snapshot(force=True)
+
+    def store(self, store_name):
+        """Группа и доставщики пиццерии из одного снимка или None."""
+        store = self.get_snapshot().stores.get(store_name)
+        if store is None or not store['couriers']:
+            age = self.cache.age()
+            if age is not None and age >= MISS_REFRESH_INTERVAL:
+                # Доставщика могли только что добавить.
+                store = self.refresh().stores.get(store_name)
+        return store
+
+    def couriers(self, store_name):
+        """Telegram ID доставщиков пиццерии."""
+        store = self.store(store_name)
+        return store['couriers'] if store else ()
+
+    def loads(self, couriers):
+        """Число заказов каждого доставщика за load_window секунд."""
+        since = time.time() - self.load_window
+        with self.db.pipeline() as pipe:
+            for courier_id in couriers:
+                key = f'couriers:orders:{courier_id}'
+                pipe.zremrangebyscore(key, '-inf', since)
+                pipe.zcard(key)
+            replies = pipe.execute()
+        return dict(zip(couriers, replies[1::2]))
+
+    def pick(self, store_name):
+        """Telegram ID доставщика для заказа или None, если их нет."""
+        # Доставщики и группа - из одного снимка: между двумя чтениями
+        # справочник мог обновить другой поток.
+        store = self.store(store_name)
+        if store is None or not store['couriers']:
+            self.cache.counters['misses'] += 1
+            logger.warning(f'Нет доставщиков пиццерии {store_name}')
+            return None
+
+        self.cache.counters['picks'] += 1
+        couriers = store['couriers']
+        if len(couriers) == 1:
+            return couriers[0]
+        turn = (self.db.incr(f'couriers:turn:{store["group_id"]}')
+                % len(couriers))
+        couriers = couriers[turn:] + couriers[:turn]
+        if self.strategy == 'least_loaded':
+            # При равной нагрузке min берет первого, а очередь
+            # сдвигается - так равные доставщики чередуются.
+            loads = self.loads(couriers)
+            return min(couriers, key=loads.get)
+        return couriers[0]
+
+    def _in_snapshot(self, store_name):
+        # Без запросов к БД обойдется, только если снимок свежий и у
+        # пиццерии есть доставщики: иначе store() его обновит.
+        if not self._is_fresh():
+            return False
+        store = self.cache.snapshot.stores.get(store_name)
+        return store is not None and bool(store['couriers'])
+
+    async def couriers_async(self, store_name):
+        """Асинхронный вариант couriers."""
+        if self._in_snapshot(store_name):
+            return self.couriers(store_name)
+        return await run_in_db_executor(self.couriers, store_name)
+
+    async def pick_async(self, store_name):
+        """Асинхронный вариант pick: БД читается в отдельном потоке."""
+        if self._in_snapshot(store_name):
+            return self.pick(store_name)
+        return await run_in_db_executor(self.pick, store_name)
+
+    def assigned(self, courier_id, order_id):
+        """Учесть заказ, переданный доставщику, в его нагрузке."""
+        key = f'couriers:orders:{courier_id}'
+        with self.db.pipeline() as pipe:
+            pipe.zadd(key, {order_id: time.time()})
+            pipe.expire(key, self.load_window)
+            pipe.execute()
+        self.cache.counters['assigned'] += 1
+
+    def stats(self):
+        cache = self.cache
+        snapshot = cache.snapshot
+        return {
+            'stores': len(snapshot) if snapshot else 0,
+            'couriers': snapshot.couriers if snapshot else 0,
+            'refreshes': cache.refreshes,
+            'skipped': snapshot.skipped if snapshot else 0,
+            'picks': cache.counters['picks'],
+            'misses': cache.counters['misses'],
+            'assigned': cache.counters['assigned'],
+            'age': cache.age(),
+        }
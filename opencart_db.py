@@ -0,0 +1,365 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import mysql.connector
+
+
+logger = logging.getLogger('tg_bot.oc_db')
+
+# Пулы соединений, общие для всех модулей бота.
+# Ключ - (user, host, database).
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Ограниченный пул потоков для блокирующих запросов к БД из asyncio.
+_executor = None
+_executor_lock = threading.Lock()
+
+# Кэши снимков, общие для всех экземпляров классов, которые их читают.
+_snapshot_caches = {}
+_snapshot_caches_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    """Не дождались свободного соединения из пула."""
+
+
+class ConnectionPool():
+    """
+    Ограниченный по размеру пул соединений с БД OpenCart.
+
+    Соединения создаются по мере надобности, но не больше size.
+    Простаивающие дольше max_idle секунд соединения закрываются,
+    а соединения, не использовавшиеся дольше health_check_interval
+    секунд, перед выдачей проверяются пингом.
+    """
+
+    def __init__(self, user, password, host, database, size=5, timeout=10,
+                 max_idle=300, health_check_interval=30, connect=None):
+        """Инициализировать атрибуты данных."""
+        self.user = user
+        self.password = password
+        self.host = host
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self._connect = connect or self._mysql_connect
+        self._idle = deque()
+        self._created = 0
+        self._condition = threading.Condition()
+        self._metrics = {
+            'acquired': 0,
+            'created': 0,
+            'closed': 0,
+            'evicted': 0,
+            'failed_health_checks': 0,
+            'timeouts': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+    def _mysql_connect(self):
+        return mysql.connector.connect(user=self.user,
+                                       password=self.password,
+                                       host=self.host,
+                                       database=self.database,
+                                       autocommit=True)
+
+    def _close(self, cnx):
+        self._metrics['closed'] += 1
+        try:
+            cnx.close()
+        except Exception as err:
+            logger.debug(f'Ошибка закрытия соединения: {err}')
+
+    def _is_healthy(self, cnx):
+        try:
+            return cnx.is_connected()
+        except Exception:
+            return False
+
+    def evict_idle(self):
+        """Закрыть соединения, простаивающие дольше max_idle секунд."""
+        now = time.monotonic()
+        evicted = []
+        with self._condition:
+            # Слева лежат самые давно использованные соединения.
+            while self._idle and now - self._idle[0][1] > self.max_idle:
+                evicted.append(self._idle.popleft()[0])
+                self._created -= 1
+            if evicted:
+                self._condition.notify(len(evicted))
+        for cnx in evicted:
+            self._metrics['evicted'] += 1
+            self._close(cnx)
+        return len(evicted)
+
+    def acquire(self):
+        """Взять соединение из пула, при необходимости подождав его."""
+        self.evict_idle()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            cnx = None
+            with self._condition:
+                while not self._idle and self._created >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._metrics['timeouts'] += 1
+                        raise PoolTimeout(
+                            f'Нет свободных соединений с БД '
+                            f'{self.database} за {self.timeout} сек.')
+                    self._condition.wait(remaining)
+                if self._idle:
+                    # Берем последнее возвращенное - оно "самое живое".
+                    cnx, last_used = self._idle.pop()
+                else:
+                    self._created += 1
+
+            if cnx is None:
+                try:
+                    cnx = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._created -= 1
+                        self._condition.notify()
+                    raise
+                self._metrics['created'] += 1
+            elif (time.monotonic() - last_used > self.health_check_interval
+                    and not self._is_healthy(cnx)):
+                self._metrics['failed_health_checks'] += 1
+                self._discard(cnx)
+                continue
+
+            waited = time.monotonic() - started
+            with self._condition:
+                self._metrics['acquired'] += 1
+                self._metrics['wait_total'] += waited
+                self._metrics['wait_max'] = max(self._metrics['wait_max'],
+                                                waited)
+            return cnx
+
+    def release(self, cnx):
+        """Вернуть соединение в пул."""
+        with self._condition:
+            self._idle.append((cnx, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, cnx):
+        """Закрыть соединение, не возвращая его в пул."""
+        with self._condition:
+            self._created -= 1
+            self._condition.notify()
+        self._close(cnx)
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула на время блока with.
+
+        Если в блоке возникло исключение, соединение закрывается,
+        чтобы не вернуть в пул соединение в неизвестном состоянии.
+        """
+        cnx = self.acquire()
+        try:
+            yield cnx
+        except BaseException:
+            self._discard(cnx)
+            raise
+        else:
+            self.release(cnx)
+
+    def stats(self):
+        """Метрики пула."""
+        with self._condition:
+            idle = len(self._idle)
+            created = self._created
+        stats = dict(self._metrics)
+        stats['size'] = self.size
+        stats['open'] = created
+        stats['idle'] = idle
+        stats['in_use'] = created - idle
+        stats['wait_avg'] = (stats['wait_total'] / stats['acquired']
+                             if stats['acquired'] else 0.0)
+        return stats
+
+    def close(self):
+        """Закрыть все простаивающие соединения."""
+        with self._condition:
+            idle = [cnx for cnx, _ in self._idle]
+            self._idle.clear()
+            self._created -= len(idle)
+            self._condition.notify_all()
+        for cnx in idle:
+            self._close(cnx)
+
+
+class SnapshotCache():
+    """
+    Снимок данных OpenCart, общий для всех потоков.
+
+    Пока снимок моложе max_staleness секунд, БД не проверяется вовсе.
+    Затем выполняется fingerprint_query: если его результат ("отпечаток")
+    не изменился, снимок остается прежним, иначе load(cursor) строит
+    новый. Без fingerprint_query устаревший снимок перечитывается
+    всегда.
+    """
+
+    def __init__(self, pool, fingerprint_query, load, max_staleness):
+        """Инициализировать атрибуты данных."""
+        self.pool = pool
+        self.fingerprint_query = fingerprint_query
+        self.load = load
+        self.max_staleness = max_staleness
+        self.snapshot = None
+        self.fingerprint = None
+        # Когда снимок последний раз сверялся с БД.
+        self.checked_at = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.checks = 0
+        self.refreshes = 0
+        # Счетчики тех, кто пользуется снимком (поиски, выборы и т.п.):
+        # экземпляров много, а считать нужно по всему кэшу.
+        self.counters = Counter()
+
+    def age(self):
+        """Сколько секунд назад снимок сверялся с БД (None - не сверялся)."""
+        checked_at = self.checked_at
+        if self.snapshot is None or checked_at is None:
+            return None
+        return time.monotonic() - checked_at
+
+    def is_fresh(self):
+        """Можно ли отдать снимок без обращения к БД."""
+        age = self.age()
+        return age is not None and age < self.max_staleness
+
+    def get(self, force=False):
+        """Актуальный снимок. force - перечитать, не проверяя отпечаток."""
+        if not force and self.is_fresh():
+            self.hits += 1
+            return self.snapshot
+
+        with self.lock:
+            # Пока ждали блокировку, снимок мог обновить другой поток.
+            if not force and self.is_fresh():
+                self.hits += 1
+                return self.snapshot
+
+            with self.pool.connection() as cnx:
+                cursor = cnx.cursor()
+                fingerprint = None
+                if self.fingerprint_query:
+                    cursor.execute(self.fingerprint_query)
+                    fingerprint = tuple(cursor.fetchone())
+                    self.checks += 1
+                    if (not force and self.snapshot is not None
+                            and fingerprint == self.fingerprint):
+                        cursor.close()
+                        self.checked_at = time.monotonic()
+                        self.hits += 1
+                        return self.snapshot
+                self.misses += 1
+                snapshot = self.load(cursor)
+                cursor.close()
+            # checked_at раньше snapshot: is_fresh читает их без
+            # блокировки.
+            self.checked_at = time.monotonic()
+            self.fingerprint = fingerprint
+            self.snapshot = snapshot
+            self.refreshes += 1
+        return snapshot
+
+    def stats(self):
+        """Счетчики попаданий, промахов и перечитываний."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'checks': self.checks,
+            'refreshes': self.refreshes,
+            'age': self.age(),
+        }
+
+
+def get_snapshot_cache(key, pool, fingerprint_query, load, max_staleness):
+    """Получить общий кэш снимка по ключу, создав его при первом вызове.
+
+    Если экземпляры просят разный max_staleness, действует наименьший.
+    """
+    with _snapshot_caches_lock:
+        cache = _snapshot_caches.get(key)
+        if cache is None:
+            cache = SnapshotCache(pool, fingerprint_query, load,
+                                  max_staleness)
+            _snapshot_caches[key] = cache
+        else:
+            cache.max_staleness = min(cache.max_staleness, max_staleness)
+        return cache
+
+
+def get_pool(user, password, host, database, **kwargs):
+    """Получить общий пул соединений для указанной БД.
+
+    Настройки пула (size, timeout, max_idle, health_check_interval)
+    учитываются только при первом вызове для этой БД.
+    """
+    key = (user, host, database)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(user, password, host, database,
+                                         **kwargs)
+        return _pools[key]
+
+
+def get_pools_stats():
+    """Метрики всех созданных пулов."""
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {f'{user}@{host}/{database}': pool.stats()
+            for (user, host, database), pool in pools}
+
+
+def evict_idle_connections():
+    """Закрыть простаивающие соединения во всех пулах."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return sum(pool.evict_idle() for pool in pools)
+
+
+def configure_db_executor(max_workers=5):
+    """Задать число потоков для запросов к БД из асинхронного кода.
+
+    Нет смысла делать потоков больше, чем соединений в пуле: лишние
+    потоки будут просто ждать соединение.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix='oc_db')
+    return _executor
+
+
+def get_db_executor():
+    """Получить пул потоков для запросов к БД."""
+    if _executor is None:
+        return configure_db_executor()
+    return _executor
+
+
+async def run_in_db_executor(func, *args, **kwargs):
+    """Выполнить блокирующую функцию работы с БД, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_db_executor(), functools.partial(func, *args, **kwargs))
@@ -1,4 +1,24 @@
-import mysql.connector
+from types import MappingProxyType
+
+from opencart_db import get_pool, get_snapshot_cache, run_in_db_executor
+
+
+class CatalogSnapshot():
+    """
+    Неизменяемый снимок каталога OpenCart.
+
+    Хранит товары, индексированные по product_id и по category_id.
+    """
+
+    __slots__ = ('products', 'product_ids', 'categories')
+
+    def __init__(self, products, product_ids, categories):
+        """Инициализировать атрибуты данных."""
+        self.products = MappingProxyType(products)
+        self.product_ids = tuple(product_ids)
+        self.categories = MappingProxyType(
+            {category_id: tuple(ids)
+             for category_id, ids in categories.items()})
 
 
 class OpenCartProducts():
@@ -6,13 +26,23 @@ class OpenCartProducts():
     Общий класс для получения данных о продуктах, хранящихся в БД OpenCart.
     """
 
+    # Снимок перечитывается только если изменились MAX(date_modified)
+    # или количество строк в oc_product (либо количество привязок
+    # товаров к категориям).
+    fingerprint_query = (
+        'SELECT (SELECT COUNT(*) FROM oc_product), '
+        '(SELECT MAX(date_modified) FROM oc_product), '
+        '(SELECT COUNT(*) FROM oc_product_to_category)')
+
     def __init__(
-            self, user, password, host, database, website):
+            self, user, password, host, database, website,
+            cache=True, max_staleness=30):
         """Инициализировать атрибуты данных."""
         self.user = user
         self.password = password
         self.host = host
         self.database = database
+        self.pool = get_pool(user, password, host, database)
         self.image_path = f'https://{website}/image/'
         self.query = ('SELECT p.product_id as id, '
                       'pd.name as name, '
@@ -24,86 +54,151 @@ class OpenCartProducts():
                       'left JOIN oc_product_description as pd '
                       'on pd.product_id = p.product_id')
 
+        self.cache = None
+        if cache:
+            # Снимок общий для всех экземпляров OpenCartProducts магазина.
+            self.cache = get_snapshot_cache(
+                ('catalog', host, database, website), self.pool,
+                self.fingerprint_query, self._load_snapshot, max_staleness)
+
+    def _make_product(self, id, name, price, quantity, image, description):
+        """Собрать словарь товара из строки запроса."""
+        product = {}
+        product['id'] = id
+        product['name'] = name
+        product['price'] = int(price)
+        product['quantity'] = quantity
+        product['image'] = self.image_path + image
+        product['description'] = description
+        return product
+
+    def _load_snapshot(self, cursor):
+        """Прочитать каталог целиком и построить индексы."""
+        cursor.execute(self.query)
+        products = {}
+        product_ids = []
+        for row in cursor:
+            product = MappingProxyType(self._make_product(*row))
+            if product['id'] not in products:
+                product_ids.append(product['id'])
+            products[product['id']] = product
+
+        cursor.execute('SELECT category_id, product_id '
+                       'FROM oc_product_to_category '
+                       'ORDER BY product_id')
+        categories = {}
+        for (category_id, product_id) in cursor:
+            if product_id in products:
+                categories.setdefault(category_id, []).append(product_id)
+
+        return CatalogSnapshot(products, product_ids, categories)
+
+    def _is_fresh(self):
+        """Можно ли отдать снимок без обращения к БД."""
+        return self.cache.is_fresh()
+
+    def get_snapshot(self, force=False):
+        """Получить актуальный снимок каталога."""
+        return self.cache.get(force)
+
+    def cache_stats(self):
+        """Счетчики кэша каталога (None, если кэш выключен)."""
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        snapshot = self.cache.snapshot
+        stats['products'] = len(snapshot.products) if snapshot else 0
+        return stats
+
     def get_my_product(self, id_my_product=None):
         """Получить данные определенного продукта."""
-        cnx = mysql.connector.connect(user=self.user,
-                                      password=self.password,
-                                      host=self.host,
-                                      database=self.database)
-        cursor = cnx.cursor()
-        cursor.execute(self.query)
-        product = {}
+        if self.cache is not None:
+            product = self.get_snapshot().products.get(id_my_product)
+            return dict(product) if product else {}
 
-        for (id, name, price, quantity, image, description) in cursor:
-            if id == id_my_product:
-                product['id'] = id
-                product['name'] = name
-                product['price'] = int(price)
-                product['quantity'] = quantity
-                product['image'] = self.image_path + image
-                product['description'] = description
-
-        cursor.close()
-        cnx.close()
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(f'{self.query} WHERE p.product_id = %s',
+                           (id_my_product,))
+            product = {}
+            for row in cursor:
+                product = self._make_product(*row)
+            cursor.close()
         return product
 
     def get_my_products(self, category_id=None):
         """Получить данные всех продуктов."""
-        cnx = mysql.connector.connect(user=self.user,
-                                      password=self.password,
-                                      host=self.host,
-                                      database=self.database)
-        cursor = cnx.cursor()
-
-        if category_id:
-            query_product_id = (
-                'SELECT product_id FROM oc_product_to_category '
-                f'WHERE category_id = {category_id}')
-            cursor.execute(query_product_id)
-            products_id = []
-            for product_id in cursor:
-                product_id = int(str(product_id).rstrip(',)').lstrip('('))
-                products_id.append(product_id)
-
-            products_id.sort()
-
-            products = []
-            for product_id in products_id:
-                query = ('SELECT p.product_id as id, '
-                         'pd.name as name, '
-                         'p.price as price, '
-                         'p.quantity as quantity,'
-                         'p.image as image, '
-                         'pd.description as description '
-                         'FROM oc_product as p '
-                         'left JOIN oc_product_description as pd '
-                         'on pd.product_id = p.product_id '
-                         f'where p.product_id = {product_id}')
-                cursor.execute(query)
-                for (id, name, price, quantity, image, description) in cursor:
-                    product = {}
-                    product['id'] = id
-                    product['name'] = name
-                    product['price'] = int(price)
-                    product['quantity'] = quantity
-                    product['image'] = self.image_path + image
-                    product['description'] = description
-
-                    products.append(product)
-
-        else:
-            cursor.execute(self.query)
-            products = []
-            for (id, name, price, quantity, image, description) in cursor:
-                product = {}
-                product['id'] = id
-                product['name'] = name
-                product['price'] = int(price)
-                product['quantity'] = quantity
-                product['image'] = self.image_path + image
-                product['description'] = description
-
-                products.append(product)
-        cursor.close()
-        cnx.close()
+        if self.cache is not None:
+            snapshot = self.get_snapshot()
+            if category_id:
+                product_ids = snapshot.categories.get(category_id, ())
+            else:
+                product_ids = snapshot.product_ids
+            return [dict(snapshot.products[product_id])
+                    for product_id in product_ids]
+
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            if category_id:
+                # Один запрос вместо отдельного запроса на каждый товар.
+                query = (f'{self.query} '
+                         'JOIN oc_product_to_category as pc '
+                         'on pc.product_id = p.product_id '
+                         'WHERE pc.category_id = %s '
+                         'ORDER BY p.product_id')
+                cursor.execute(query, (category_id,))
+            else:
+                cursor.execute(self.query)
+
+            products = [self._make_product(*row) for row in cursor]
+            cursor.close()
         return products
+
+    def get_products_by_ids(self, ids):
+        """Получить данные нескольких продуктов за один запрос.
+
+        Товары возвращаются в порядке ids, отсутствующие пропускаются.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+
+        if self.cache is not None:
+            products = self.get_snapshot().products
+            return [dict(products[product_id])
+                    for product_id in ids if product_id in products]
+
+        placeholders = ', '.join(['%s'] * len(ids))
+        query = f'{self.query} WHERE p.product_id IN ({placeholders})'
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(query, tuple(ids))
+            products = {}
+            for row in cursor:
+                product = self._make_product(*row)
+                products[product['id']] = product
+            cursor.close()
+        return [products[product_id]
+                for product_id in ids if product_id in products]
+
+    async def _run(self, method, *args):
+        """Выполнить метод в пуле потоков БД.
+
+        Если свежий снимок каталога уже в памяти, обращения к БД
+        не будет, и метод выполняется сразу в event loop.
+        """
+        if self.cache is not None and self._is_fresh():
+            return method(*args)
+        return await run_in_db_executor(method, *args)
+
+    async def get_my_product_async(self, id_my_product=None):
+        """Асинхронный вариант get_my_product."""
+        return await self._run(self.get_my_product, id_my_product)
+
+    async def get_my_products_async(self, category_id=None):
+        """Асинхронный вариант get_my_products."""
+        return await self._run(self.get_my_products, category_id)
+
+    async def get_products_by_ids_async(self, ids):
+        """Асинхронный вариант get_products_by_ids."""
+        return await self._run(self.get_products_by_ids, ids)
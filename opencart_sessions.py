@@ -0,0 +1,181 @@
+"""
+Реестр сессий OpenCart по чатам Telegram.
+
+У каждого чата своя aiohttp-сессия (свои cookies) и свой api_token
+(его хранит TokenManager), а TCP-соединения с магазином берутся из
+одного общего пула. Реестр ограничен по числу сессий: сессии,
+простаивающие дольше ttl секунд, и самые давно использованные при
+превышении max_sessions закрываются. api_token чата при этом остается
+в TokenManager, чтобы не потерять корзину его api-сессии.
+"""
+import logging
+import time
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+import opencart_api_async as api_async
+
+from opencart_tokens import TokenManager
+
+
+logger = logging.getLogger('tg_bot.oc_sessions')
+
+
+class ChatSession():
+    """Состояние OpenCart одного чата."""
+
+    __slots__ = ('chat_id', 'http', 'last_used', 'in_use')
+
+    def __init__(self, chat_id, http):
+        """Инициализировать атрибуты данных."""
+        self.chat_id = chat_id
+        self.http = http
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+
+class SessionRegistry():
+    """
+    Ограниченный реестр сессий OpenCart с вытеснением по LRU и TTL.
+
+    max_sessions - предел числа живых сессий (и тем самым памяти,
+    которую они занимают), ttl - сколько секунд хранить простаивающую
+    сессию. Сессии, занятые обработкой апдейта, не вытесняются.
+    """
+
+    def __init__(self, username, key, website, max_sessions=5000, ttl=3600,
+                 limit=20, keepalive_timeout=30,
+                 timeout=api_async.DEFAULT_TIMEOUT, max_logins=5,
+                 on_refresh=None):
+        """Инициализировать атрибуты данных."""
+        self.website = website
+        self.tokens = TokenManager(username, key, website, ttl=ttl,
+                                   max_logins=max_logins,
+                                   on_refresh=on_refresh)
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._connector = None
+        self._sessions = OrderedDict()
+        self._metrics = {
+            'created': 0,
+            'evicted_ttl': 0,
+            'evicted_lru': 0,
+        }
+        self._last_stats = (time.monotonic(), 0)
+
+    def _get_connector(self):
+        if self._connector is None or self._connector.closed:
+            self._connector = api_async.create_connector(
+                limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+        return self._connector
+
+    async def _close(self, chat):
+        # Токен остается в TokenManager: с ним в api-сессии OpenCart
+        # лежит корзина чата. Забывается только состояние оформления.
+        api_async.forget_checkout_state(self.tokens.token(chat.chat_id))
+        await chat.http.close()
+
+    async def evict(self):
+        """Закрыть просроченные сессии и лишние сессии сверх предела."""
+        now = time.monotonic()
+        evicted = []
+        # Слева лежат самые давно использованные сессии.
+        for chat in list(self._sessions.values()):
+            expired = now - chat.last_used > self.ttl
+            over_limit = (len(self._sessions) - len(evicted)
+                          > self.max_sessions)
+            if not expired and not over_limit:
+                break
+            if chat.in_use:
+                continue
+            evicted.append(chat)
+            if expired:
+                self._metrics['evicted_ttl'] += 1
+            else:
+                self._metrics['evicted_lru'] += 1
+
+        for chat in evicted:
+            del self._sessions[chat.chat_id]
+            await self._close(chat)
+        if evicted:
+            logger.debug(f'Вытеснено сессий OpenCart: {len(evicted)}')
+        return len(evicted)
+
+    async def _get(self, chat_id):
+        chat = self._sessions.get(chat_id)
+        if chat is not None and time.monotonic() - chat.last_used > self.ttl:
+            if not chat.in_use:
+                del self._sessions[chat_id]
+                self._metrics['evicted_ttl'] += 1
+                await self._close(chat)
+                chat = None
+
+        if chat is None:
+            http = api_async.create_session(connector=self._get_connector(),
+                                            timeout=self.timeout,
+                                            cookie_jar=aiohttp.CookieJar())
+            chat = ChatSession(chat_id, http)
+            self._sessions[chat_id] = chat
+            self._metrics['created'] += 1
+
+        self._sessions.move_to_end(chat_id)
+        chat.last_used = time.monotonic()
+        return chat
+
+    async def get_api_token(self, chat):
+        """Актуальный api_token сессии чата."""
+        return await self.tokens.get(chat.chat_id, chat.http)
+
+    async def call(self, chat, func, *args, **kwargs):
+        """Вызвать функцию opencart_api_async в сессии чата.
+
+        При недействительном api_token он обновляется, и вызов
+        повторяется один раз.
+        """
+        return await self.tokens.call(chat.chat_id, chat.http, func,
+                                      *args, **kwargs)
+
+    @asynccontextmanager
+    async def session(self, chat_id):
+        """Сессия чата на время обработки апдейта.
+
+        Пока блок with не завершился, сессия не будет вытеснена.
+        """
+        chat = await self._get(chat_id)
+        chat.in_use += 1
+        try:
+            await self.evict()
+            yield chat
+        finally:
+            chat.in_use -= 1
+            chat.last_used = time.monotonic()
+
+    def stats(self):
+        """Число живых сессий и частота вытеснения с прошлого вызова."""
+        now = time.monotonic()
+        evicted = self._metrics['evicted_ttl'] + self._metrics['evicted_lru']
+        last_time, last_evicted = self._last_stats
+        self._last_stats = (now, evicted)
+        stats = dict(self._metrics)
+        stats['live'] = len(self._sessions)
+        stats['in_use'] = sum(1 for chat in self._sessions.values()
+                              if chat.in_use)
+        stats['evictions_per_min'] = ((evicted - last_evicted)
+                                      / max(now - last_time, 1e-9) * 60)
+        stats['tokens'] = self.tokens.stats()
+        return stats
+
+    async def close(self):
+        """Закрыть все сессии и общий пул соединений."""
+        for chat in list(self._sessions.values()):
+            await self._close(chat)
+        self._sessions.clear()
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
@@ -0,0 +1,176 @@
+"""
+Индекс пунктов самовывоза (oc_location) для поиска ближайшего.
+
+Таблица oc_location читается один раз и хранится в виде массивов
+numpy с широтой и долготой в радианах. Поиск ближайших пунктов -
+векторная формула гаверсинусов по всем пунктам сразу, расстояние до
+нескольких лучших кандидатов затем уточняется геодезической формулой
+geopy, которой бот считал расстояния раньше. Индекс перечитывается,
+только если изменилось содержимое oc_location; пока он моложе
+max_staleness секунд, БД не проверяется вовсе.
+"""
+import logging
+import re
+
+import numpy as np
+
+from geopy import distance
+
+from opencart_db import get_pool, get_snapshot_cache, run_in_db_executor
+
+
+logger = logging.getLogger('tg_bot.oc_stores')
+
+EARTH_RADIUS_KM = 6371.0088
+# Сколько ближайших по гаверсинусам пунктов могут уточняться geopy
+# и с каким запасом на разницу сферы и эллипсоида.
+REFINE_CANDIDATES = 3
+SPHERE_ERROR = 0.01
+
+
+def parse_geocode(geocode):
+    """Строка "широта,долгота" из oc_location.geocode в пару float."""
+    parts = re.split(r'[,\s]+', (geocode or '').strip())
+    if len(parts) != 2:
+        raise ValueError(f'Некорректные координаты: {geocode!r}')
+    return float(parts[0]), float(parts[1])
+
+
+class StoreSnapshot():
+    """Неизменяемый снимок oc_location."""
+
+    __slots__ = ('names', 'points', 'positions', 'lat', 'lon', 'cos_lat',
+                 'skipped')
+
+    def __init__(self, names, coords, skipped=0):
+        """Инициализировать атрибуты данных."""
+        self.names = tuple(names)
+        self.points = tuple(coords)
+        self.positions = {name: position
+                          for position, name in enumerate(self.names)}
+        radians = np.radians(np.asarray(coords, dtype=np.float64)
+                             .reshape(-1, 2))
+        self.lat = np.ascontiguousarray(radians[:, 0])
+        self.lon = np.ascontiguousarray(radians[:, 1])
+        self.cos_lat = np.cos(self.lat)
+        # Сколько пунктов пропущено из-за некорректных координат.
+        self.skipped = skipped
+
+    def __len__(self):
+        return len(self.names)
+
+
+class StoreIndex():
+    """Поиск ближайших пунктов самовывоза."""
+
+    query = 'SELECT name, geocode FROM oc_location ORDER BY location_id'
+    fingerprint_query = (
+        'SELECT COUNT(*), '
+        'COALESCE(SUM(CRC32('
+        "CONCAT_WS('|', location_id, name, geocode))), 0) "
+        'FROM oc_location')
+
+    def __init__(self, user, password, host, database, max_staleness=60):
+        """Инициализировать атрибуты данных."""
+        self.pool = get_pool(user, password, host, database)
+        # Индекс общий для всех экземпляров StoreIndex одной БД.
+        self.cache = get_snapshot_cache(('stores', host, database),
+                                        self.pool, self.fingerprint_query,
+                                        self._load_snapshot, max_staleness)
+
+    def _load_snapshot(self, cursor):
+        cursor.execute(self.query)
+        names = []
+        coords = []
+        skipped = 0
+        for name, geocode in cursor:
+            try:
+                coords.append(parse_geocode(geocode))
+            except ValueError as err:
+                # Пункт без координат не участвует в поиске.
+                logger.warning(f'Пункт {name}: {err}')
+                skipped += 1
+                continue
+            names.append(name)
+        logger.info(f'Загружено пунктов самовывоза: {len(names)}')
+        return StoreSnapshot(names, coords, skipped)
+
+    def _is_fresh(self):
+        return self.cache.is_fresh()
+
+    def get_snapshot(self, force=False):
+        """Актуальный снимок oc_location."""
+        return self.cache.get(force)
+
+    def nearest(self, latitude, longitude, count=1):
+        """
+        count ближайших пунктов: [{'name': ..., 'distance': км}, ...].
+
+        Пункты отсортированы по расстоянию, формат словарей - как
+        у get_distance_to_stores в shop_tg_bot.
+        """
+        snapshot = self.get_snapshot()
+        self.cache.counters['lookups'] += 1
+        if not len(snapshot):
+            return []
+
+        lat = np.radians(float(latitude))
+        lon = np.radians(float(longitude))
+        # Гаверсинус без asin: порядок пунктов по нему тот же,
+        # что и по расстоянию.
+        haversine = (np.sin((snapshot.lat - lat) / 2) ** 2
+                     + np.cos(lat) * snapshot.cos_lat
+                     * np.sin((snapshot.lon - lon) / 2) ** 2)
+        candidates = max(count, REFINE_CANDIDATES)
+        if candidates < len(snapshot):
+            best = np.argpartition(haversine, candidates)[:candidates]
+        else:
+            best = np.arange(len(snapshot))
+        spherical = (2 * EARTH_RADIUS_KM
+                     * np.arcsin(np.sqrt(haversine[best])))
+        best = best[np.argsort(spherical)]
+        spherical.sort()
+
+        # На сфере расстояние отличается от геодезического не больше
+        # чем на 0.5%: geopy пересчитывает только тех кандидатов,
+        # которые могут оказаться ближе count-го.
+        limit = spherical[min(count, len(best)) - 1] * (1 + SPHERE_ERROR)
+        user_point = (float(latitude), float(longitude))
+        stores = [{
+            'name': snapshot.names[i],
+            'distance': distance.distance(snapshot.points[i],
+                                          user_point).km,
+        } for i, km in zip(best, spherical) if km <= limit]
+        stores.sort(key=lambda store: store['distance'])
+        return stores[:count]
+
+    def point(self, name):
+        """(широта, долгота) пункта или None, если его нет."""
+        snapshot = self.get_snapshot()
+        position = snapshot.positions.get(name)
+        if position is None:
+            return None
+        return snapshot.points[position]
+
+    async def nearest_async(self, latitude, longitude, count=1):
+        """Асинхронный вариант nearest.
+
+        Если индекс свежий, обращения к БД не будет, и поиск
+        выполняется сразу в event loop.
+        """
+        if self._is_fresh():
+            return self.nearest(latitude, longitude, count)
+        return await run_in_db_executor(self.nearest, latitude, longitude,
+                                        count)
+
+    def stats(self):
+        cache = self.cache
+        snapshot = cache.snapshot
+        return {
+            'stores': len(snapshot) if snapshot else 0,
+            'lookups': cache.counters['lookups'],
+            'checks': cache.checks,
+            'refreshes': cache.refreshes,
+            'skipped': snapshot.skipped if snapshot else 0,
+            'age': cache.age(),
+        }
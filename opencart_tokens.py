@@ -0,0 +1,180 @@
+"""
+Кэш api_token OpenCart с единственным обновлением на ключ.
+
+OpenCart продлевает api-сессию на час при каждом запросе к API, поэтому
+срок жизни токена считается от последнего использования. Токен, которому
+осталось жить меньше refresh_ahead секунд, обновляется заранее.
+Если токен нужен нескольким корутинам одновременно, в api/login уходит
+один запрос, а остальные ждут его результат.
+
+Вызовы, которые не ходят в API (функции с extends_api_session = False,
+например корзина в БД), сессию не продлевают и срок токена не сдвигают.
+
+Токены хранятся дольше aiohttp-сессий чатов: чат, сессию которого
+вытеснили, продолжает работать со своей api-сессией и корзиной в ней,
+а после истечения токена on_refresh получает старый токен. Кэш
+ограничен max_tokens ключами, первыми вытесняются давно не
+использованные.
+"""
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+
+import opencart_api_async as api_async
+
+
+logger = logging.getLogger('tg_bot.oc_tokens')
+
+
+class TokenManager():
+    """
+    Менеджер api_token OpenCart.
+
+    ttl - сколько секунд OpenCart хранит простаивающую api-сессию,
+    refresh_ahead - за сколько секунд до истечения обновлять токен,
+    max_logins - сколько запросов api/login может идти одновременно.
+    on_refresh(old_token, new_token), если задан, - корутина, которая
+    вызывается, когда токен ключа заменен новым. max_tokens - сколько
+    ключей хранить.
+    """
+
+    def __init__(self, username, key, website, ttl=3600, refresh_ahead=60,
+                 max_logins=5, on_refresh=None, max_tokens=100000):
+        """Инициализировать атрибуты данных."""
+        self.username = username
+        self.key = key
+        self.website = website
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.on_refresh = on_refresh
+        self.max_tokens = max_tokens
+        # {ключ: (api_token, время истечения)}, слева - давно не
+        # использованные.
+        self._tokens = OrderedDict()
+        # {ключ: asyncio.Future} - обновления, которые идут сейчас.
+        self._refreshing = {}
+        self._logins = asyncio.Semaphore(max_logins)
+        self._metrics = {
+            'hits': 0,
+            'logins': 0,
+            'login_errors': 0,
+            'shared_refreshes': 0,
+            'invalid_tokens': 0,
+            'evicted': 0,
+        }
+
+    async def _login(self, session):
+        async with self._logins:
+            api_token = await api_async.get_api_token(
+                session,
+                username=self.username,
+                key=self.key,
+                website=self.website)
+        self._metrics['logins'] += 1
+        if not api_token:
+            self._metrics['login_errors'] += 1
+            raise api_async.OpenCartApiError('api/login не вернул api_token')
+        return api_token
+
+    async def refresh(self, key, session, stale=None):
+        """Получить новый токен для ключа.
+
+        Если обновление для ключа уже идет, дождаться его. Если передан
+        stale, а токен в кэше уже другой, значит его обновил кто-то еще.
+        """
+        cached = self._tokens.get(key)
+        if stale is not None and cached and cached[0] != stale:
+            return cached[0]
+
+        future = self._refreshing.get(key)
+        if future is not None:
+            self._metrics['shared_refreshes'] += 1
+            return await asyncio.shield(future)
+
+        old_token = stale if stale is not None else (cached and cached[0])
+        future = asyncio.get_running_loop().create_future()
+        self._refreshing[key] = future
+        try:
+            api_token = await self._login(session)
+            if old_token and self.on_refresh is not None:
+                await self._on_refresh(old_token, api_token)
+        except BaseException as err:
+            future.set_exception(err)
+            # Исключение заберут ожидающие, если они есть.
+            future.exception()
+            raise
+        else:
+            self._store(key, api_token)
+            future.set_result(api_token)
+            return api_token
+        finally:
+            del self._refreshing[key]
+
+    def _store(self, key, api_token):
+        self._tokens[key] = (api_token, time.monotonic() + self.ttl)
+        self._tokens.move_to_end(key)
+        while len(self._tokens) > self.max_tokens:
+            _, (evicted, _) = self._tokens.popitem(last=False)
+            api_async.forget_checkout_state(evicted)
+            self._metrics['evicted'] += 1
+
+    async def _on_refresh(self, old_token, new_token):
+        try:
+            await self.on_refresh(old_token, new_token)
+        except Exception as err:
+            # Новый токен все равно годится, теряется только то,
+            # что было привязано к старой сессии.
+            logger.error(f'Перенос сессии на новый api_token: {err!r}')
+
+    async def get(self, key, session):
+        """Токен для ключа: из кэша или обновленный."""
+        cached = self._tokens.get(key)
+        if (cached is not None
+                and cached[1] - time.monotonic() > self.refresh_ahead):
+            self._metrics['hits'] += 1
+            return cached[0]
+        return await self.refresh(key, session)
+
+    def touch(self, key):
+        """Продлить срок жизни токена после успешного запроса."""
+        cached = self._tokens.get(key)
+        if cached is not None:
+            self._store(key, cached[0])
+
+    def token(self, key):
+        """Токен ключа из кэша (возможно, истекший) или None."""
+        cached = self._tokens.get(key)
+        return cached[0] if cached else None
+
+    def forget(self, key):
+        """Удалить токен ключа из кэша."""
+        return self._tokens.pop(key, (None, None))[0]
+
+    async def call(self, key, session, func, *args, **kwargs):
+        """Вызвать функцию opencart_api_async с актуальным токеном.
+
+        Если OpenCart ответил, что токен недействителен, токен
+        обновляется и вызов повторяется один раз.
+        """
+        api_token = await self.get(key, session)
+        try:
+            result = await func(session, api_token, *args, **kwargs)
+        except api_async.InvalidApiToken:
+            self._metrics['invalid_tokens'] += 1
+            logger.warning(f'Недействительный api_token для {key}, '
+                           f'обновляем и повторяем {func.__name__}')
+            api_async.forget_checkout_state(api_token)
+            api_token = await self.refresh(key, session, stale=api_token)
+            result = await func(session, api_token, *args, **kwargs)
+        if getattr(func, 'extends_api_session', True):
+            self.touch(key)
+        return result
+
+    def stats(self):
+        """Метрики кэша токенов."""
+        stats = dict(self._metrics)
+        stats['tokens'] = len(self._tokens)
+        stats['refreshing'] = len(self._refreshing)
+        return stats
@@ -0,0 +1,304 @@
+"""
+Транспорт запросов к OpenCart API.
+
+Добавляет к каждому запросу таймаут по маршруту, повторы с джиттером
+для идемпотентных маршрутов, общий для магазина предохранитель
+(circuit breaker) и гистограмму задержек по каждому маршруту api/*.
+"""
+import asyncio
+import bisect
+import logging
+import random
+import time
+
+import aiohttp
+import requests
+
+
+logger = logging.getLogger('tg_bot.oc_transport')
+
+# Маршруты, повтор которых не меняет результат.
+# api/cart/add и api/order/add повторять нельзя: товар добавится дважды,
+# заказ создастся дважды. Повтор api/login лишь создаст еще одну
+# api-сессию, а без токена не выполнить ни одного запроса.
+IDEMPOTENT_ROUTES = frozenset((
+    'api/login',
+    'api/cart/edit',
+    'api/cart/remove',
+    'api/cart/products',
+    'api/customer',
+    'api/shipping/address',
+    'api/shipping/methods',
+    'api/shipping/method',
+    'api/payment/address',
+    'api/payment/methods',
+    'api/payment/method',
+    'api/order/info',
+    'api/order/history',
+))
+# Таймауты маршрутов, сек. Остальные маршруты - default_timeout.
+ROUTE_TIMEOUTS = {
+    'api/login': 5,
+    'api/cart/products': 5,
+    'api/order/add': 20,
+}
+# Границы корзин гистограммы задержек, мс.
+LATENCY_BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class OpenCartUnavailable(Exception):
+    """Магазин недоступен: предохранитель разомкнут."""
+
+
+# Ошибки, после которых пользователю стоит просто повторить действие.
+TRANSIENT_ERRORS = (OpenCartUnavailable,
+                    asyncio.TimeoutError,
+                    aiohttp.ClientError)
+
+
+class LatencyHistogram():
+    """Гистограмма задержек запросов с фиксированными корзинами."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Инициализировать атрибуты данных."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        """Учесть один запрос."""
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if error:
+            self.errors += 1
+
+    def percentile(self, q):
+        """Верхняя граница корзины, в которую попал q-й перцентиль, мс."""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket
+        return float('inf')
+
+    def stats(self):
+        """Сводка по гистограмме."""
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': self.total / self.count if self.count else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(zip([*self.buckets, 'inf'], self.counts)),
+        }
+
+
+class CircuitBreaker():
+    """
+    Предохранитель запросов к магазину.
+
+    После failure_threshold неудачных запросов подряд размыкается
+    и reset_timeout секунд сразу отказывает. Затем пропускает один
+    пробный запрос: удачный замыкает предохранитель, неудачный снова
+    размыкает.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """Инициализировать атрибуты данных."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before_request(self):
+        """Проверить, можно ли отправить запрос."""
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self.trial):
+            raise OpenCartUnavailable(
+                'OpenCart недоступен, запросы временно не отправляются')
+        if state == 'half-open':
+            self.trial = True
+
+    def on_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def on_abort(self):
+        # Запрос отменен, а не провалился: о магазине он ничего
+        # не говорит, пробный запрос отправит следующий.
+        self.trial = False
+
+    def on_failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial:
+                self.opened += 1
+                logger.error(f'OpenCart: предохранитель разомкнут после '
+                             f'{self.failures} ошибок подряд')
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+
+def is_retryable(err):
+    """Временная ошибка: таймаут, обрыв соединения или 5xx."""
+    if isinstance(err, (asyncio.TimeoutError,
+                        aiohttp.ClientConnectionError,
+                        aiohttp.ServerDisconnectedError,
+                        requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout)):
+        return True
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status >= 500
+    if isinstance(err, requests.exceptions.HTTPError):
+        return (err.response is not None
+                and err.response.status_code >= 500)
+    return False
+
+
+class Transport():
+    """
+    Политика отправки запросов к OpenCart.
+
+    retries - сколько раз повторять идемпотентный запрос после временной
+    ошибки, backoff - базовая пауза перед повтором (удваивается,
+    к ней добавляется случайный джиттер). observer(route, seconds, error),
+    если задан, вызывается после каждой попытки запроса.
+    """
+
+    def __init__(self, default_timeout=10, route_timeouts=None, retries=2,
+                 backoff=0.2, failure_threshold=5, reset_timeout=30,
+                 observer=None):
+        """Инициализировать атрибуты данных."""
+        self.default_timeout = default_timeout
+        self.route_timeouts = dict(ROUTE_TIMEOUTS)
+        if route_timeouts:
+            self.route_timeouts.update(route_timeouts)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.histograms = {}
+        self.retried = 0
+        self.observer = observer
+
+    def timeout_for(self, route):
+        """Таймаут маршрута, сек."""
+        return self.route_timeouts.get(route, self.default_timeout)
+
+    def _attempts(self, route):
+        return 1 + (self.retries if route in IDEMPOTENT_ROUTES else 0)
+
+    def _delay(self, attempt):
+        # "Full jitter": случайная пауза от 0 до backoff * 2^attempt.
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def _observe(self, route, seconds, error=False):
+        histogram = self.histograms.get(route)
+        if histogram is None:
+            histogram = self.histograms[route] = LatencyHistogram()
+        histogram.observe(seconds, error)
+        if self.observer is not None:
+            self.observer(route, seconds, error)
+
+    def _on_error(self, route, err, attempt, attempts):
+        """Учесть ошибку и решить, повторять ли запрос."""
+        if not is_retryable(err):
+            # Магазин ответил (например, 4xx) - он жив.
+            self.breaker.on_success()
+            return False
+        self.breaker.on_failure()
+        if attempt + 1 >= attempts or self.breaker.state != 'closed':
+            return False
+        self.retried += 1
+        logger.warning(f'{route}: {err!r}, повтор {attempt + 1}')
+        return True
+
+    async def request(self, route, send):
+        """Отправить запрос: send(timeout) - корутина с самим запросом."""
+        attempts = self._attempts(route)
+        for attempt in range(attempts):
+            self.breaker.before_request()
+            started = time.perf_counter()
+            try:
+                result = await send(self.timeout_for(route))
+            except Exception as err:
+                self._observe(route, time.perf_counter() - started, True)
+                if not self._on_error(route, err, attempt, attempts):
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+            except BaseException:
+                # CancelledError, KeyboardInterrupt: иначе пробный
+                # запрос так и остался бы "в пути".
+                self.breaker.on_abort()
+                raise
+            else:
+                self._observe(route, time.perf_counter() - started)
+                self.breaker.on_success()
+                return result
+
+    def request_sync(self, route, send):
+        """Синхронный вариант request для opencart_api."""
+        attempts = self._attempts(route)
+        for attempt in range(attempts):
+            self.breaker.before_request()
+            started = time.perf_counter()
+            try:
+                result = send(self.timeout_for(route))
+            except Exception as err:
+                self._observe(route, time.perf_counter() - started, True)
+                if not self._on_error(route, err, attempt, attempts):
+                    raise
+                time.sleep(self._delay(attempt))
+            except BaseException:
+                # CancelledError, KeyboardInterrupt: иначе пробный
+                # запрос так и остался бы "в пути".
+                self.breaker.on_abort()
+                raise
+            else:
+                self._observe(route, time.perf_counter() - started)
+                self.breaker.on_success()
+                return result
+
+    def stats(self):
+        """Состояние предохранителя и задержки по маршрутам."""
+        return {
+            'breaker': self.breaker.state,
+            'breaker_opened': self.breaker.opened,
+            'retried': self.retried,
+            'routes': {route: histogram.stats()
+                       for route, histogram in sorted(
+                           self.histograms.items())},
+        }
+
+
+_transport = Transport()
+
+
+def get_transport():
+    """Общий транспорт запросов к OpenCart."""
+    return _transport
+
+
+def configure_transport(**kwargs):
+    """Заменить общий транспорт транспортом с новыми настройками."""
+    global _transport
+    _transport = Transport(**kwargs)
+    return _transport
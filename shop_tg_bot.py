@@ -1,16 +1,42 @@
 import os
 
-import logging
+import asyncio
+import contextvars
 import json
+import logging
+import multiprocessing
 import phonenumbers
 import redis
-import requests
+import sys
 
 from dotenv import load_dotenv
-from geopy import distance
+from dispatch import Dispatcher
+from geocoder import (CachedGeocoder,
+                      GeocoderError,
+                      StubGeocoder,
+                      YandexGeocoder)
+import opencart_api_async as api_async
 from opencart_api import *
+from opencart_cart import CartMirror
+from opencart_cart_db import DatabaseCart
+from opencart_couriers import CourierDirectory
+from opencart_db import (configure_db_executor,
+                         evict_idle_connections,
+                         get_pool,
+                         get_pools_stats)
 from opencart_products import OpenCartProducts
-from telegram import (InlineKeyboardButton,
+from opencart_sessions import SessionRegistry
+from opencart_stores import StoreIndex
+from opencart_transport import (TRANSIENT_ERRORS,
+                                configure_transport,
+                                get_transport)
+from tariffs import TariffEngine
+from tg_photos import PhotoCache
+from tg_render import MessageRenderer
+from tg_updates import ChatUpdateProcessor
+from tg_webhook import UpdateQueue, UpdateWorker, WebhookServer
+from telegram import (Bot,
+                      InlineKeyboardButton,
                       InlineKeyboardMarkup,
                       Update,
                       constants,
@@ -24,6 +50,7 @@ from telegram.ext import (Application,
                           filters,
                           CallbackQueryHandler,
                           PreCheckoutQueryHandler)
+from telegram.error import BadRequest
 
 load_dotenv()
 
@@ -34,10 +61,17 @@ logging.basicConfig(
 logger = logging.getLogger('tg_bot')
 logger.setLevel(logging.DEBUG)
 
-s = requests.Session()
-sessions = {}
-
 _database = None
+_sessions = None
+_cart_mirror = None
+_cart_backend = None
+_renderer = None
+_photo_cache = None
+_geocoder = None
+_tariffs = None
+_dispatcher = None
+# Сессия OpenCart чата, апдейт которого сейчас обрабатывается.
+_current_chat_session = contextvars.ContextVar('opencart_chat_session')
 OP_USER = os.getenv("OPENCART_DB_USER")
 OP_PASSWORD = os.getenv("OPENCART_DB_PASSWORD")
 OP_HOST = os.getenv("OPENCART_DB_HOST")
@@ -46,28 +80,78 @@ API_USERNAME = os.getenv('OPENCART_API_USER_NAME')
 API_KEY = os.getenv('OPENCART_API_KEY')
 WEBSITE = os.getenv('WEBSITE_HOST')
 YA_GEO_API_KEY = os.getenv('YA_GEO_API_KEY')
+# Геокодер: yandex или stub (адреса из JSON-файла GEOCODER_STUB_PATH),
+# сроки хранения найденных и ненайденных адресов в кэше, сек, и его
+# предельный размер. GEOCODER_DUMP_PATH - куда писать ответы Яндекса
+# для отладки (по умолчанию не пишутся).
+GEOCODER = os.getenv('GEOCODER', 'yandex')
+GEOCODER_STUB_PATH = os.getenv('GEOCODER_STUB_PATH', 'data/addresses.json')
+GEOCODER_TIMEOUT = int(os.getenv('GEOCODER_TIMEOUT', 5))
+GEOCODER_CACHE_TTL = int(os.getenv('GEOCODER_CACHE_TTL', 30 * 24 * 3600))
+GEOCODER_NEGATIVE_TTL = int(os.getenv('GEOCODER_NEGATIVE_TTL', 24 * 3600))
+GEOCODER_CACHE_SIZE = int(os.getenv('GEOCODER_CACHE_SIZE', 100000))
+GEOCODER_DUMP_PATH = os.getenv('GEOCODER_DUMP_PATH')
 PAYMENT_PROVIDER_TOKEN = os.getenv('PAYMENT_PROVIDER_TOKEN')
-
-
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
-    response.raise_for_status()
-    found_places = response.json()['response']['GeoObjectCollection']['featureMember']
-    with open('data/geo.json', 'w', encoding='utf-8') as f:
-        json.dump(found_places, f, indent=4, ensure_ascii=False)
-
-    if not found_places:
-        return None
-
-    most_relevant = found_places[0]
-    lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
-
-    return lat, lon
+# Сколько секунд снимок каталога считается свежим без проверки БД.
+CATALOG_MAX_STALENESS = int(os.getenv('CATALOG_MAX_STALENESS', 30))
+# Сколько секунд индекс пунктов самовывоза считается свежим без проверки БД.
+STORES_MAX_STALENESS = int(os.getenv('STORES_MAX_STALENESS', 60))
+# Доставщики: как выбирать (round_robin или least_loaded), номер поля
+# custom_field с Telegram ID, как часто перечитывать справочник и
+# за сколько секунд считать нагрузку доставщика.
+COURIERS_STRATEGY = os.getenv('COURIERS_STRATEGY', 'round_robin')
+COURIERS_FIELD_ID = os.getenv('COURIERS_FIELD_ID')
+COURIERS_MAX_STALENESS = int(os.getenv('COURIERS_MAX_STALENESS', 300))
+COURIERS_LOAD_WINDOW = int(os.getenv('COURIERS_LOAD_WINDOW', 3600))
+# Файл с зонами и тарифами доставки (см. tariffs.py). Без него
+# доставка считается по расстоянию: 0.5/5/20 км.
+DELIVERY_ZONES_PATH = os.getenv('DELIVERY_ZONES_PATH')
+DELIVERY_QUOTE_TTL = int(os.getenv('DELIVERY_QUOTE_TTL', 3600))
+# Раздача заказов пакетами: раз в DISPATCH_WINDOW секунд (0 - сразу
+# по одному), до DISPATCH_MAX_STOPS заказов в пределах
+# DISPATCH_RADIUS_KM км в одном маршруте. Заказ, не розданный за
+# DISPATCH_MAX_ATTEMPTS окон, уходит оператору в DISPATCH_ALERT_CHAT_ID.
+DISPATCH_WINDOW = int(os.getenv('DISPATCH_WINDOW', 0))
+DISPATCH_MAX_STOPS = int(os.getenv('DISPATCH_MAX_STOPS', 5))
+DISPATCH_RADIUS_KM = float(os.getenv('DISPATCH_RADIUS_KM', 3))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv('DISPATCH_MAX_ATTEMPTS', 10))
+DISPATCH_ALERT_CHAT_ID = os.getenv('DISPATCH_ALERT_CHAT_ID')
+# Настройки HTTP-клиента OpenCart API.
+OPENCART_HTTP_LIMIT = int(os.getenv('OPENCART_HTTP_LIMIT', 20))
+OPENCART_HTTP_TIMEOUT = int(os.getenv('OPENCART_HTTP_TIMEOUT', 10))
+# Предел числа сессий OpenCart в памяти и время жизни простаивающей, сек.
+OPENCART_SESSIONS_MAX = int(os.getenv('OPENCART_SESSIONS_MAX', 5000))
+OPENCART_SESSIONS_TTL = int(os.getenv('OPENCART_SESSIONS_TTL', 3600))
+# Сколько запросов api/login может идти одновременно.
+OPENCART_MAX_LOGINS = int(os.getenv('OPENCART_MAX_LOGINS', 5))
+# Повторы идемпотентных запросов и предохранитель OpenCart.
+OPENCART_RETRIES = int(os.getenv('OPENCART_RETRIES', 2))
+OPENCART_BREAKER_THRESHOLD = int(os.getenv('OPENCART_BREAKER_THRESHOLD', 5))
+OPENCART_BREAKER_RESET = int(os.getenv('OPENCART_BREAKER_RESET', 30))
+# Через сколько секунд зеркало корзины в Redis сверяется с OpenCart.
+CART_MIRROR_MAX_AGE = int(os.getenv('CART_MIRROR_MAX_AGE', 300))
+# Откуда брать корзину: http - через OpenCart API, db - напрямую из БД.
+CART_BACKEND = os.getenv('CART_BACKEND', 'http')
+# Чат, из которого разрешена команда /warmup_photos.
+PHOTO_ADMIN_CHAT_ID = os.getenv('PHOTO_ADMIN_CHAT_ID')
+# Вебхук: публичный адрес, на котором его слушать, секретный токен
+# и число воркеров (шардов очереди апдейтов).
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 2))
+WEBHOOK_WORKER_CONCURRENCY = int(os.getenv('WEBHOOK_WORKER_CONCURRENCY', 32))
+# Сколько апдейтов обрабатывается одновременно (апдейты одного чата -
+# всегда по очереди) и сколько может ждать обработки.
+UPDATES_CONCURRENCY = int(os.getenv('UPDATES_CONCURRENCY', 64))
+UPDATES_MAX_PENDING = int(os.getenv('UPDATES_MAX_PENDING', 1024))
+# Настройки общего пула соединений с БД OpenCart.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_IDLE = int(os.getenv('DB_POOL_MAX_IDLE', 300))
 
 
 def get_keyboard_menu(products: list, count_lines_on_page, page_num=1):
@@ -106,12 +190,15 @@ async def start(
                                    password=OP_PASSWORD,
                                    host=OP_HOST,
                                    database=OP_DATABASE,
-                                   website=WEBSITE)
+                                   website=WEBSITE,
+                                   max_staleness=CATALOG_MAX_STALENESS)
     logger.debug(f'op_products: {op_products}')
     # Если category_id=None, то получим список всех товаров.
     # Иначе список товаров определенной категории.
     category_pizza = 59
-    products = op_products.get_my_products(category_id=category_pizza)
+    products = await op_products.get_my_products_async(
+        category_id=category_pizza)
+    logger.debug(f'Кэш каталога: {op_products.cache_stats()}')
     user = update.effective_user
 
     total_count_products = len(products)
@@ -128,8 +215,7 @@ async def start(
         )
     elif update.callback_query:
         logger.debug(f'callback_query.data: {update.callback_query.data}')
-        chat_id = update.callback_query.message.chat_id
-        message_id = update.callback_query.message.message_id
+        message = update.callback_query.message
 
         reply_markup = get_keyboard_menu(products, count_lines_on_page)
 
@@ -139,12 +225,9 @@ async def start(
                 or update.callback_query.data.split(',')[0] == 'pickup'
                 or update.callback_query.data.split(';')[0] == 'pickup'
                 or update.callback_query.data.split(';')[0] == 'delivery'):
-            await context.bot.delete_message(chat_id=chat_id,
-                                             message_id=message_id)
             text = 'Выбирай то, что тебе нравится:'
-            await context.bot.send_message(text=text,
-                                           chat_id=chat_id,
-                                           reply_markup=reply_markup)
+            await get_renderer().render(context.bot, message, text=text,
+                                        reply_markup=reply_markup)
         else:
             query = update.callback_query.data.lstrip('page')
             logger.debug(f'QUERY: {query}')
@@ -158,11 +241,9 @@ async def start(
                                              count_lines_on_page,
                                              page_num=page_num)
 
-            await context.bot.delete_message(chat_id=chat_id,
-                                             message_id=message_id)
-            await context.bot.send_message(
+            await get_renderer().render(
+                context.bot, message,
                 text=f'Выбирай то, что тебе нравится:',
-                chat_id=chat_id,
                 reply_markup=reply_markup,
             )
             # return 'START'
@@ -174,7 +255,6 @@ async def handle_menu(
         context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
     chat_id = update.callback_query.message.chat_id
-    message_id = update.callback_query.message.message_id
     await query.answer()
 
     logger.debug(f'QUERY_DATA in HANDLE_MENU: {query.data}')
@@ -188,20 +268,17 @@ async def handle_menu(
                                        password=OP_PASSWORD,
                                        host=OP_HOST,
                                        database=OP_DATABASE,
-                                       website=WEBSITE)
-        product = op_products.get_my_product(id_my_product=int(query.data))
-
-        cart_content = get_cart_products(s, api_token, WEBSITE)
-        cart_products = cart_content['products']
-        if cart_products:
-            for cart_product in cart_products:
-                if cart_product['name'] == product["name"]:
-                    quantity = cart_product['quantity']
-                    break
-                else:
-                    quantity = '0'
-        else:
-            quantity = '0'
+                                       website=WEBSITE,
+                                       max_staleness=CATALOG_MAX_STALENESS)
+        product = await op_products.get_my_product_async(
+            id_my_product=int(query.data))
+
+        cart = get_cart_mirror()
+        if not cart.is_synced(chat_id, api_token):
+            cart_content = await call_api(
+                get_cart_backend().get_cart_products, WEBSITE)
+            cart.reconcile(chat_id, api_token, cart_content)
+        quantity = cart.quantity(chat_id, product['id'])
 
         text = (f'{product["name"]}\n'
                 f'Стоимость: {product["price"]} руб.\n\n'
@@ -223,13 +300,16 @@ async def handle_menu(
 
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await context.bot.delete_message(chat_id=chat_id,
-                                         message_id=message_id)
-        await context.bot.send_photo(chat_id=chat_id,
-                                     photo=product['image'],
-                                     caption=text,
-                                     reply_markup=reply_markup,
-                                     parse_mode=constants.ParseMode.HTML)
+        async def show(photo):
+            return await get_renderer().render(
+                context.bot, query.message,
+                text=text,
+                photo=photo,
+                reply_markup=reply_markup,
+                parse_mode=constants.ParseMode.HTML)
+
+        # Фото по file_id: Telegram не скачивает его снова с сайта.
+        await get_photo_cache().send(product['id'], product['image'], show)
         return 'HANDLE_DESCRIPTION'
 
 
@@ -237,8 +317,10 @@ async def get_cart(
         api_token, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     query = update.callback_query
     chat_id = update.callback_query.message.chat_id
-    message_id = update.callback_query.message.message_id
-    cart_content = get_cart_products(s, api_token, WEBSITE)
+    cart_content = await call_api(get_cart_backend().get_cart_products,
+                                  WEBSITE)
+    # Показ корзины - точка сверки зеркала с OpenCart.
+    get_cart_mirror().reconcile(chat_id, api_token, cart_content)
     await query.answer()
 
     keyboard = []
@@ -273,11 +355,10 @@ async def get_cart(
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    await context.bot.send_message(text=total_text,
-                                   chat_id=chat_id,
-                                   reply_markup=reply_markup,
-                                   parse_mode=constants.ParseMode.HTML)
+    await get_renderer().render(context.bot, query.message,
+                                text=total_text,
+                                reply_markup=reply_markup,
+                                parse_mode=constants.ParseMode.HTML)
 
     return state
 
@@ -299,7 +380,16 @@ async def handle_description(
         product_quantity = int(user_reply[1])
         logger.debug(f'Product_id - {product_id}')
         logger.debug(f'Product_quantity - {product_quantity}')
-        cart_add(s, api_token, product_id, WEBSITE, product_quantity)
+        try:
+            await call_api(get_cart_backend().cart_add, product_id,
+                           WEBSITE, product_quantity)
+        except api_async.CartError as err:
+            logger.warning(f'Товар не добавлен: {err}')
+            await query.answer(text='Этот товар сейчас недоступен.',
+                               show_alert=True)
+            return 'HANDLE_DESCRIPTION'
+        get_cart_mirror().add(query.message.chat_id, product_id,
+                              product_quantity)
 
         if product_quantity:
             text = (f'Добавлено в корзину, \n'
@@ -319,7 +409,9 @@ async def handle_cart(
     elif query.data == 'order':
         return await get_contacts(api_token, update, context)
     else:
-        cart_remove(s, api_token, cart_id=query.data, website=WEBSITE)
+        await call_api(get_cart_backend().cart_remove, cart_id=query.data,
+                       website=WEBSITE)
+        get_cart_mirror().remove(query.message.chat_id, query.data)
         await get_cart(api_token, update, context)
         return 'GET_CART'
 
@@ -415,34 +507,23 @@ async def handle_location(
     if update.message:
         chat_id = update.message.chat_id
         logger.debug(f'update.message: {update.message}')
-        stores_locations = get_all_stores_locations(OP_USER, OP_PASSWORD,
-                                                    OP_HOST, OP_DATABASE)
-        try:
-            coords = fetch_coordinates(YA_GEO_API_KEY, update.message.text)
-            logger.debug(f'Координаты от яндекса - {coords}')
-        except requests.exceptions.HTTPError as err:
-            logger.error(f'Error: {err}')
+        stores = get_store_index()
+        if update.message.location:
+            # Геопозиция уже дает координаты, геокодер не нужен.
             lat = update.message.location.latitude
             lon = update.message.location.longitude
             current_pos = (lat, lon)
             logger.debug(f'Геолокация от пользователя - {current_pos}')
-            distances = get_distance_to_stores(current_pos, stores_locations)
-            min_distance = min(distances, key=get_distance)
+            min_distance = (await stores.nearest_async(lat, lon))[0]
             store_name = min_distance['name']
             logger.debug(f'Магазин (яндекс координаты): {store_name}')
-            deliveryman_id = get_deliveryman_id(store_name,
-                                                OP_USER, OP_PASSWORD,
-                                                OP_HOST, OP_DATABASE)
-            await update.message.reply_text(text=get_shipping(min_distance))
+            quote = get_delivery_quote(chat_id, min_distance, lat, lon)
+            deliveryman_id = await find_deliveryman(store_name)
+            await update.message.reply_text(text=get_shipping(quote))
 
             text = f'Делаем доставку или самовывоз?'
-            keyboard = [
-                [InlineKeyboardButton('Доставка',
-                                      callback_data=f'delivery;{deliveryman_id};{current_pos}')],
-                [InlineKeyboardButton('Самовывоз', callback_data=f'pickup;{store_name}')],
-            ]
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = get_delivery_keyboard(quote, deliveryman_id,
+                                                 current_pos)
 
             await context.bot.send_message(text=text,
                                            chat_id=chat_id,
@@ -451,25 +532,26 @@ async def handle_location(
             return 'DELIVERY_OPTIONS'
 
         else:
+            try:
+                coords = await get_geocoder().fetch_coordinates(
+                    update.message.text)
+                logger.debug(f'Координаты от геокодера - {coords}')
+            except GeocoderError as err:
+                logger.error(f'Ошибка геокодера: {err}')
+                await update.message.reply_text(
+                    'Не удалось найти адрес, попробуйте еще раз '
+                    'или отправьте геолокацию.')
+                return 'LOCATION'
             if coords:
-                distances = get_distance_to_stores(coords,
-                                                   stores_locations)
-                min_distance = min(distances, key=get_distance)
+                min_distance = (await stores.nearest_async(*coords))[0]
                 store_name = min_distance['name']
                 logger.debug(f'Магазин (геопозиция): {store_name}')
-                deliveryman_id = get_deliveryman_id(store_name, OP_USER,
-                                                    OP_PASSWORD, OP_HOST,
-                                                    OP_DATABASE)
-                await update.message.reply_text(
-                    text=get_shipping(min_distance))
+                quote = get_delivery_quote(chat_id, min_distance, *coords)
+                deliveryman_id = await find_deliveryman(store_name)
+                await update.message.reply_text(text=get_shipping(quote))
                 text = f'Делаем доставку или самовывоз?'
-                keyboard = [
-                [InlineKeyboardButton('Доставка',
-                                      callback_data=f'delivery;{deliveryman_id};{coords}')],
-                [InlineKeyboardButton('Самовывоз', callback_data=f'pickup;{store_name}')],
-                ]
-
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = get_delivery_keyboard(quote, deliveryman_id,
+                                                     coords)
 
                 await context.bot.send_message(text=text,
                                                chat_id=chat_id,
@@ -497,29 +579,36 @@ async def handle_location(
     return 'LOCATION'
 
 
-def get_deliveryman_id(store_name, OP_USER, OP_PASSWORD, OP_HOST, OP_DATABASE):
-    cnx = mysql.connector.connect(user=OP_USER,
-                                  password=OP_PASSWORD,
-                                  host=OP_HOST,
-                                  database=OP_DATABASE)
-
-    cursor = cnx.cursor()
-    query = ('SELECT c.custom_field as custom_field '
-             'FROM oc_customer as c '
-             'left JOIN oc_customer_group_description as cgd '
-             'on cgd.customer_group_id = c.customer_group_id '
-             f"where cgd.name = '{store_name}'")
-    cursor.execute(query)
-    deliverymans_id_list = []
-    for custom_field in cursor:
-        dlvman_id_list = custom_field[0].lstrip('{').rstrip('}').split(':')
-        deliveryman_id = dlvman_id_list[1].strip('"')
-        logger.debug(f'deliveryman_id: {deliveryman_id}')
-        deliverymans_id_list.append(deliveryman_id)
-    cnx.close()
-    logger.debug(f'deliverymans_id_list: {deliverymans_id_list}')
-    logger.debug(f'deliverymans_id_list[0]: {deliverymans_id_list[0]}')
-    return deliverymans_id_list[0]
+async def find_deliveryman(store_name):
+    directory = get_courier_directory()
+    if DISPATCH_WINDOW:
+        # Доставщика выберет раздача. Здесь только проверяем, что он
+        # есть: pick сдвинул бы очередь пиццерии впустую.
+        couriers = await directory.couriers_async(store_name)
+        return couriers[0] if couriers else None
+    return await directory.pick_async(store_name)
+
+
+def get_delivery_keyboard(quote, deliveryman_id, coords):
+    keyboard = []
+    # Без доставщика или вне зон доставки остается только самовывоз.
+    if deliveryman_id and quote['deliverable']:
+        keyboard.append([InlineKeyboardButton(
+            'Доставка', callback_data=f'delivery;{deliveryman_id};{coords}')])
+    keyboard.append([InlineKeyboardButton(
+        'Самовывоз', callback_data=f'pickup;{quote["store"]}')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_delivery_quote(chat_id, min_distance, lat, lon):
+    # Расчет доставки нужен и в delivery_options, а в callback_data
+    # он не помещается - храним его в Redis.
+    quote = get_tariffs().quote(min_distance['name'], lat, lon,
+                                min_distance['distance'])
+    logger.debug(f'Расчет доставки: {quote}')
+    get_database_connection().set(f'quote:{chat_id}', json.dumps(quote),
+                                  ex=DELIVERY_QUOTE_TTL)
+    return quote
 
 
 async def delivery_options(api_token,
@@ -540,24 +629,36 @@ async def delivery_options(api_token,
         if user_reply[0] == 'pickup':
             text = (f'Ближайшая к вам пиццерия - {user_reply[-1]}.\n')
             await context.bot.send_message(text=text, chat_id=chat_id)
-            order_id = create_order(s, api_token,
-                                    telephone=telephone,
-                                    lastname=chat_id,
-                                    website=WEBSITE)
+            order_id = await call_api(api_async.create_order,
+                                      telephone=telephone,
+                                      lastname=chat_id,
+                                      website=WEBSITE)
+            # После api/order/add корзина OpenCart очищается.
+            get_cart_mirror().forget(chat_id)
         else:
             deliveryman_id = user_reply[1]
             coords = user_reply[2]
             logger.debug(f'ID доставщика: {deliveryman_id}')
             logger.debug(f'Координаты клиента: {user_reply[2]}')
+            quote = db.get(f'quote:{chat_id}')
+            quote = json.loads(quote) if quote else None
+            logger.debug(f'Расчет доставки: {quote}')
             text = (f'Ваш заказ передан в доставку.')
+            if quote and quote['deliverable']:
+                text += (f'\nСтоимость доставки: {quote["price"]:g} руб.'
+                         if quote['price'] else '\nДоставка бесплатная.')
+                if quote['eta']:
+                    text += f' Привезем примерно за {quote["eta"]} мин.'
             await context.bot.send_message(text=text, chat_id=chat_id)
-            order_id = create_order(s, api_token,
-                                    telephone=telephone,
-                                    lastname=chat_id,
-                                    website=WEBSITE)
+            order_id = await call_api(api_async.create_order,
+                                      telephone=telephone,
+                                      lastname=chat_id,
+                                      website=WEBSITE)
+            # После api/order/add корзина OpenCart очищается.
+            get_cart_mirror().forget(chat_id)
             await delivery(order_id, deliveryman_id, coords,
                            OP_USER, OP_PASSWORD, OP_HOST, OP_DATABASE,
-                           update, context)
+                           update, context, quote=quote)
             # Запуск шедулера, для отправки сообщения 60 сек.
             name = update.effective_chat.full_name
             seconds = 60
@@ -605,9 +706,10 @@ async def payment(api_token,
     logger.debug(f'user_reply: {user_reply}')
     if user_reply[0] == 'online_payment':
         order_id = user_reply[1]
-        order_info = get_order_info(s, api_token, order_id, website=WEBSITE)
+        order_info = await call_api(api_async.get_order_info, order_id,
+                                    website=WEBSITE)
         logger.debug(f'Alarm after order_info!!!')
-        total = int(float(json.loads(order_info)['order']['total']))
+        total = int(float(order_info['order']['total']))
         logger.debug(f'total: {total}')
         logger.debug(f'type of total: {type(total)}')
         title = "Оплата заказа"
@@ -664,7 +766,8 @@ async def callback_alarm(context: ContextTypes.DEFAULT_TYPE):
 
 async def delivery(order_id, deliveryman_id, coords,
                    OP_USER, OP_PASSWORD, OP_HOST, OP_DATABASE,
-                   update: Update, context: ContextTypes.DEFAULT_TYPE):
+                   update: Update, context: ContextTypes.DEFAULT_TYPE,
+                   quote=None):
     logger.info(f'Entering the delivery function')
     coords_list = coords.lstrip('(').rstrip(')').split(', ')
     logger.debug(f'Coords: {coords}')
@@ -673,67 +776,37 @@ async def delivery(order_id, deliveryman_id, coords,
     logger.debug(f'Latitude: {lat}')
     lon = float(coords_list[1].strip("'"))
     logger.debug(f'Longitude: {lon}')
-    text = get_order_content(order_id, user_db=OP_USER,
-                             psw=OP_PASSWORD, host=OP_HOST, db=OP_DATABASE)
+    text = await get_order_content_async(order_id, user_db=OP_USER,
+                                         psw=OP_PASSWORD, host=OP_HOST,
+                                         db=OP_DATABASE)
+    if text is None:
+        logger.error(f'Заказ {order_id} не найден в БД, доставщик '
+                     f'не назначен')
+        await context.bot.send_message(
+            text=f'Не удалось передать заказ {order_id} в доставку. '
+                 f'Мы свяжемся с вами по телефону.',
+            chat_id=update.effective_chat.id)
+        return
+    if DISPATCH_WINDOW and quote:
+        # Доставщика выберет раздача вместе с соседними заказами.
+        get_dispatcher().add(order_id, update.effective_chat.id,
+                             quote['store'], lat, lon, text)
+        return
     await context.bot.send_message(text=text, chat_id=deliveryman_id)
     await context.bot.send_location(chat_id=deliveryman_id,
                                     latitude=lat, longitude=lon)
-    pass
-
-
-def get_all_stores_locations(OP_USER, OP_PASSWORD, OP_HOST, OP_DATABASE):
-    cnx = mysql.connector.connect(user=OP_USER,
-                                  password=OP_PASSWORD,
-                                  host=OP_HOST,
-                                  database=OP_DATABASE)
-
-    cursor = cnx.cursor()
-    query = ('SELECT name, geocode from oc_location')
-    cursor.execute(query)
-
-    locations = []
-    for name, geocode in cursor:
-        location_store = {}
-        location_store['name'] = name
-        location_store['geocode'] = geocode
-        locations.append(location_store)
-
-    cnx.close()
-    logger.debug(f'stores_locations: {locations}')
-    return locations
-
-
-def get_distance_to_stores(user_geocode, stores_locations: list):
-    distances_list = []
-    for store_location in stores_locations:
-        distance_to_store = {}
-        store_geocode = store_location['geocode']
-        dist = distance.distance(store_geocode, user_geocode).km
-        distance_to_store['name'] = store_location['name']
-        distance_to_store['distance'] = dist
-        distances_list.append(distance_to_store)
-    logger.debug(f'distances: {distances_list}')
-    return distances_list
+    get_courier_directory().assigned(deliveryman_id, order_id)
 
 
-def get_distance(distances):
-    return distances['distance']
-
-
-def get_store_name(distances):
-    return distances['name']
-
-
-def get_shipping(min_distance):
-    logger.debug(f'min_distance: {min_distance["distance"]}')
-    if min_distance['distance'] <= 0.5:
+def get_shipping(quote):
+    if not quote['deliverable']:
+        shipping = 'Сюда нет доставки.'
+    elif not quote['price']:
         shipping = 'Самовывоз или бесплатная доставка.'
-    elif min_distance['distance'] > 0.5 and min_distance['distance'] <= 5:
-        shipping = 'Доставка 100 руб.'
-    elif min_distance['distance'] > 5 and min_distance['distance'] <= 20:
-        shipping = 'Доставка 300 руб.'
     else:
-        shipping = 'Сюда нет доставки.'
+        shipping = f'Доставка {quote["price"]:g} руб.'
+    if quote['deliverable'] and quote['eta']:
+        shipping += f' Привезем примерно за {quote["eta"]} мин.'
     logger.debug(f'shipping_text: {shipping}')
     return shipping
 
@@ -750,10 +823,24 @@ async def handle_users_reply(
         chat_id = update.callback_query.message.chat_id
     else:
         return
-    try:
-        api_token = get_session(chat_id, s)
-    except Exception as err:
-        logger.error(f'Ошибка получения токена OpenCart: {err}')
+    registry = get_session_registry()
+    async with registry.session(chat_id) as chat:
+        api_token = None
+        try:
+            api_token = await registry.get_api_token(chat)
+        except Exception as err:
+            logger.error(f'Ошибка получения токена OpenCart: {err}')
+        chat_session = _current_chat_session.set(chat)
+        try:
+            await process_user_state(api_token, user_reply, chat_id,
+                                     db, update, context)
+        finally:
+            _current_chat_session.reset(chat_session)
+
+
+async def process_user_state(api_token, user_reply, chat_id, db,
+                             update: Update,
+                             context: ContextTypes.DEFAULT_TYPE) -> None:
     if user_reply == '/start':
         user_state = 'START'
     # Если category_id=None, то получим список всех товаров.
@@ -780,18 +867,153 @@ async def handle_users_reply(
         next_state = await state_handler(api_token, update, context)
         logger.debug(f'Next state - {next_state}')
         db.set(chat_id, next_state)
+    except TRANSIENT_ERRORS as err:
+        # Состояние не меняем: пользователь сможет повторить действие.
+        logger.error(f'OpenCart недоступен - {err!r}')
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=('Магазин временно недоступен. '
+                  'Попробуйте еще раз чуть позже или введите /start.'))
     except Exception as err:
         logger.error(f'Ошибка - {err}')
 
 
-def get_session(chat_id, s):
-    # Проверить, существует ли сессия для этого пользователя.
-    if chat_id not in sessions:
-        sessions[chat_id] = get_api_token(s,
-                                          username=API_USERNAME,
-                                          key=API_KEY,
-                                          website=WEBSITE)
-    return sessions[chat_id]
+def get_session_registry():
+    global _sessions
+    if _sessions is None:
+        _sessions = SessionRegistry(username=API_USERNAME,
+                                    key=API_KEY,
+                                    website=WEBSITE,
+                                    max_sessions=OPENCART_SESSIONS_MAX,
+                                    ttl=OPENCART_SESSIONS_TTL,
+                                    limit=OPENCART_HTTP_LIMIT,
+                                    timeout=OPENCART_HTTP_TIMEOUT,
+                                    max_logins=OPENCART_MAX_LOGINS,
+                                    on_refresh=get_token_refresh_hook())
+    return _sessions
+
+
+def get_token_refresh_hook():
+    # Корзина в БД привязана к api_token: при его смене ее строки
+    # переносятся в новую api-сессию, иначе корзина пропадет.
+    if CART_BACKEND == 'db':
+        return get_cart_backend().move_cart
+    return None
+
+
+async def call_api(func, *args, **kwargs):
+    # Вызвать функцию opencart_api_async в сессии OpenCart чата,
+    # чей апдейт сейчас обрабатывается. Токен подставляется сам.
+    return await get_session_registry().call(_current_chat_session.get(),
+                                             func, *args, **kwargs)
+
+
+async def close_api_sessions(application: Application) -> None:
+    global _sessions, _geocoder
+    if _sessions is not None:
+        await _sessions.close()
+        _sessions = None
+    if _geocoder is not None:
+        await _geocoder.close()
+        _geocoder = None
+
+
+def get_cart_backend():
+    # Модуль opencart_api_async или DatabaseCart - у обоих одинаковые
+    # функции корзины.
+    global _cart_backend
+    if _cart_backend is None:
+        if CART_BACKEND == 'db':
+            _cart_backend = DatabaseCart(user=OP_USER,
+                                         password=OP_PASSWORD,
+                                         host=OP_HOST,
+                                         database=OP_DATABASE,
+                                         api_username=API_USERNAME)
+        else:
+            _cart_backend = api_async
+    return _cart_backend
+
+
+def get_cart_mirror():
+    global _cart_mirror
+    if _cart_mirror is None:
+        _cart_mirror = CartMirror(get_database_connection(),
+                                  ttl=OPENCART_SESSIONS_TTL,
+                                  max_age=CART_MIRROR_MAX_AGE)
+    return _cart_mirror
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = MessageRenderer()
+    return _renderer
+
+
+def get_photo_cache():
+    global _photo_cache
+    if _photo_cache is None:
+        _photo_cache = PhotoCache(get_database_connection())
+    return _photo_cache
+
+
+def get_store_index():
+    return StoreIndex(user=OP_USER,
+                      password=OP_PASSWORD,
+                      host=OP_HOST,
+                      database=OP_DATABASE,
+                      max_staleness=STORES_MAX_STALENESS)
+
+
+def get_tariffs():
+    global _tariffs
+    if _tariffs is None:
+        if DELIVERY_ZONES_PATH:
+            _tariffs = TariffEngine.from_file(DELIVERY_ZONES_PATH)
+        else:
+            _tariffs = TariffEngine()
+    return _tariffs
+
+
+def get_courier_directory():
+    return CourierDirectory(user=OP_USER,
+                            password=OP_PASSWORD,
+                            host=OP_HOST,
+                            database=OP_DATABASE,
+                            db=get_database_connection(),
+                            strategy=COURIERS_STRATEGY,
+                            field_id=COURIERS_FIELD_ID,
+                            max_staleness=COURIERS_MAX_STALENESS,
+                            load_window=COURIERS_LOAD_WINDOW)
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = Dispatcher(get_database_connection(),
+                                 get_courier_directory(),
+                                 get_store_index(),
+                                 max_stops=DISPATCH_MAX_STOPS,
+                                 radius_km=DISPATCH_RADIUS_KM,
+                                 max_attempts=DISPATCH_MAX_ATTEMPTS,
+                                 alert_chat_id=DISPATCH_ALERT_CHAT_ID)
+    return _dispatcher
+
+
+def get_geocoder():
+    global _geocoder
+    if _geocoder is None:
+        if GEOCODER == 'stub':
+            geocoder = StubGeocoder.from_file(GEOCODER_STUB_PATH)
+        else:
+            geocoder = YandexGeocoder(YA_GEO_API_KEY,
+                                      timeout=GEOCODER_TIMEOUT,
+                                      dump_path=GEOCODER_DUMP_PATH)
+        _geocoder = CachedGeocoder(get_database_connection(), geocoder,
+                                   ttl=GEOCODER_CACHE_TTL,
+                                   negative_ttl=GEOCODER_NEGATIVE_TTL,
+                                   max_size=GEOCODER_CACHE_SIZE)
+    return _geocoder
 
 
 def get_database_connection():
@@ -809,6 +1031,77 @@ def get_database_connection():
     return _database
 
 
+async def db_pool_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    # Закрыть простаивающие соединения и сбросить метрики пула в лог.
+    evicted = evict_idle_connections()
+    logger.info(f'Пул БД: закрыто простаивающих - {evicted}, '
+                f'метрики - {get_pools_stats()}')
+
+
+async def sessions_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    # Вытеснить простаивающие сессии OpenCart и сбросить метрики в лог.
+    registry = get_session_registry()
+    await registry.evict()
+    logger.info(f'Сессии OpenCart: {registry.stats()}')
+    logger.info(f'Транспорт OpenCart: {get_transport().stats()}')
+    logger.info(f'Зеркало корзин: {get_cart_mirror().stats()}')
+    logger.info(f'Отрисовка экранов: {get_renderer().stats()}')
+    logger.info(f'Кэш фото: {get_photo_cache().stats()}')
+    logger.info(f'Кэш геокодера: {get_geocoder().stats()}')
+    logger.info(f'Пункты самовывоза: {get_store_index().stats()}')
+    logger.info(f'Доставщики: {get_courier_directory().stats()}')
+    logger.info(f'Тарифы доставки: {get_tariffs().stats()}')
+
+
+async def dispatch_orders(context: ContextTypes.DEFAULT_TYPE):
+    # Раздать накопившиеся за окно заказы доставщикам.
+    await get_dispatcher().run(context.bot)
+    logger.info(f'Раздача заказов: {get_dispatcher().stats()}')
+
+
+async def updates_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    # Очереди чатов, ожидание блокировок и общего лимита.
+    logger.info(f'Обработка апдейтов: '
+                f'{context.application.update_processor.stats()}')
+
+
+async def warmup_photos(update: Update,
+                        context: ContextTypes.DEFAULT_TYPE):
+    """Загрузить в Telegram фото всех товаров, которых нет в кэше."""
+    chat_id = update.effective_chat.id
+    op_products = OpenCartProducts(user=OP_USER,
+                                   password=OP_PASSWORD,
+                                   host=OP_HOST,
+                                   database=OP_DATABASE,
+                                   website=WEBSITE,
+                                   max_staleness=CATALOG_MAX_STALENESS)
+    products = await op_products.get_my_products_async()
+    photos = get_photo_cache()
+    uploaded = 0
+    failed = 0
+    for product in products:
+        if photos.get(product['id'], product['image']):
+            continue
+        try:
+            message = await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=product['image'],
+                disable_notification=True)
+        except BadRequest as err:
+            logger.error(f'Фото товара {product["id"]} не загружено: '
+                         f'{err.message}')
+            failed += 1
+            continue
+        photos.remember(product['id'], product['image'], message)
+        await context.bot.delete_message(chat_id=chat_id,
+                                         message_id=message.message_id)
+        uploaded += 1
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(f'Фото товаров: загружено {uploaded}, ошибок {failed}, '
+              f'всего товаров {len(products)}.'))
+
+
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -816,14 +1109,45 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def main() -> None:
-    logger.info('Start application.')
-    token = os.getenv("TOKEN_TG")
+def configure() -> None:
+    # Первый вызов get_pool задает настройки общего пула.
+    get_pool(OP_USER, OP_PASSWORD, OP_HOST, OP_DATABASE,
+             size=DB_POOL_SIZE,
+             timeout=DB_POOL_TIMEOUT,
+             max_idle=DB_POOL_MAX_IDLE)
+    configure_transport(default_timeout=OPENCART_HTTP_TIMEOUT,
+                        retries=OPENCART_RETRIES,
+                        failure_threshold=OPENCART_BREAKER_THRESHOLD,
+                        reset_timeout=OPENCART_BREAKER_RESET)
+    # Запросы к БД из обработчиков идут в отдельных потоках.
+    configure_db_executor(max_workers=DB_POOL_SIZE)
+
 
-    application = Application.builder().token(token).build()
+def build_application(updater=True) -> Application:
+    token = os.getenv("TOKEN_TG")
+    builder = (Application.builder()
+               .token(token)
+               .concurrent_updates(ChatUpdateProcessor(
+                   concurrency=UPDATES_CONCURRENCY,
+                   max_pending=UPDATES_MAX_PENDING))
+               .post_shutdown(close_api_sessions))
+    if not updater:
+        # Апдейты приходят из очереди вебхука, а не от getUpdates.
+        builder = builder.updater(None)
+    application = builder.build()
+    application.job_queue.run_repeating(db_pool_maintenance, interval=60)
+    application.job_queue.run_repeating(sessions_maintenance, interval=60)
+    application.job_queue.run_repeating(updates_maintenance, interval=60)
+    if DISPATCH_WINDOW:
+        application.job_queue.run_repeating(dispatch_orders,
+                                            interval=DISPATCH_WINDOW)
 
     application.add_handler(
         CommandHandler("start", handle_users_reply))
+    if PHOTO_ADMIN_CHAT_ID:
+        application.add_handler(
+            CommandHandler("warmup_photos", warmup_photos,
+                           filters=filters.Chat(int(PHOTO_ADMIN_CHAT_ID))))
     application.add_handler(
         CallbackQueryHandler(handle_users_reply))
 
@@ -843,6 +1167,109 @@ def main() -> None:
     application.add_handler(
         MessageHandler(filters.TEXT | filters.COMMAND, unknown))
 
+    return application
+
+
+def get_update_queue():
+    return UpdateQueue(get_database_connection(), shards=WEBHOOK_WORKERS)
+
+
+async def run_worker_async(shard) -> None:
+    application = build_application(updater=False)
+
+    async def process(data):
+        update = Update.de_json(data, application.bot)
+        # Тот же общий лимит и очередь чата, что и при polling.
+        await application.update_processor.process_update(
+            update, application.process_update(update))
+
+    worker = UpdateWorker(get_update_queue(), shard, process,
+                          concurrency=WEBHOOK_WORKER_CONCURRENCY)
+
+    async def worker_stats(context: ContextTypes.DEFAULT_TYPE):
+        logger.info(f'Воркер шарда {shard}: {worker.stats()}')
+
+    application.job_queue.run_repeating(worker_stats, interval=60)
+    async with application:
+        await application.start()
+        try:
+            await worker.run()
+        finally:
+            worker.stop()
+            await application.stop()
+            # post_shutdown вызывается только из run_polling/run_webhook.
+            await close_api_sessions(application)
+
+
+def run_worker(shard) -> None:
+    logger.info(f'Start worker {shard}.')
+    configure()
+    try:
+        asyncio.run(run_worker_async(shard))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_front_async() -> None:
+    queue = get_update_queue()
+    server = WebhookServer(queue,
+                           secret_token=WEBHOOK_SECRET,
+                           path=WEBHOOK_PATH)
+    bot = Bot(os.getenv("TOKEN_TG"))
+    async with bot:
+        await bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH,
+                              secret_token=WEBHOOK_SECRET,
+                              allowed_updates=Update.ALL_TYPES,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS)
+    await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(f'Вебхук: {server.stats()}, '
+                        f'очередь: {queue.stats()}')
+    finally:
+        await server.stop()
+
+
+def run_webhook(spawn_workers=True) -> None:
+    logger.info('Start webhook.')
+    # Воркеры - отдельные процессы, каждый обрабатывает свой шард.
+    workers = []
+    if spawn_workers:
+        for shard in range(WEBHOOK_WORKERS):
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(shard,),
+                                              name=f'tg-worker-{shard}')
+            process.start()
+            workers.append(process)
+    try:
+        asyncio.run(run_front_async())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+
+
+def main() -> None:
+    # python shop_tg_bot.py                - polling (или вебхук, если
+    #                                        задан WEBHOOK_URL);
+    # python shop_tg_bot.py webhook        - вебхук и все воркеры;
+    # python shop_tg_bot.py front          - только вебхук;
+    # python shop_tg_bot.py worker <шард>  - только воркер шарда.
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'worker':
+        return run_worker(int(sys.argv[2]))
+    if command == 'front':
+        return run_webhook(spawn_workers=False)
+    if command == 'webhook' or (command is None and WEBHOOK_URL):
+        return run_webhook()
+
+    logger.info('Start application.')
+    configure()
+    application = build_application()
     application.run_polling()
 
 
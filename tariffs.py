@@ -0,0 +1,259 @@
+"""
+Тарифы доставки: зоны пиццерий и расчет стоимости.
+
+Зона - многоугольник на карте со своей ценой и временем доставки.
+Зоны каждой пиццерии проверяются по порядку, подходит первая,
+содержащая точку клиента, поэтому внутренние зоны перечисляются перед
+внешними. Для пиццерий без многоугольников цена берется по полосам
+расстояния до пиццерии; пиццерия с многоугольниками возит вне их,
+только если для нее явно заданы полосы. Пиццерии, которых нет
+в настройках, считаются по полосам по умолчанию - тем же 0.5/5/20 км,
+что были зашиты в get_shipping.
+
+Для быстрого поиска у каждой зоны заранее посчитаны ограничивающий
+прямоугольник и ребра, а у пиццерии - сетка: клетка хранит только те
+зоны, прямоугольник которых ее задевает. Точку проверяют на попадание
+лишь в зоны ее клетки.
+
+Формат файла настроек (JSON), координаты - [широта, долгота]:
+    {
+        "default": {"bands": [{"name": ..., "max_distance": км,
+                               "price": руб, "eta": мин}, ...]},
+        "stores": {
+            "<пиццерия>": {
+                "zones": [{"name": ..., "price": ..., "eta": ...,
+                           "polygon": [[широта, долгота], ...]}, ...],
+                "bands": [...]
+            }
+        }
+    }
+"""
+import json
+import logging
+
+
+logger = logging.getLogger('tg_bot.tariffs')
+
+# Сетка пиццерии - не больше GRID_SIZE x GRID_SIZE клеток.
+GRID_SIZE = 32
+
+DEFAULT_BANDS = (
+    {'name': 'до 0.5 км', 'max_distance': 0.5, 'price': 0, 'eta': None},
+    {'name': 'до 5 км', 'max_distance': 5, 'price': 100, 'eta': None},
+    {'name': 'до 20 км', 'max_distance': 20, 'price': 300, 'eta': None},
+)
+
+
+def _parse_price(config, where):
+    price = config.get('price')
+    if not isinstance(price, (int, float)) or price < 0:
+        raise ValueError(f'{where}: некорректная цена {price!r}')
+    eta = config.get('eta')
+    if eta is not None and (not isinstance(eta, (int, float)) or eta <= 0):
+        raise ValueError(f'{where}: некорректное время {eta!r}')
+    return price, eta
+
+
+def parse_bands(bands, where='bands'):
+    """Полосы расстояния, отсортированные по max_distance."""
+    parsed = []
+    for band in bands:
+        price, eta = _parse_price(band, where)
+        max_distance = band.get('max_distance')
+        if not isinstance(max_distance, (int, float)) or max_distance <= 0:
+            raise ValueError(f'{where}: некорректное расстояние '
+                             f'{max_distance!r}')
+        parsed.append({
+            'name': band.get('name') or f'до {max_distance} км',
+            'max_distance': max_distance,
+            'price': price,
+            'eta': eta,
+        })
+    return tuple(sorted(parsed, key=lambda band: band['max_distance']))
+
+
+def find_band(bands, distance):
+    """Первая полоса, в которую попадает расстояние, или None."""
+    for band in bands:
+        if distance <= band['max_distance']:
+            return band
+    return None
+
+
+class Zone():
+    """Зона доставки - многоугольник с ценой и временем доставки."""
+
+    __slots__ = ('name', 'price', 'eta', 'bbox', 'edges')
+
+    def __init__(self, name, price, eta, polygon):
+        """Инициализировать атрибуты данных."""
+        points = [(float(lat), float(lon)) for lat, lon in polygon]
+        if points and points[0] == points[-1]:
+            points.pop()
+        if len(points) < 3:
+            raise ValueError(f'Зона {name}: меньше трех вершин')
+        self.name = name
+        self.price = price
+        self.eta = eta
+        lats = [lat for lat, _ in points]
+        lons = [lon for _, lon in points]
+        self.bbox = (min(lats), min(lons), max(lats), max(lons))
+        # Ребра для проверки лучом вдоль долготы. Горизонтальные
+        # (по широте) ребра луч не пересекают, их можно не хранить.
+        self.edges = tuple(
+            (lat1, lon1, lat2, (lon2 - lon1) / (lat2 - lat1))
+            for (lat1, lon1), (lat2, lon2)
+            in zip(points, points[1:] + points[:1])
+            if lat1 != lat2)
+
+    def contains(self, lat, lon):
+        """Лежит ли точка внутри многоугольника."""
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        inside = False
+        for lat1, lon1, lat2, slope in self.edges:
+            if ((lat1 > lat) != (lat2 > lat)
+                    and lon < lon1 + (lat - lat1) * slope):
+                inside = not inside
+        return inside
+
+
+class StoreTariff():
+    """Зоны и полосы расстояния одной пиццерии."""
+
+    def __init__(self, name, zones=(), bands=DEFAULT_BANDS):
+        """Инициализировать атрибуты данных."""
+        self.name = name
+        self.zones = tuple(zones)
+        self.bands = tuple(bands)
+        self._build_grid()
+
+    def _build_grid(self):
+        self.grid = {}
+        if not self.zones:
+            self.bbox = None
+            return
+        self.bbox = (min(zone.bbox[0] for zone in self.zones),
+                     min(zone.bbox[1] for zone in self.zones),
+                     max(zone.bbox[2] for zone in self.zones),
+                     max(zone.bbox[3] for zone in self.zones))
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        self.cell_lat = (max_lat - min_lat) / GRID_SIZE or 1.0
+        self.cell_lon = (max_lon - min_lon) / GRID_SIZE or 1.0
+        for zone in self.zones:
+            row_from, col_from = self._cell(zone.bbox[0], zone.bbox[1])
+            row_to, col_to = self._cell(zone.bbox[2], zone.bbox[3])
+            for row in range(row_from, row_to + 1):
+                for col in range(col_from, col_to + 1):
+                    # Порядок зон в клетке совпадает с порядком настроек.
+                    self.grid.setdefault((row, col), []).append(zone)
+
+    def _cell(self, lat, lon):
+        row = int((lat - self.bbox[0]) / self.cell_lat)
+        col = int((lon - self.bbox[1]) / self.cell_lon)
+        return min(row, GRID_SIZE - 1), min(col, GRID_SIZE - 1)
+
+    def find_zone(self, lat, lon):
+        """Первая зона, содержащая точку, или None."""
+        if self.bbox is None:
+            return None
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return None
+        for zone in self.grid.get(self._cell(lat, lon), ()):
+            if zone.contains(lat, lon):
+                return zone
+        return None
+
+    def find_band(self, distance):
+        return find_band(self.bands, distance)
+
+
+class TariffEngine():
+    """
+    Расчет доставки по зонам и расстоянию.
+
+    stores - {пиццерия: StoreTariff}, default_bands - полосы для
+    пиццерий, которых нет в stores.
+    """
+
+    def __init__(self, stores=None, default_bands=DEFAULT_BANDS):
+        """Инициализировать атрибуты данных."""
+        self.stores = dict(stores or {})
+        self.default_bands = tuple(default_bands)
+        self._metrics = {
+            'quotes': 0,
+            'zone': 0,
+            'band': 0,
+            'undeliverable': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        """Собрать тарифы из словаря в формате файла настроек."""
+        default = config.get('default') or {}
+        default_bands = (parse_bands(default['bands'], 'default')
+                         if 'bands' in default else DEFAULT_BANDS)
+        stores = {}
+        for name, store in (config.get('stores') or {}).items():
+            zones = []
+            for zone in store.get('zones', ()):
+                where = f'{name}, зона {zone.get("name")}'
+                price, eta = _parse_price(zone, where)
+                zones.append(Zone(zone.get('name') or where, price, eta,
+                                  zone.get('polygon') or ()))
+            if 'bands' in store:
+                bands = parse_bands(store['bands'], name)
+            elif zones:
+                # Вне нарисованных зон пиццерия не возит.
+                bands = ()
+            else:
+                bands = default_bands
+            stores[name] = StoreTariff(name, zones, bands)
+        logger.info(f'Загружены тарифы пиццерий: {len(stores)}, '
+                    f'зон: {sum(len(s.zones) for s in stores.values())}')
+        return cls(stores, default_bands)
+
+    @classmethod
+    def from_file(cls, path):
+        """Загрузить тарифы из JSON-файла."""
+        with open(path, encoding='utf-8') as f:
+            return cls.from_config(json.load(f))
+
+    def quote(self, store_name, latitude, longitude, distance):
+        """
+        Стоимость доставки из пиццерии store_name в точку клиента.
+
+        distance - расстояние до пиццерии в км. Возвращает словарь
+        {'store', 'zone', 'price', 'eta', 'distance', 'deliverable'};
+        если доставки нет, zone, price и eta - None.
+        """
+        self._metrics['quotes'] += 1
+        store = self.stores.get(store_name)
+        zone = None
+        if store is not None:
+            zone = store.find_zone(float(latitude), float(longitude))
+            band = store.find_band(distance) if zone is None else None
+        else:
+            band = find_band(self.default_bands, distance)
+        if zone is not None:
+            self._metrics['zone'] += 1
+            tariff = {'zone': zone.name, 'price': zone.price,
+                      'eta': zone.eta}
+        elif band is not None:
+            self._metrics['band'] += 1
+            tariff = {'zone': band['name'], 'price': band['price'],
+                      'eta': band['eta']}
+        else:
+            self._metrics['undeliverable'] += 1
+            tariff = {'zone': None, 'price': None, 'eta': None}
+        return {
+            'store': store_name,
+            **tariff,
+            'distance': distance,
+            'deliverable': tariff['price'] is not None,
+        }
+
+    def stats(self):
+        return dict(self._metrics)
@@ -0,0 +1,40 @@
+import unittest
+
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.fake_telegram import FakeBot
+from dispatch import Dispatcher
+
+
+class NoCouriers():
+
+    def couriers(self, store):
+        return ()
+
+
+class Stores():
+
+    def point(self, store):
+        return (53.71, 91.69)
+
+
+class DeadLetterTest(unittest.IsolatedAsyncioTestCase):
+    """Заказ пиццерии без доставщиков не ждет раздачи вечно."""
+
+    async def test_dead_letter(self):
+        db = FakeRedis()
+        bot = FakeBot()
+        dispatcher = Dispatcher(db, NoCouriers(), Stores(), max_attempts=3,
+                                alert_chat_id=42)
+        dispatcher.add(7, 1, 'Пункт', 53.72, 91.70, 'Пицца - 1 шт.')
+        for _ in range(3):
+            self.assertEqual(await dispatcher.run(bot), 0)
+
+        stats = dispatcher.stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['dead_pending'], 1)
+        self.assertEqual(stats['dead'], 1)
+        self.assertEqual(bot.total_calls(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
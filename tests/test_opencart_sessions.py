@@ -0,0 +1,52 @@
+import unittest
+
+from opencart_sessions import SessionRegistry
+from opencart_tokens import TokenManager
+
+
+class FakeLoginTokens(TokenManager):
+
+    async def _login(self, session):
+        self.logins = getattr(self, 'logins', 0) + 1
+        return f'token-{self.logins}'
+
+
+class EvictionTest(unittest.IsolatedAsyncioTestCase):
+    """Вытесненный чат сохраняет api-сессию и корзину в ней."""
+
+    async def asyncSetUp(self):
+        self.moved = []
+
+        async def on_refresh(old_token, new_token):
+            self.moved.append((old_token, new_token))
+
+        self.registry = SessionRegistry('user', 'key', 'site',
+                                        max_sessions=1)
+        self.registry.tokens = FakeLoginTokens('user', 'key', 'site',
+                                               on_refresh=on_refresh)
+
+    async def asyncTearDown(self):
+        await self.registry.close()
+
+    async def token(self, chat_id):
+        async with self.registry.session(chat_id) as chat:
+            return await self.registry.get_api_token(chat)
+
+    async def test_lru_eviction_keeps_token(self):
+        self.assertEqual(await self.token(1), 'token-1')
+        self.assertEqual(await self.token(2), 'token-2')
+        self.assertEqual(self.registry.stats()['evicted_lru'], 1)
+        self.assertEqual(await self.token(1), 'token-1')
+        self.assertEqual(self.registry.tokens.logins, 2)
+
+    async def test_expired_token_moves_cart(self):
+        self.assertEqual(await self.token(1), 'token-1')
+        await self.token(2)
+        # api-сессия чата 1 истекла, пока его aiohttp-сессия была закрыта.
+        self.registry.tokens._tokens[1] = ('token-1', 0)
+        self.assertEqual(await self.token(1), 'token-3')
+        self.assertEqual(self.moved, [('token-1', 'token-3')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from opencart_cart_db import local_call
+from opencart_tokens import TokenManager
+
+
+class FakeLoginTokens(TokenManager):
+
+    async def _login(self, session):
+        self.logins = getattr(self, 'logins', 0) + 1
+        return f'token-{self.logins}'
+
+
+class LocalCallTest(unittest.IsolatedAsyncioTestCase):
+    """Корзина в БД не продлевает api-сессию и переезжает на новый токен."""
+
+    async def asyncSetUp(self):
+        self.moved = []
+
+        async def on_refresh(old_token, new_token):
+            self.moved.append((old_token, new_token))
+
+        self.tokens = FakeLoginTokens('user', 'key', 'site', ttl=3600,
+                                      on_refresh=on_refresh)
+
+    async def test_local_call_does_not_touch(self):
+        @local_call
+        async def cart_add(session, api_token):
+            return api_token
+
+        await self.tokens.call(1, None, cart_add)
+        expires = self.tokens._tokens[1][1]
+        await self.tokens.call(1, None, cart_add)
+        self.assertEqual(self.tokens._tokens[1][1], expires)
+
+    async def test_refresh_moves_cart(self):
+        self.assertEqual(await self.tokens.get(1, None), 'token-1')
+        self.assertEqual(self.moved, [])
+        # Сессия OpenCart истекла: токен обновляется, корзина переезжает.
+        self.tokens._tokens[1] = ('token-1', 0)
+        self.assertEqual(await self.tokens.get(1, None), 'token-2')
+        self.assertEqual(self.moved, [('token-1', 'token-2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
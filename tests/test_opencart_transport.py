@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from opencart_transport import Transport
+
+
+class HalfOpenTrialTest(unittest.IsolatedAsyncioTestCase):
+    """Отмененный пробный запрос не блокирует предохранитель."""
+
+    def setUp(self):
+        self.transport = Transport(retries=0, failure_threshold=1,
+                                   reset_timeout=0)
+        # Размыкаем предохранитель; reset_timeout=0 - сразу half-open.
+        self.transport.breaker.on_failure()
+        self.assertEqual(self.transport.breaker.state, 'half-open')
+
+    async def test_cancelled_trial(self):
+        started = asyncio.Event()
+
+        async def hang(timeout):
+            started.set()
+            await asyncio.sleep(3600)
+
+        async def ok(timeout):
+            return 'ok'
+
+        task = asyncio.create_task(self.transport.request('cart/add', hang))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertEqual(await self.transport.request('cart/add', ok), 'ok')
+        self.assertEqual(self.transport.breaker.state, 'closed')
+
+    def test_interrupted_sync_trial(self):
+        def interrupt(timeout):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.transport.request_sync('cart/add', interrupt)
+
+        self.assertEqual(
+            self.transport.request_sync('cart/add', lambda timeout: 'ok'),
+            'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
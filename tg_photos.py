@@ -0,0 +1,88 @@
+"""
+Кэш file_id фотографий товаров в Redis.
+
+Когда фото отправляется по URL, Telegram каждый раз скачивает его
+с сайта магазина. После первой отправки Telegram возвращает file_id,
+по которому то же фото можно отправлять без скачивания. Кэш хранит
+file_id для каждого товара вместе с путем к картинке, по которому он
+получен: если в oc_product у товара сменилась картинка, запись
+считается устаревшей и удаляется.
+
+Ключи: photo:<product_id> - {'image': путь к картинке, 'file_id': ...}.
+"""
+import logging
+
+from telegram.error import BadRequest
+
+
+logger = logging.getLogger('tg_bot.photos')
+
+
+class PhotoCache():
+    """Соответствие товар + картинка -> file_id Telegram."""
+
+    def __init__(self, db):
+        """Инициализировать атрибуты данных."""
+        self.db = db
+        self._metrics = {
+            'hits': 0,
+            'misses': 0,
+            'invalidated': 0,
+            'stored': 0,
+            'rejected': 0,
+        }
+
+    @staticmethod
+    def _key(product_id):
+        return f'photo:{product_id}'
+
+    def get(self, product_id, image):
+        """file_id фото товара или None, если его еще нет в кэше."""
+        entry = self.db.hgetall(self._key(product_id))
+        if entry and entry.get('image') != image:
+            # Картинку товара заменили - старый file_id не годится.
+            self.db.delete(self._key(product_id))
+            self._metrics['invalidated'] += 1
+            entry = {}
+        file_id = entry.get('file_id')
+        self._metrics['hits' if file_id else 'misses'] += 1
+        return file_id
+
+    def remember(self, product_id, image, message):
+        """Запомнить file_id фото из сообщения, которое вернул Telegram."""
+        photo = getattr(message, 'photo', None)
+        if not photo:
+            return None
+        # Последний размер - самый большой, его и показываем дальше.
+        file_id = photo[-1].file_id
+        self.db.hset(self._key(product_id),
+                     mapping={'image': image, 'file_id': file_id})
+        self._metrics['stored'] += 1
+        return file_id
+
+    def forget(self, product_id):
+        self.db.delete(self._key(product_id))
+
+    async def send(self, product_id, image, send):
+        """
+        Показать фото товара через send(photo) -> Message.
+
+        Сначала пробует file_id из кэша, если Telegram его не принял
+        (например, сменился токен бота) - отправляет по URL image.
+        file_id из ответа сохраняется для следующих показов.
+        """
+        file_id = self.get(product_id, image)
+        if file_id is not None:
+            try:
+                return await send(file_id)
+            except BadRequest as err:
+                logger.warning(f'file_id фото товара {product_id} '
+                               f'отклонен: {err.message}')
+                self._metrics['rejected'] += 1
+                self.forget(product_id)
+        message = await send(image)
+        self.remember(product_id, image, message)
+        return message
+
+    def stats(self):
+        return dict(self._metrics)
@@ -0,0 +1,122 @@
+"""
+Отрисовка экранов бота в одном сообщении.
+
+Вместо пары delete_message + send_* на каждое нажатие кнопки сообщение,
+в котором нажали кнопку, редактируется: текст - edit_message_text,
+фото - edit_message_media, только клавиатура - edit_message_reply_markup.
+Удалить старое сообщение и прислать новое приходится, только когда
+меняется тип сообщения (текст <-> фото) или Telegram отказывается его
+редактировать (сообщение удалено или старше 48 часов).
+"""
+import logging
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+
+logger = logging.getLogger('tg_bot.render')
+
+NOT_MODIFIED = 'message is not modified'
+
+
+class MessageRenderer():
+    """Показывает экран, редактируя сообщение с кнопками."""
+
+    def __init__(self):
+        """Инициализировать атрибуты данных."""
+        self.edited = 0
+        self.not_modified = 0
+        self.replaced = 0
+        self.edit_failed = 0
+        self.calls = 0
+
+    async def render(self, bot, message, text=None, reply_markup=None,
+                     photo=None, parse_mode=None):
+        """
+        Показать в message текст text или фото photo с подписью text.
+
+        Если text и photo не заданы, меняется только клавиатура.
+        Возвращает сообщение, в котором теперь показан экран.
+        """
+        if photo is not None:
+            can_edit = bool(getattr(message, 'photo', None))
+        elif text is not None:
+            can_edit = getattr(message, 'text', None) is not None
+        else:
+            can_edit = True
+
+        if can_edit:
+            try:
+                result = await self._edit(bot, message, text, reply_markup,
+                                          photo, parse_mode)
+                self.edited += 1
+                return result
+            except BadRequest as err:
+                if NOT_MODIFIED in err.message.lower():
+                    self.not_modified += 1
+                    return message
+                self.edit_failed += 1
+                logger.debug(f'Сообщение {message.message_id} не '
+                             f'отредактировать: {err.message}')
+                if text is None and photo is None:
+                    # Присылать заново нечего.
+                    return message
+        return await self._replace(bot, message, text, reply_markup,
+                                   photo, parse_mode)
+
+    async def _edit(self, bot, message, text, reply_markup, photo,
+                    parse_mode):
+        chat_id = message.chat_id
+        message_id = message.message_id
+        self.calls += 1
+        if photo is not None:
+            return await bot.edit_message_media(
+                chat_id=chat_id,
+                message_id=message_id,
+                media=InputMediaPhoto(media=photo, caption=text,
+                                      parse_mode=parse_mode),
+                reply_markup=reply_markup)
+        if text is not None:
+            return await bot.edit_message_text(text=text,
+                                               chat_id=chat_id,
+                                               message_id=message_id,
+                                               reply_markup=reply_markup,
+                                               parse_mode=parse_mode)
+        return await bot.edit_message_reply_markup(chat_id=chat_id,
+                                                   message_id=message_id,
+                                                   reply_markup=reply_markup)
+
+    async def _replace(self, bot, message, text, reply_markup, photo,
+                       parse_mode):
+        chat_id = message.chat_id
+        self.replaced += 1
+        self.calls += 2
+        try:
+            await bot.delete_message(chat_id=chat_id,
+                                     message_id=message.message_id)
+        except BadRequest as err:
+            # Уже удалено или слишком старое - новое все равно пришлем.
+            logger.debug(f'Сообщение {message.message_id} не '
+                         f'удалить: {err.message}')
+        if photo is not None:
+            return await bot.send_photo(chat_id=chat_id,
+                                        photo=photo,
+                                        caption=text,
+                                        reply_markup=reply_markup,
+                                        parse_mode=parse_mode)
+        return await bot.send_message(text=text,
+                                      chat_id=chat_id,
+                                      reply_markup=reply_markup,
+                                      parse_mode=parse_mode)
+
+    def stats(self):
+        renders = self.edited + self.not_modified + self.replaced
+        return {
+            'renders': renders,
+            'edited': self.edited,
+            'not_modified': self.not_modified,
+            'replaced': self.replaced,
+            'edit_failed': self.edit_failed,
+            'calls': self.calls,
+            'calls_per_render': self.calls / renders if renders else 0.0,
+        }
@@ -0,0 +1,149 @@
+"""
+Параллельная обработка апдейтов с очередью на каждый чат.
+
+handle_users_reply читает состояние чата из Redis, обрабатывает апдейт
+и записывает новое состояние. Если два апдейта одного чата (например,
+два быстрых нажатия) обрабатываются одновременно, второй прочитает
+старое состояние и затрет результат первого. ChatUpdateProcessor
+обрабатывает апдейты разных чатов параллельно, а апдейты одного чата -
+по очереди, в порядке поступления.
+"""
+import asyncio
+import logging
+import time
+
+from telegram.ext import BaseUpdateProcessor
+
+from opencart_transport import LatencyHistogram
+
+
+logger = logging.getLogger('tg_bot.updates')
+
+# Границы корзин гистограмм ожидания, мс.
+WAIT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def update_chat_key(update):
+    """Чат, к которому относится апдейт, или None."""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    return None
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик апдейтов для Application.concurrent_updates.
+
+    concurrency - сколько апдейтов обрабатывается одновременно всего,
+    max_pending - сколько апдейтов может ждать своей очереди (сверх
+    этого PTB перестает принимать новые). Апдейт сначала ждет свой чат
+    и только потом общий лимит, поэтому один "быстрый" пользователь
+    не занимает лимит апдейтами, которые все равно ждут друг друга.
+    """
+
+    def __init__(self, concurrency=64, max_pending=1024):
+        """Инициализировать атрибуты данных."""
+        # Семафор базового класса ограничивает число ждущих апдейтов,
+        # а не обрабатываемых: их ограничивает self._limit.
+        super().__init__(max_concurrent_updates=max_pending)
+        self.concurrency = concurrency
+        self._limit = asyncio.Semaphore(concurrency)
+        # chat_id -> [блокировка, число апдейтов чата в работе].
+        self._chats = {}
+        self._waiting_chat = 0
+        self._waiting_limit = 0
+        self._running = 0
+        self._metrics = {
+            'processed': 0,
+            'failed': 0,
+            'max_chat_depth': 0,
+            'max_queue_depth': 0,
+        }
+        self.chat_wait = LatencyHistogram(WAIT_BUCKETS)
+        self.limit_wait = LatencyHistogram(WAIT_BUCKETS)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _enter_chat(self, chat_key):
+        entry = self._chats.get(chat_key)
+        if entry is None:
+            entry = self._chats[chat_key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self._metrics['max_chat_depth'] = max(
+            self._metrics['max_chat_depth'], entry[1])
+        return entry
+
+    def _leave_chat(self, chat_key, entry):
+        entry[1] -= 1
+        if not entry[1]:
+            del self._chats[chat_key]
+
+    async def do_process_update(self, update, coroutine):
+        chat_key = update_chat_key(update)
+        if chat_key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._enter_chat(chat_key)
+        started = time.perf_counter()
+        self._waiting_chat += 1
+        self._observe_depth()
+        acquired = False
+        try:
+            # asyncio.Lock отдает блокировку в порядке очереди,
+            # так что апдейты чата идут в порядке поступления.
+            async with entry[0]:
+                acquired = True
+                self._waiting_chat -= 1
+                self.chat_wait.observe(time.perf_counter() - started)
+                await self._run(coroutine)
+        finally:
+            if not acquired:
+                self._waiting_chat -= 1
+            self._leave_chat(chat_key, entry)
+
+    async def _run(self, coroutine):
+        started = time.perf_counter()
+        self._waiting_limit += 1
+        self._observe_depth()
+        acquired = False
+        try:
+            async with self._limit:
+                acquired = True
+                self._waiting_limit -= 1
+                self.limit_wait.observe(time.perf_counter() - started)
+                self._running += 1
+                try:
+                    await coroutine
+                    self._metrics['processed'] += 1
+                except Exception:
+                    self._metrics['failed'] += 1
+                    raise
+                finally:
+                    self._running -= 1
+        finally:
+            if not acquired:
+                self._waiting_limit -= 1
+
+    def _observe_depth(self):
+        depth = self._waiting_chat + self._waiting_limit
+        self._metrics['max_queue_depth'] = max(
+            self._metrics['max_queue_depth'], depth)
+
+    def stats(self):
+        stats = dict(self._metrics)
+        stats['running'] = self._running
+        stats['waiting_chat'] = self._waiting_chat
+        stats['waiting_limit'] = self._waiting_limit
+        stats['chats'] = len(self._chats)
+        stats['chat_wait'] = self.chat_wait.stats()
+        stats['limit_wait'] = self.limit_wait.stats()
+        return stats
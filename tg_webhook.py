@@ -0,0 +1,236 @@
+"""
+Прием апдейтов Telegram через вебхук и их обработка несколькими
+процессами.
+
+Фронт (WebhookServer) - aiohttp-сервер, который принимает POST от
+Telegram, проверяет секретный токен и кладет апдейт в очередь Redis.
+Очередь разбита на shards списков tg_updates:<n>, шард выбирается по
+chat_id, поэтому все апдейты одного чата попадают в один список и
+обрабатываются одним воркером. Воркер (UpdateWorker) забирает апдейты
+своего шарда и обрабатывает разные чаты параллельно, а апдейты одного
+чата - строго по очереди.
+
+Состояние бота (состояние диалога, корзины, кэш фото) уже хранится
+в Redis, так что воркеры могут работать в разных процессах и на разных
+машинах.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from aiohttp import web
+
+
+logger = logging.getLogger('tg_bot.webhook')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_chat_id(data):
+    """chat_id апдейта в виде словаря из JSON или None."""
+    for key, payload in data.items():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get('chat') or payload.get('message', {}).get('chat')
+        if chat:
+            return chat['id']
+        # pre_checkout_query, inline_query и т.п.: личный чат = user_id.
+        if 'from' in payload:
+            return payload['from']['id']
+    return None
+
+
+class UpdateQueue():
+    """Очередь апдейтов в Redis, разбитая на шарды по chat_id."""
+
+    def __init__(self, db, shards, prefix='tg_updates'):
+        """Инициализировать атрибуты данных."""
+        self.db = db
+        self.shards = shards
+        self.prefix = prefix
+        self._metrics = {
+            'pushed': 0,
+            'popped': 0,
+        }
+
+    def shard(self, chat_id):
+        if chat_id is None:
+            return 0
+        return chat_id % self.shards
+
+    def _key(self, shard):
+        return f'{self.prefix}:{shard}'
+
+    def push(self, data):
+        """Положить апдейт в шард его чата. Возвращает номер шарда."""
+        shard = self.shard(update_chat_id(data))
+        # Время приема нужно, чтобы мерить задержку до обработки.
+        self.db.rpush(self._key(shard),
+                      json.dumps({'received_at': time.time(),
+                                  'update': data}))
+        self._metrics['pushed'] += 1
+        return shard
+
+    def pop(self, shard, timeout=1):
+        """Забрать апдейт шарда, ожидая не дольше timeout секунд."""
+        item = self.db.blpop([self._key(shard)], timeout=timeout)
+        if item is None:
+            return None
+        self._metrics['popped'] += 1
+        return json.loads(item[1])
+
+    def lengths(self):
+        """Сколько апдейтов ждет в каждом шарде."""
+        return [self.db.llen(self._key(shard))
+                for shard in range(self.shards)]
+
+    def stats(self):
+        stats = dict(self._metrics)
+        stats['lengths'] = self.lengths()
+        return stats
+
+
+class WebhookServer():
+    """HTTP-сервер, принимающий апдейты от Telegram."""
+
+    def __init__(self, queue, secret_token=None, path='/telegram'):
+        """Инициализировать атрибуты данных."""
+        self.queue = queue
+        self.secret_token = secret_token
+        self.path = path
+        self.runner = None
+        self._metrics = {
+            'accepted': 0,
+            'forbidden': 0,
+            'invalid': 0,
+        }
+
+    async def handle(self, request):
+        if (self.secret_token
+                and request.headers.get(SECRET_HEADER) != self.secret_token):
+            self._metrics['forbidden'] += 1
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            self._metrics['invalid'] += 1
+            return web.Response(status=400)
+        # Telegram ждет быстрый ответ: только кладем в очередь.
+        self.queue.push(data)
+        self._metrics['accepted'] += 1
+        return web.Response()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def start(self, host='0.0.0.0', port=8443):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f'Вебхук слушает {host}:{port}{self.path}')
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def stats(self):
+        return dict(self._metrics)
+
+
+class UpdateWorker():
+    """
+    Обработчик апдейтов одного шарда очереди.
+
+    process(data) - корутина, обрабатывающая апдейт (словарь из JSON).
+    Одновременно обрабатывается не больше concurrency апдейтов и
+    в памяти ждет не больше max_pending, апдейты одного чата идут
+    строго в порядке поступления.
+    """
+
+    def __init__(self, queue, shard, process, concurrency=32,
+                 max_pending=256, poll_timeout=1):
+        """Инициализировать атрибуты данных."""
+        self.queue = queue
+        self.shard = shard
+        self.process = process
+        self.poll_timeout = poll_timeout
+        self._limit = asyncio.Semaphore(concurrency)
+        self._pending = asyncio.Semaphore(max_pending)
+        # Последний апдейт каждого чата: следующий ждет его завершения.
+        self._tails = {}
+        self._tasks = set()
+        self._running = False
+        self._metrics = {
+            'processed': 0,
+            'failed': 0,
+            'delay_total': 0.0,
+            'delay_max': 0.0,
+        }
+
+    async def run(self):
+        """Забирать и обрабатывать апдейты, пока не вызван stop()."""
+        self._running = True
+        logger.info(f'Воркер шарда {self.shard} запущен')
+        while self._running:
+            await self._pending.acquire()
+            try:
+                # Синхронный BLPOP не должен блокировать event loop.
+                item = await asyncio.to_thread(self.queue.pop, self.shard,
+                                               self.poll_timeout)
+            except Exception:
+                self._pending.release()
+                raise
+            if item is None:
+                self._pending.release()
+                continue
+            self._schedule(item)
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self, item):
+        chat_id = update_chat_id(item['update'])
+        previous = self._tails.get(chat_id)
+        task = asyncio.create_task(self._process(item, previous))
+        self._tails[chat_id] = task
+        self._tasks.add(task)
+
+        def done(task):
+            self._tasks.discard(task)
+            self._pending.release()
+            if self._tails.get(chat_id) is task:
+                del self._tails[chat_id]
+        task.add_done_callback(done)
+
+    async def _process(self, item, previous):
+        if previous is not None:
+            # Ошибка предыдущего апдейта не должна останавливать чат.
+            await asyncio.wait([previous])
+        async with self._limit:
+            try:
+                await self.process(item['update'])
+            except Exception as err:
+                self._metrics['failed'] += 1
+                logger.error(f'Ошибка обработки апдейта '
+                             f'{item["update"].get("update_id")}: {err!r}')
+            finally:
+                delay = time.time() - item['received_at']
+                self._metrics['processed'] += 1
+                self._metrics['delay_total'] += delay
+                self._metrics['delay_max'] = max(self._metrics['delay_max'],
+                                                 delay)
+
+    def stats(self):
+        stats = dict(self._metrics)
+        delay_total = stats.pop('delay_total')
+        stats['delay_avg'] = (delay_total / stats['processed']
+                              if stats['processed'] else 0.0)
+        stats['in_flight'] = len(self._tasks)
+        stats['chats'] = len(self._tails)
+        return stats